@@ -6,60 +6,109 @@ import time
 import re
 import sys
 import os
-from sklearn.feature_selection import SelectKBest
-from sklearn.feature_selection import chi2
-from sklearn.feature_selection import f_classif
-from sklearn.preprocessing import StandardScaler
-from sklearn.preprocessing import MinMaxScaler
+import argparse
+import multiprocessing
+import fractions
+import io
+import json
+import columnar
+import buckets
+import store
+import process
+import openingtree
 
 # extracts features and build csvs from them.
 # writes and opens a figure of the results
+# the FEATURES files are streamed a chunk at a time into FeatureStats, which hold all the f_classif
+# and chi2 scores need, so they are never loaded whole and can be read by many processes at once.
+
+# how many rows of a FEATURES .npy file (or bytes of a csv) are read at a time
+CHUNK_ROWS = 1024 * 1024
+CHUNK_BYTES = 16 * 1024 * 1024
+
+# the summary of the last analysis, kept next to the FEATURES files. it has the FeatureStats and scores
+# of every bucket, so the chart can be made again (see --chart-only) without reading the files:
+#   {"buckets": [{"name", "file", "size", "mtime", "stats": FeatureStats.to_dict(), "f_scores", "chi2_scores"}]}
+# files that haven't changed since they were summarized aren't read again either.
+SUMMARY = "analysis.json"
+# what the chart calls the features, and the colors of their bars
+FEATURE_LABELS = {"when_castled": "Castling", "num_center_squares_controlled": "Center Square Control",\
+    "material_difference": "Gambits", "num_unique_pieces_moved": "Unique Pieces Moved"}
+FEATURE_COLORS = ['g', 'c', 'b', 'm', 'y', 'r', 'k', 'tab:orange']
 
 # main program entry
 # analyze all FEATURE csvs and 
 def main(args:list):
     start = time.time()
-    path = str(args[0])
-    csvs = get_csvs(path)
-    print("Analyzing",len(csvs),"csvs:")
-    for csv in csvs:
-        print("\t",csv)
-    importances = iterate_csvs(csvs, path)
-    plt = make_chart(importances, path)
+    args = get_args(args)
+    path = str(args.path)
+    if args.chart_only:
+        summary = load_summary(path)
+        if summary is None:
+            print("no summary of an earlier analysis in",path)
+            return
+    elif args.tree:
+        print("Analyzing the opening tree of",path)
+        summary = iterate_tree(openingtree.OpeningIndex(path), args.opening, args.buckets)
+    elif args.opening is not None:
+        print("Analyzing the games starting",args.opening,"in the store of",path)
+        summary = iterate_store(store.FeatureStore(path), args.opening)
+    else:
+        csvs = buckets.get_files(path, "FEATURES", args.format)
+        print("Analyzing",len(csvs),"csvs:")
+        for bucket, csv in csvs:
+            print("\t",csv)
+        summary = iterate_csvs(csvs, path, args.workers, load_summary(path))
+        save_summary(path, summary)
+    plt = make_chart(summary, path)
     end = time.time() - start
     print("Done. Took",end,"seconds.")
     plt.show()
     
-# makes the matplotlib figure
-def make_chart(importances:list, path:str):
-    xs = 1
-    x1 = []
-    x2 = []
-    x3 = []
-    x4 = []
-    # scale to data size
-    scale = [1533, 910605, 2192593, 89214]
-    for i in range(len(importances)):
-        x1.append((importances[i][0]/scale[i])*xs)
-        x2.append((importances[i][1]/scale[i])*xs)
-        x3.append((importances[i][2]/scale[i])*xs)
-        x4.append((importances[i][3]/scale[i])*xs)
-    labels = ["0-999", "1000-1499", "1500-1999", "2000+"]
-    line_labels = ["Castling", "Center Square Control", "Gambits" ,"Unique Pieces Moved"]
+# reads the commandline args
+def get_args(args:list):
+    parser = argparse.ArgumentParser(description="ranks the features in the FEATURES files of a directory")
+    parser.add_argument("path", help="path to the csvs directory")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv", help="format of the FEATURES files to read")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to read the FEATURES files with")
+    parser.add_argument("--chart-only", action="store_true", help="make the chart from the summary of the last analysis without reading any FEATURES files")
+    parser.add_argument("--opening", help="only analyze the games starting with these moves (like \"1.e4 c5\"), read from the features store (see store.py)")
+    parser.add_argument("--tree", action="store_true", help="analyze the opening tree process.py --tree built (see openingtree.py) instead of the FEATURES files, --opening too")
+    parser.add_argument("--buckets", type=buckets.BucketScheme, help="with --tree, group the buckets into the ones of this scheme: brackets, elo:WIDTH or bounds:ELO/ELO/.., with ,tc to split by time control too")
+    return parser.parse_args(args)
+
+# makes the matplotlib figure from a summary (see SUMMARY)
+# every feature's F-value in a bucket is scaled to the bucket's number of rows
+def make_chart(summary:dict, path:str):
+    entries = summary["buckets"]
+    labels = [entry["name"] for entry in entries]
+    columns = entries[0]["stats"]["columns"] if entries else []
     x = np.arange(len(labels))
-    w = 0.2
-    plt.bar(x+-.2, x1, width=w, color='g', align='center', label = line_labels[0], edgecolor="black")
-    plt.bar(x, x2, width=w, color='c', align='center', label = line_labels[1], edgecolor="black")
-    plt.bar(x+.2, x3, width=w, color='b', align='center', label = line_labels[2], edgecolor="black")
-    plt.bar(x+.4, x4, width=w, color='m', align='center', label = line_labels[3], edgecolor="black")
+    w = 0.8 / max(len(columns), 1)
+    for i, column in enumerate(columns):
+        scores = []
+        for entry in entries:
+            rows = FeatureStats.from_dict(entry["stats"]).get_count()
+            scores.append(entry["f_scores"][entry["stats"]["columns"].index(column)] / rows)
+        plt.bar(x + (i - (len(columns) - 1) / 2) * w, scores, width=w, color=FEATURE_COLORS[i % len(FEATURE_COLORS)],\
+            align='center', label = get_feature_label(column), edgecolor="black")
     plt.xlabel('Rating Ranges')
-    plt.ylabel('F-value scores')
+    plt.ylabel('F-value scores per row')
     plt.title('Best Features When Predicting Game Outcome')
-    plt.xticks(np.arange(4), (labels))
+    plt.xticks(np.arange(len(labels)), (labels))
     plt.legend()
     plt.savefig('FeatureImportance.png')
     return plt
 
+# returns what the chart calls a FEATURES column (with its horizon, for features taken at several)
+def get_feature_label(column:str):
+    if column in FEATURE_LABELS:
+        return FEATURE_LABELS[column]
+    feature, _, moves = column.rpartition("_")
+    if feature in FEATURE_LABELS:
+        return FEATURE_LABELS[feature]+" ("+moves+" moves)"
+    return column
+
 # opens all the files and returns a list of file objects instead of strings
 def open_all(out_names:list):
     files = []
@@ -73,57 +122,324 @@ def open_all(out_names:list):
 def analyze(csv, data):
     # data: the data in CSV:
     # format: when_castled,num_center_squares_controlled,material_difference,num_unique_pieces_moved,win
-    y = data.iloc[:,-1]
-    x = data.iloc[:,0:-1]
-    scaler = MinMaxScaler()
-    x = scaler.fit_transform(x)
-    x = pd.DataFrame(x)
-    kbest = SelectKBest(score_func=f_classif, k=4)
-    importance = pd.DataFrame(kbest.fit(x,y).scores_)
-    rating_range = get_range(csv)
+    stats = FeatureStats(list(data.columns[:-1]))
+    stats.add(data.iloc[:,0:-1].to_numpy(), data.iloc[:,-1].to_numpy())
+    return get_importance(stats)
+
+# returns the best 4 f_classif scores of stats, highest first
+def get_importance(stats):
+    importance = pd.DataFrame(stats.get_f_scores())
     importance = importance.nlargest(4, 0)
     importance_ar = importance[0].tolist()
     return importance_ar
 
+# per class counts, sums and sums of squares of some feature columns (and their minimums and maximums),
+# added up a chunk of rows at a time. that's everything sklearn's f_classif and chi2 need, so the scores
+# come out the same as theirs without the rows ever being in memory together, and FeatureStats of
+# different chunks (or processes) can be merged. integer features are added up exactly.
+class FeatureStats:
+    def __init__(self, columns:list):
+        self.columns = columns
+        # class -> [rows, sums, sums of squares]
+        self.classes = {}
+        self.minimums = None
+        self.maximums = None
+
+    # adds rows x (a 2d array with a column per feature) of classes y
+    def add(self, x, y):
+        x = np.asarray(x)
+        y = np.asarray(y)
+        if len(x) == 0:
+            return
+        # a row per feature, so every sum runs over contiguous memory
+        columns = np.ascontiguousarray(x.T, dtype=np.int64 if x.dtype.kind in "iub" else np.float64)
+        self.add_range(columns.min(axis=1), columns.max(axis=1))
+        if y.dtype.kind in "iub" and y.min() >= 0:
+            labels = np.flatnonzero(np.bincount(y))
+        else:
+            labels = np.unique(y)
+        sums = columns.sum(axis=1)
+        squares = np.einsum("ij,ij->i", columns, columns)
+        count = len(y)
+        # the last class gets what's left of the totals
+        for label in labels[:-1]:
+            rows = columns[:, y == label]
+            label_sums = rows.sum(axis=1)
+            label_squares = np.einsum("ij,ij->i", rows, rows)
+            self.add_class(label.item(), rows.shape[1], label_sums, label_squares)
+            sums = sums - label_sums
+            squares = squares - label_squares
+            count -= rows.shape[1]
+        self.add_class(labels[-1].item(), count, sums, squares)
+
+    # adds the stats of other, which has the same columns
+    def merge(self, other):
+        if other.minimums is not None:
+            self.add_range(other.minimums, other.maximums)
+        for label, (count, sums, squares) in other.classes.items():
+            self.add_class(label, count, sums, squares)
+
+    def add_range(self, minimums, maximums):
+        if self.minimums is None:
+            self.minimums = minimums
+            self.maximums = maximums
+        else:
+            self.minimums = np.minimum(self.minimums, minimums)
+            self.maximums = np.maximum(self.maximums, maximums)
+
+    def add_class(self, label, count:int, sums, squares):
+        if label in self.classes:
+            entry = self.classes[label]
+            entry[0] += count
+            entry[1] = entry[1] + sums
+            entry[2] = entry[2] + squares
+        else:
+            self.classes[label] = [count, sums, squares]
+
+    # returns the stats as json types (see from_dict)
+    def to_dict(self):
+        return {"columns": self.columns,\
+            "classes": [[label, count, sums.tolist(), squares.tolist()] for label, (count, sums, squares) in self.classes.items()],\
+            "minimums": None if self.minimums is None else self.minimums.tolist(),\
+            "maximums": None if self.maximums is None else self.maximums.tolist()}
+
+    @staticmethod
+    def from_dict(values:dict):
+        stats = FeatureStats(values["columns"])
+        for label, count, sums, squares in values["classes"]:
+            stats.classes[label] = [count, np.array(sums), np.array(squares)]
+        if values["minimums"] is not None:
+            stats.minimums = np.array(values["minimums"])
+            stats.maximums = np.array(values["maximums"])
+        return stats
+
+    # returns the number of rows added
+    def get_count(self):
+        return sum(count for count, sums, squares in self.classes.values())
+
+    # returns the ANOVA F-value of every column, like sklearn.feature_selection.f_classif
+    # (which gives the same scores on min-max scaled columns, F is unchanged by scaling)
+    def get_f_scores(self):
+        labels = sorted(self.classes)
+        counts = [self.classes[label][0] for label in labels]
+        num_rows = sum(counts)
+        scores = []
+        for i in range(len(self.columns)):
+            if len(labels) < 2 or num_rows <= len(labels):
+                scores.append(np.nan)
+                continue
+            sums = [self.classes[label][1][i].item() for label in labels]
+            squares = [self.classes[label][2][i].item() for label in labels]
+            square_of_sums = divide(sum(sums) ** 2, num_rows)
+            sstot = sum(squares) - square_of_sums
+            ssbn = sum(divide(total ** 2, count) for total, count in zip(sums, counts)) - square_of_sums
+            sswn = sstot - ssbn
+            msb = divide(ssbn, len(labels) - 1)
+            msw = divide(sswn, num_rows - len(labels))
+            with np.errstate(divide="ignore", invalid="ignore"):
+                scores.append(float(np.float64(msb) / np.float64(msw)))
+        return scores
+
+    # returns the chi-squared statistic of every column, like sklearn.feature_selection.chi2.
+    # scale takes it on the columns min-max scaled to 0-1 (chi2 needs non-negative features)
+    def get_chi2_scores(self, scale:bool=True):
+        labels = sorted(self.classes)
+        counts = [self.classes[label][0] for label in labels]
+        num_rows = sum(counts)
+        scores = []
+        for i in range(len(self.columns)):
+            sums = [self.classes[label][1][i].item() for label in labels]
+            if scale:
+                low = self.minimums[i].item()
+                width = self.maximums[i].item() - low
+                if width == 0:
+                    width = 1 # MinMaxScaler leaves constant columns at 0
+                sums = [divide(total - count * low, width) for total, count in zip(sums, counts)]
+            elif self.minimums is not None and self.minimums[i] < 0:
+                raise ValueError("chi2 needs non-negative features, "+self.columns[i]+" has negative values")
+            feature_count = sum(sums)
+            score = 0
+            for total, count in zip(sums, counts):
+                expected = divide(count * feature_count, num_rows)
+                if expected == 0:
+                    score = np.nan
+                    break
+                score += divide((total - expected) ** 2, expected)
+            scores.append(float(score))
+        return scores
+
+# a / b, exactly if they're ints
+def divide(a, b):
+    if isinstance(a, (int, fractions.Fraction)) and isinstance(b, int):
+        return fractions.Fraction(a, b)
+    return a / b
+
 # strips the csv of their GAMES tag.
 def strip_csv(csv:str):
     return csv.split("GAMES")[0]
 
-# get all the relevant csvs from the databases directory
-def get_csvs(path:str):
-    csvs = []
-    for root, directories, files in os.walk(path, topdown=False):
-	    for name in files:
-		    if (".csv" in name) and ("FEATURES" in name): csvs.append(os.path.join(root, name))
-	    for name in directories:
-		    if (".csv" in name) and ("FEATURES" in name): csvs.append(os.path.join(root, name))
-    return csvs
-
 # iterate through all the csvs. calls the processing function.
-def iterate_csvs(csvs:list, path:str):
-    importances = []
-    for csv in csvs:
-        data = pd.read_csv(csv)
-        print("analyzing",csv)
-        rating_range = get_range(csv)
-        importance = analyze(csv, data)
-        importances.append(importance)
-    return importances
-
-# extract the rating range from a csv string
-def get_range(csv:str):
-    if "1000" in csv:
-        return "1000-1499"
-    elif "1500" in csv:
-        return "1500-1999"
-    elif "2000" in csv:
-        return "2000+"
-    elif "999" in csv:
-        return "0-999"
+# csvs are (bucket name, FEATURES file) pairs, see buckets.get_files.
+# workers > 1 reads the chunks of every csv in that many processes.
+# csvs that are the same as in the last summary (if given) aren't read again.
+# returns the summary (see SUMMARY) of the buckets, without the ones that have no games
+def iterate_csvs(csvs:list, path:str, workers:int=1, last_summary:dict=None):
+    summarized = {}
+    if last_summary is not None:
+        summarized = {entry["file"]: entry for entry in last_summary["buckets"]}
+    entries = []
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for bucket, csv in csvs:
+            name = os.path.relpath(csv, path)
+            stat = os.stat(csv)
+            entry = summarized.get(name)
+            if entry is not None and entry["name"] == bucket and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                print("using the summary of",csv)
+                stats = FeatureStats.from_dict(entry["stats"])
+            else:
+                print("analyzing",csv)
+                stats = get_stats(csv, pool)
+            if stats.get_count() == 0:
+                print("skipping",csv,"(no games)")
+                continue
+            entries.append({"name": bucket, "file": name, "size": stat.st_size, "mtime": stat.st_mtime,\
+                "stats": stats.to_dict(), "f_scores": stats.get_f_scores(), "chi2_scores": stats.get_chi2_scores()})
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return {"buckets": entries}
+
+# the same as iterate_csvs for the games of every bucket of a store.FeatureStore that start with opening.
+# the summary (which isn't saved) has no files
+def iterate_store(feature_store, opening):
+    entries = []
+    for bucket in feature_store.buckets:
+        rows = feature_store.get_rows(bucket, opening)
+        stats = FeatureStats(feature_store.columns)
+        for start in range(0, len(rows), CHUNK_ROWS):
+            stats.add(*store.get_features(rows[start:start+CHUNK_ROWS], feature_store.columns))
+        if stats.get_count() == 0:
+            print("skipping",bucket,"(no games)")
+            continue
+        print("analyzed",len(rows),"games of",bucket)
+        entries.append({"name": bucket, "file": None, "size": None, "mtime": None,\
+            "stats": stats.to_dict(), "f_scores": stats.get_f_scores(), "chi2_scores": stats.get_chi2_scores()})
+    return {"buckets": entries}
+
+# the same as iterate_csvs for the games of an openingtree.OpeningIndex that start with opening, from the counts
+# of its nodes instead of the rows of every game. scheme (a buckets.BucketScheme, if given) groups the buckets
+# of the tree into its own, which have to be made of whole buckets of the tree (see buckets.get_groups).
+# the summary (which isn't saved) has no files
+def iterate_tree(index, opening=None, scheme=None):
+    counts = index.get_counts(list(process.iter_plies(opening or "")))
+    names = index.buckets
+    groups = np.arange(len(names))
+    if scheme is not None:
+        names = scheme.names
+        groups = np.array(buckets.get_groups(scheme, buckets.BucketScheme(index.scheme)))
+    entries = []
+    for number, bucket in enumerate(names):
+        stats = get_tree_stats(index, counts[groups[counts["bucket"]] == number])
+        if stats.get_count() == 0:
+            print("skipping",bucket,"(no games)")
+            continue
+        print("analyzed",stats.get_count() // 2,"games of",bucket)
+        entries.append({"name": bucket, "file": None, "size": None, "mtime": None,\
+            "stats": stats.to_dict(), "f_scores": stats.get_f_scores(), "chi2_scores": stats.get_chi2_scores()})
+    return {"buckets": entries}
+
+# returns the FeatureStats of the FEATURES rows of the games in counts (rows of an opening tree's counts, see
+# openingtree.COUNTS_DTYPE): every board feature is its node's value once per game, and when_castled is summed up
+# already. white's row of a game is a win if white won and black's if black did
+def get_tree_stats(index, counts):
+    stats = FeatureStats(index.columns)
+    if len(counts) == 0:
+        return stats
+    nodes = index.nodes[counts["node"]]
+    games = counts["games"].astype(np.int64)
+    board_columns = index.columns[1:]
+    # a row per feature and a column per count
+    white = np.stack([np.asarray(nodes[column+"_w"], dtype=np.int64) for column in board_columns])
+    black = np.stack([np.asarray(nodes[column+"_b"], dtype=np.int64) for column in board_columns])
+    stats.add_range(np.concatenate(([counts["when_castled_min"].min()], np.minimum(white, black).min(axis=1))).astype(np.int64),\
+        np.concatenate(([counts["when_castled_max"].max()], np.maximum(white, black).max(axis=1))).astype(np.int64))
+    for values, color, won in [(white, "w", counts["result"] == 1), (black, "b", counts["result"] == 2)]:
+        sums = np.concatenate(([counts["when_castled_"+color]], values * games))
+        squares = np.concatenate(([counts["when_castled_"+color+"_squares"]], values * values * games))
+        for label, rows in [(0, ~won), (1, won)]:
+            if games[rows].sum() > 0:
+                stats.add_class(label, int(games[rows].sum()), sums[:, rows].sum(axis=1), squares[:, rows].sum(axis=1))
+    return stats
+
+# returns the summary of the last analysis of path, or None if there isn't one
+def load_summary(path:str):
+    summary_path = os.path.join(path, SUMMARY)
+    if not os.path.exists(summary_path):
+        return None
+    with open(summary_path, "r") as f:
+        return json.load(f)
+
+# writes the summary of an analysis of path
+def save_summary(path:str, summary:dict):
+    with open(os.path.join(path, SUMMARY), "w") as f:
+        json.dump(summary, f, indent=1)
+
+# streams a FEATURES csv (or .npy file) into FeatureStats of its feature columns (the last column,
+# win, is the class). the chunks are read by pool's processes if it's given
+def get_stats(csv:str, pool=None):
+    columns = columnar.get_columns(csv)
+    stats = FeatureStats(columns[:-1])
+    tasks = [(csv, start, end, columns) for start, end in get_chunks(csv)]
+    if pool is None:
+        chunks = map(read_chunk_stats, tasks)
+    else:
+        chunks = pool.imap_unordered(read_chunk_stats, tasks)
+    for chunk_stats in chunks:
+        stats.merge(chunk_stats)
+    return stats
+
+# splits a FEATURES file into (start, end) pieces of about CHUNK_ROWS rows of a .npy file
+# or CHUNK_BYTES bytes of a csv (past its header, split at line ends)
+def get_chunks(csv:str):
+    if csv.endswith(".npy"):
+        with open(csv, "rb") as f:
+            length, dtype, header_bytes = columnar.read_header(f)
+        return [(start, min(start + CHUNK_ROWS, length)) for start in range(0, length, CHUNK_ROWS)]
+    size = os.path.getsize(csv)
+    chunks = []
+    with open(csv, "rb") as f:
+        f.readline() # the header
+        start = f.tell()
+        while start < size:
+            f.seek(min(start + CHUNK_BYTES, size) - 1)
+            f.readline() # to the end of the line the chunk ends in
+            end = min(f.tell(), size)
+            chunks.append((start, end))
+            start = end
+    return chunks
+
+# worker side of get_stats: returns the FeatureStats of rows (or bytes) start to end of a FEATURES file
+def read_chunk_stats(task:tuple):
+    csv, start, end, columns = task
+    stats = FeatureStats(columns[:-1])
+    if csv.endswith(".npy"):
+        rows = columnar.load_npy(csv)[start:end]
+        x = np.stack([rows[column] for column in columns[:-1]]).T
+        y = rows[columns[-1]]
+    else:
+        with open(csv, "rb") as f:
+            f.seek(start)
+            data = pd.read_csv(io.BytesIO(f.read(end - start)), header=None, names=columns)
+        x = data.iloc[:,0:-1].to_numpy()
+        y = data.iloc[:,-1].to_numpy()
+    stats.add(x, y)
+    return stats
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("USEAGE: python process.py <path-to-csvs-directory>")
-        print("NOTE: must be run with python3 because of the sklearn library")
+    if len(sys.argv) < 2:
+        print("USEAGE: python analyze.py <path-to-csvs-directory> [--format csv|npy] [--workers N] [--chart-only] [--opening MOVES] [--tree] [--buckets SCHEME]")
+        print("NOTE: must be run with python3")
     else:
         main(sys.argv[1:])
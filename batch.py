@@ -0,0 +1,164 @@
+import chess
+import numpy as np
+import itertools
+import process
+import openingboard
+
+# the board features of process.replay_features for many games at once.
+# the games are replayed a single time (on an openingboard.OpeningBoard) into arrays:
+#   bitboards    - N x 12 uint64, one bitboard per PIECE_PLANES entry for the board of every game at a ply
+#   from_squares - N x plies int8, the square each ply moved from (-1 past the end of a game)
+#   castles      - N x plies int8, for castling plies the rook square that counts as moved, otherwise -1
+# and the features are numpy operations over all N games at a time instead of python loops per game.
+# the results are the same as replay_features gives for each game.
+
+# the piece bitboards of a position, in the order of the bitboards arrays
+PIECE_PLANES = [(color, piece_type) for color in chess.COLORS for piece_type in chess.PIECE_TYPES]
+
+# popcount of every uint64 in an array (numpy >= 2.0 has it built in)
+if hasattr(np, "bitwise_count"):
+    popcount = np.bitwise_count
+else:
+    POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+    def popcount(a):
+        a = np.ascontiguousarray(a, dtype=np.uint64)
+        return POPCOUNT_TABLE[a.view(np.uint8)].reshape(a.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+# returns a board evaluation of process.py as (output, plane, weight, mask) terms, so that output
+# number output of evaluate(board) = sum(weight * popcount(bitboards[plane] & mask)) over its terms.
+# the evaluations count pieces on squares, so they add up over the pieces of a board and
+# the terms can be read off boards with a single piece on them.
+def get_terms(evaluate):
+    terms = []
+    for plane, (color, piece_type) in enumerate(PIECE_PLANES):
+        # (output, weight) -> mask of the squares where a piece of the plane adds weight to output
+        masks = {}
+        for square in chess.SQUARES:
+            board = chess.Board(None)
+            board.set_piece_at(square, chess.Piece(piece_type, color))
+            values = evaluate(board)
+            if not isinstance(values, tuple):
+                values = (values,)
+            for output, value in enumerate(values):
+                if value != 0:
+                    masks[output, value] = masks.get((output, value), 0) | chess.BB_SQUARES[square]
+        terms += [(output, plane, weight, mask) for (output, weight), mask in sorted(masks.items())]
+    return terms
+
+MATERIAL_TERMS = get_terms(process.evaluate_material_difference)
+CENTER_TERMS = get_terms(process.evaluate_num_center_squares_controlled)
+CENTER_TERMS_LEGACY = get_terms(process.evaluate_num_center_squares_controlled_legacy)
+
+# returns the bitboards of a board as a list of PIECE_PLANES ints
+def get_bitboards(board):
+    bitboards = []
+    for color in chess.COLORS:
+        mask = board.occupied_co[color]
+        bitboards += [board.pawns & mask, board.knights & mask, board.bishops & mask,\
+            board.rooks & mask, board.queens & mask, board.kings & mask]
+    return bitboards
+
+# evaluates terms (see get_terms) on N x 12 bitboards. returns an N x num_outputs int array
+def evaluate_terms(bitboards, terms:list, num_outputs:int):
+    values = np.zeros((len(bitboards), num_outputs), dtype=np.int64)
+    for output, plane, weight, mask in terms:
+        values[:, output] += weight * popcount(bitboards[:, plane] & np.uint64(mask)).astype(np.int64)
+    return values
+
+# returns the material difference of every board in N x 12 bitboards (see evaluate_material_difference)
+def evaluate_material_difference(bitboards):
+    return evaluate_terms(bitboards, MATERIAL_TERMS, 1)[:, 0]
+
+# returns the center squares white and black control on every board in N x 12 bitboards, as two arrays
+# (see evaluate_num_center_squares_controlled and evaluate_num_center_squares_controlled_legacy)
+def evaluate_num_center_squares_controlled(bitboards, legacy:bool=False):
+    if legacy:
+        values = evaluate_terms(bitboards, CENTER_TERMS_LEGACY, 2)
+    else:
+        values = evaluate_terms(bitboards, CENTER_TERMS, 2)
+    return values[:, 0], values[:, 1]
+
+# returns the number of unique pieces white and black moved in the first k moves of N games
+# as two arrays, from the from_squares and castles arrays of replay_games (see process.push_ply)
+def count_unique_pieces_moved(from_squares, castles, k:int):
+    rows = np.arange(len(from_squares))
+    moved = np.zeros((len(from_squares), 64), dtype=bool)
+    counts = [np.zeros(len(from_squares), dtype=np.int64), np.zeros(len(from_squares), dtype=np.int64)]
+    for ply in range(min(2 * k, from_squares.shape[1])):
+        squares = from_squares[:, ply].astype(np.int64)
+        played = squares >= 0
+        squares[~played] = 0
+        castled = castles[:, ply] >= 0
+        if ply % 2 == 0:
+            home = squares < 16 # the first two ranks
+            king = chess.E1
+        else:
+            home = squares >= 48 # the last two ranks
+            king = chess.E8
+        new = played & ~castled & home & ~moved[rows, squares]
+        counts[ply % 2] += new + 2 * castled
+        moved[rows[new], squares[new]] = True
+        moved[rows[castled], king] = True
+        moved[rows[castled], castles[castled, ply]] = True
+    return counts[0], counts[1]
+
+# replays N games (moves_ars, see get_moves_ar) once. returns the bitboards of every game
+# k_material and k_center moves in (or at its end), the from_squares and castles of the
+# first k_unique moves and which games could be replayed
+def replay_games(moves_ars:list, k_unique:int, k_material:int, k_center:int):
+    material_bitboards = []
+    center_bitboards = []
+    from_squares = np.full((len(moves_ars), 2 * k_unique), -1, dtype=np.int8)
+    castles = np.full((len(moves_ars), 2 * k_unique), -1, dtype=np.int8)
+    valid = np.ones(len(moves_ars), dtype=bool)
+    empty = [0] * len(PIECE_PLANES)
+    for i, moves_ar in enumerate(moves_ars):
+        plies = tuple(itertools.chain.from_iterable(moves_ar))[:2 * max(k_unique, k_material, k_center)]
+        # the same positions sim_board(moves_ar, k) would give
+        unique_ply = min(len(plies), 2 * k_unique)
+        material_ply = min(len(plies), 2 * k_material)
+        center_ply = min(len(plies), 2 * k_center)
+        end = max(unique_ply, material_ply, center_ply)
+        board = openingboard.OpeningBoard()
+        material = center = empty
+        try:
+            for ply in range(end + 1):
+                if ply == material_ply:
+                    material = get_bitboards(board)
+                if ply == center_ply:
+                    center = get_bitboards(board)
+                if ply == end:
+                    break
+                san = plies[ply]
+                move = board.push_san(san)
+                if ply < unique_ply:
+                    if san[0] == '0': # castling written with zeros, like process.push_ply
+                        san = san.replace('0', 'O')
+                    from_squares[i, ply] = move.from_square
+                    if san.startswith('O'):
+                        # black's rook is picked by white's move, like process.push_ply
+                        if ply % 2 == 0:
+                            castles[i, ply] = chess.H1 if san == "O-O" else chess.A1
+                        else:
+                            castles[i, ply] = chess.H8 if plies[ply - 1].replace('0', 'O') == "O-O" else chess.A8
+        except (ValueError, IndexError): # illegal or unreadable move
+            valid[i] = False
+            material = center = empty
+        material_bitboards.append(material)
+        center_bitboards.append(center)
+    return np.array(material_bitboards, dtype=np.uint64).reshape(-1, len(PIECE_PLANES)),\
+        np.array(center_bitboards, dtype=np.uint64).reshape(-1, len(PIECE_PLANES)),\
+        from_squares, castles, valid
+
+# process.replay_features for N games (moves_ars) at once.
+# returns material_difference, num_center_squares_controlled_w, num_center_squares_controlled_b,
+# num_unique_pieces_moved_w and num_unique_pieces_moved_b as arrays, with -1s for the games
+# replay_features returns None for
+def replay_features(moves_ars:list, k_unique:int, k_material:int, k_center:int, legacy:bool=False):
+    material_bitboards, center_bitboards, from_squares, castles, valid = replay_games(moves_ars, k_unique, k_material, k_center)
+    features = [evaluate_material_difference(material_bitboards)]
+    features += evaluate_num_center_squares_controlled(center_bitboards, legacy)
+    features += count_unique_pieces_moved(from_squares, castles, k_unique)
+    for feature in features:
+        feature[~valid] = -1
+    return tuple(features)
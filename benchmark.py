@@ -0,0 +1,351 @@
+import chess
+import pandas as pd
+import time
+import itertools
+import random
+import argparse
+import multiprocessing
+import resource
+import platform
+import subprocess
+import json
+import io
+import os
+import sys
+import preprocess
+import process
+import analyze
+import batch
+
+# benchmarks for the pieces of the pipeline.
+# every stage is timed on its own, in its own process, over the same deterministic synthetic games
+# (or the movetexts of a GAMES csv made by preprocess.py). the results (games/sec and peak RSS per
+# stage) are saved as json so runs on different commits can be compared with --compare.
+# the stage processes are forked, so their peak RSS starts at what the parent holds, and
+# rss_growth_mb is how much the stage itself added to it.
+
+# default number of synthetic games
+NUM_GAMES = 2000
+# how many times each stage is run. the fastest run counts
+REPEATS = 3
+# analyze.analyze is fast, so the feature rows are repeated up to this many rows for it
+ANALYZE_ROWS = 200000
+# the first moves of the synthetic games, so they share openings like real games do
+OPENINGS = [[], ["e4", "e5", "Nf3", "Nc6", "Bc4"], ["e4", "c5", "Nf3", "d6"], ["d4", "d5", "c4"],\
+    ["d4", "Nf6", "c4", "e6"], ["e4", "e6", "d4", "d5"], ["c4"], ["Nf3", "d5"]]
+
+# main program entry
+def main(args:list):
+    args = get_args(args)
+    pgn = generate_pgn(args.games, args.seed, args.clock_fraction)
+    if args.write_pgn:
+        with open(args.write_pgn, "w") as f:
+            f.write(pgn)
+        print("wrote",args.games,"synthetic games to",args.write_pgn)
+    if args.csv:
+        games = process.get_games(pd.read_csv(args.csv))
+        print("benchmarking with",len(games),"games from",args.csv)
+    else:
+        games = read_pgn_games(pgn)
+        print("benchmarking with",len(games),"synthetic games (seed",str(args.seed)+")")
+    results = {"commit": get_commit(), "python": platform.python_version(), "chess": chess.__version__,\
+        "games": len(games), "seed": args.seed, "csv": args.csv, "stages": {}}
+    for name, bench in STAGES:
+        count, seconds, peak_rss, rss_growth = run_stage(bench, pgn, games, args.repeat)
+        results["stages"][name] = {"games": count, "seconds": seconds, "games_per_sec": preprocess.get_rate(count, seconds),\
+            "peak_rss_mb": peak_rss / 1e6, "rss_growth_mb": rss_growth / 1e6}
+        report(name, count, "games", seconds, rss_growth)
+    with open(args.json, "w") as f:
+        json.dump(results, f, indent=1)
+    print("saved results to",args.json)
+    if args.compare:
+        compare(args.compare, results)
+    if args.tokenizers:
+        bench_tokenizers([moves for moves, result in games])
+
+# reads the commandline args
+def get_args(args:list):
+    parser = argparse.ArgumentParser(description="times every stage of the pipeline on synthetic games")
+    parser.add_argument("csv", nargs="?", help="GAMES csv to take the movetexts from instead of the synthetic games")
+    parser.add_argument("--games", type=int, default=NUM_GAMES, help="number of synthetic games")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic games")
+    parser.add_argument("--clock-fraction", type=float, default=0.0, help="fraction of synthetic games with {[%%clk]} comments")
+    parser.add_argument("--repeat", type=int, default=REPEATS, help="times each stage is run (the fastest counts)")
+    parser.add_argument("--json", default="benchmark.json", help="where to save the results")
+    parser.add_argument("--compare", help="results of an earlier run to compare against")
+    parser.add_argument("--write-pgn", help="also write the synthetic games to this pgn file")
+    parser.add_argument("--tokenizers", action="store_true", help="also compare get_moves_ar with iter_plies in tokens/sec")
+    return parser.parse_args(args)
+
+# returns num_games random (but always the same for a seed) games as pgn text in the lichess format.
+# moves are legal and castling is preferred when it's possible, so every extractor has work to do.
+# clock_fraction of the games get %clk comments like recent lichess dumps
+def generate_pgn(num_games:int, seed:int=0, clock_fraction:float=0.0):
+    rng = random.Random(seed)
+    games = []
+    for i in range(num_games):
+        board = chess.Board()
+        sans = []
+        for san in rng.choice(OPENINGS):
+            sans.append(san)
+            board.push_san(san)
+        num_plies = rng.randint(20, 120)
+        while len(sans) < num_plies and not board.is_game_over():
+            moves = list(board.legal_moves)
+            castles = [move for move in moves if board.is_castling(move)]
+            if castles and rng.random() < 0.7:
+                move = rng.choice(castles)
+            else:
+                move = rng.choice(moves)
+            sans.append(board.san(move))
+            board.push(move)
+        result = rng.choice(["1-0", "0-1", "1/2-1/2"])
+        white_elo = rng.choice([str(rng.randint(600, 2800)), "?"])
+        black_elo = str(rng.randint(600, 2800))
+        clock = rng.random() < clock_fraction
+        tokens = []
+        for ply, san in enumerate(sans):
+            if ply % 2 == 0:
+                tokens.append(str(ply // 2 + 1)+". "+san)
+            elif clock:
+                tokens.append(str(ply // 2 + 1)+"... "+san)
+            else:
+                tokens.append(san)
+            if clock:
+                tokens.append("{ [%clk 0:03:00] }")
+        games.append('[Event "Rated Blitz game"]\n[Site "https://lichess.org/'+str(i)+'"]\n[Result "'+result+'"]\n'\
+            +'[WhiteElo "'+white_elo+'"]\n[BlackElo "'+black_elo+'"]\n\n'+" ".join(tokens)+" "+result+"\n\n")
+    return "".join(games)
+
+# returns the (moves, result) pairs preprocess writes for pgn text
+def read_pgn_games(pgn:str):
+    out = [io.StringIO() for bracket in preprocess.BRACKETS]
+    preprocess.preprocess(io.StringIO(pgn), out)
+    games = []
+    for f in out:
+        for line in f.getvalue().splitlines():
+            moves, _, result = line.rpartition(",")
+            games.append((moves, int(result)))
+    return games
+
+# runs a stage in a new process, so its peak RSS is its own. returns the number of games,
+# the seconds the fastest run took, the peak RSS and how much of it the stage added, in bytes
+def run_stage(bench, pgn:str, games:list, repeat:int):
+    with multiprocessing.Pool(1) as pool:
+        return pool.apply(measure_stage, (bench, pgn, games, repeat))
+
+# worker side of run_stage
+def measure_stage(bench, pgn:str, games:list, repeat:int):
+    start_rss = get_peak_rss()
+    runs = [bench(pgn, games) for i in range(repeat)]
+    count = runs[0][0]
+    seconds = min(seconds for count, seconds in runs)
+    peak_rss = get_peak_rss()
+    return count, seconds, peak_rss, peak_rss - start_rss
+
+# returns the peak RSS of this process in bytes (ru_maxrss is in kB on linux, bytes on macOS)
+def get_peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        return peak
+    return peak * 1024
+
+# the stages below each return (games, seconds). setup isn't timed.
+
+# header parsing and bracketing in preprocess.preprocess
+def bench_preprocess(pgn:str, games:list):
+    out = [io.StringIO() for bracket in preprocess.BRACKETS]
+    lines = io.StringIO(pgn).readlines()
+    start = time.time()
+    preprocess.preprocess(lines, out)
+    return sum(f.getvalue().count("\n") for f in out), time.time() - start
+
+def bench_get_moves_ar(pgn:str, games:list):
+    movetexts = get_plain_movetexts(games)
+    start = time.time()
+    for moves in movetexts:
+        process.get_moves_ar(moves)
+    return len(movetexts), time.time() - start
+
+# the whole of process.extract_features, the way process.py runs it
+def bench_extract_features(pgn:str, games:list):
+    process.set_opening_cache(process.OPENING_CACHE_SIZE)
+    start = time.time()
+    for moves, result in games:
+        process.extract_features(moves, result)
+    return len(games), time.time() - start
+
+def bench_extract_num_unique_pieces_moved_w(pgn:str, games:list):
+    return time_extractor(games, lambda moves_ar: process.extract_num_unique_pieces_moved_w(moves_ar, process.UNIQUE_PIECES_MOVES))
+
+def bench_extract_num_unique_pieces_moved_b(pgn:str, games:list):
+    return time_extractor(games, lambda moves_ar: process.extract_num_unique_pieces_moved_b(moves_ar, process.UNIQUE_PIECES_MOVES))
+
+def bench_extract_material_difference(pgn:str, games:list):
+    return time_extractor(games, lambda moves_ar: process.extract_material_difference(moves_ar, process.MATERIAL_MOVES))
+
+def bench_extract_num_center_squares_controlled(pgn:str, games:list):
+    return time_extractor(games, lambda moves_ar: process.extract_num_center_squares_controlled(moves_ar, process.CENTER_MOVES))
+
+def bench_extract_when_castled_w(pgn:str, games:list):
+    return time_extractor(games, process.extract_when_castled_w)
+
+def bench_extract_when_castled_b(pgn:str, games:list):
+    return time_extractor(games, process.extract_when_castled_b)
+
+# the one pass version, from the movetext
+def bench_extract_when_castled(pgn:str, games:list):
+    movetexts = [moves for moves, result in games]
+    start = time.time()
+    for moves in movetexts:
+        process.extract_when_castled(process.iter_plies(moves))
+    return len(movetexts), time.time() - start
+
+def bench_sim_board(pgn:str, games:list):
+    return time_extractor(games, lambda moves_ar: process.sim_board(moves_ar, process.MATERIAL_MOVES))
+
+# process.replay_features one game at a time, without the opening cache
+def bench_replay_features(pgn:str, games:list):
+    moves_ars = get_openings(games)
+    process.set_opening_cache(0)
+    start = time.time()
+    for moves_ar in moves_ars:
+        process.replay_features(moves_ar, process.UNIQUE_PIECES_MOVES, process.MATERIAL_MOVES, process.CENTER_MOVES)
+    return len(moves_ars), time.time() - start
+
+# batch.replay_features over every game at once
+def bench_replay_features_batch(pgn:str, games:list):
+    moves_ars = get_openings(games)
+    start = time.time()
+    batch.replay_features(moves_ars, process.UNIQUE_PIECES_MOVES, process.MATERIAL_MOVES, process.CENTER_MOVES)
+    return len(moves_ars), time.time() - start
+
+# the evaluation part of replay_features (material and center on replayed boards), one board at a time
+def bench_evaluate(pgn:str, games:list):
+    moves_ars = get_openings(games)
+    boards = [(process.sim_board(moves_ar, process.MATERIAL_MOVES), process.sim_board(moves_ar, process.CENTER_MOVES))\
+        for moves_ar in moves_ars]
+    start = time.time()
+    for material_board, center_board in boards:
+        process.evaluate_material_difference(material_board)
+        process.evaluate_num_center_squares_controlled(center_board)
+    return len(boards), time.time() - start
+
+# the evaluation part of batch.replay_features (material, center and unique pieces) on the replayed arrays
+def bench_evaluate_batch(pgn:str, games:list):
+    material_bitboards, center_bitboards, from_squares, castles, valid = batch.replay_games(get_openings(games),\
+        process.UNIQUE_PIECES_MOVES, process.MATERIAL_MOVES, process.CENTER_MOVES)
+    start = time.time()
+    batch.evaluate_material_difference(material_bitboards)
+    batch.evaluate_num_center_squares_controlled(center_bitboards)
+    batch.count_unique_pieces_moved(from_squares, castles, process.UNIQUE_PIECES_MOVES)
+    return len(valid), time.time() - start
+
+# analyze.analyze over the features of the games, repeated up to ANALYZE_ROWS rows
+def bench_analyze(pgn:str, games:list):
+    out = io.StringIO()
+    out.write("when_castled,num_center_squares_controlled,material_difference,num_unique_pieces_moved,win\n")
+    process.process_games(games, out)
+    data = pd.read_csv(io.StringIO(out.getvalue()))
+    data = pd.concat([data] * max(1, ANALYZE_ROWS // max(1, len(data))), ignore_index=True)
+    start = time.time()
+    analyze.analyze("2000+FEATURES.csv", data)
+    return len(data), time.time() - start
+
+# times extract on the moves_ar of every game get_moves_ar can read
+def time_extractor(games:list, extract):
+    moves_ars = [process.get_moves_ar(moves) for moves in get_plain_movetexts(games)]
+    moves_ars = [moves_ar for moves_ar in moves_ars if moves_ar[0] != "bad game"]
+    start = time.time()
+    for moves_ar in moves_ars:
+        extract(moves_ar)
+    return len(moves_ars), time.time() - start
+
+# returns the opening of every game as a moves_ar, the way extract_features reads it
+def get_openings(games:list):
+    k = 2 * max(process.UNIQUE_PIECES_MOVES, process.MATERIAL_MOVES, process.CENTER_MOVES)
+    return [process.get_turns(list(itertools.islice(process.iter_plies(moves), k))) for moves, result in games]
+
+# returns the movetexts get_moves_ar can read (no comments), like the --legacy pipeline
+def get_plain_movetexts(games:list):
+    return [moves for moves, result in games if '%' not in moves]
+
+# every stage, in pipeline order
+STAGES = [("preprocess", bench_preprocess), ("get_moves_ar", bench_get_moves_ar),\
+    ("extract_features", bench_extract_features),\
+    ("extract_num_unique_pieces_moved_w", bench_extract_num_unique_pieces_moved_w),\
+    ("extract_num_unique_pieces_moved_b", bench_extract_num_unique_pieces_moved_b),\
+    ("extract_material_difference", bench_extract_material_difference),\
+    ("extract_num_center_squares_controlled", bench_extract_num_center_squares_controlled),\
+    ("extract_when_castled_w", bench_extract_when_castled_w), ("extract_when_castled_b", bench_extract_when_castled_b),\
+    ("extract_when_castled", bench_extract_when_castled), ("sim_board", bench_sim_board),\
+    ("replay_features", bench_replay_features), ("replay_features_batch", bench_replay_features_batch),\
+    ("evaluate", bench_evaluate), ("evaluate_batch", bench_evaluate_batch), ("analyze", bench_analyze)]
+
+# returns the current git commit, or None outside of a checkout
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),\
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# prints the speedup of every stage over an earlier results file
+def compare(path:str, results:dict):
+    with open(path, "r") as f:
+        old = json.load(f)
+    print("compared to",path,"(commit",str(old.get("commit"))+"):")
+    for name, stage in results["stages"].items():
+        if name not in old["stages"] or old["stages"][name]["games_per_sec"] == 0:
+            continue
+        speedup = stage["games_per_sec"] / old["stages"][name]["games_per_sec"]
+        print("\t",name+":",str(round(speedup, 2))+"x games/sec,",round(stage["rss_growth_mb"] - old["stages"][name]["rss_growth_mb"], 1),"MB RSS growth")
+
+# times the original get_moves_ar splitter against iter_plies on the games get_moves_ar can
+# read (no comments), then iter_plies on the rest. prints tokens (plies) per second for whole
+# games, and games per second when only the opening plies extract_features needs are read.
+def bench_tokenizers(movetexts:list):
+    plain = [moves for moves in movetexts if '%' not in moves]
+    annotated = [moves for moves in movetexts if '%' in moves]
+    k = 2 * max(process.UNIQUE_PIECES_MOVES, process.MATERIAL_MOVES, process.CENTER_MOVES)
+
+    start = time.time()
+    tokens = 0
+    for moves in plain:
+        moves_ar = process.get_moves_ar(moves)
+        if moves_ar[0] != "bad game":
+            for turn in moves_ar:
+                tokens += len(turn)
+    report("get_moves_ar", tokens, "tokens", time.time() - start)
+    bench_iter_plies("iter_plies", plain)
+    bench_iter_plies("iter_plies (with comments)", annotated)
+
+    start = time.time()
+    for moves in plain:
+        process.get_moves_ar(moves)
+    report("get_moves_ar (opening)", len(plain), "games", time.time() - start)
+
+    start = time.time()
+    for moves in plain:
+        process.get_turns(list(itertools.islice(process.iter_plies(moves), k)))
+    report("iter_plies (first "+str(k)+" plies)", len(plain), "games", time.time() - start)
+
+# times iter_plies over whole games
+def bench_iter_plies(name:str, movetexts:list):
+    start = time.time()
+    tokens = 0
+    for moves in movetexts:
+        for san in process.iter_plies(moves):
+            tokens += 1
+    report(name, tokens, "tokens", time.time() - start)
+
+# prints how many things were done per second (and how much memory it took, if it's known)
+def report(name:str, count:int, unit:str, seconds:float, rss_growth:int=None):
+    if rss_growth is None:
+        print("\t",name+":",count,unit,"in",seconds,"seconds,",preprocess.get_rate(count, seconds),unit+"/sec")
+    else:
+        print("\t",name+":",count,unit,"in",seconds,"seconds,",preprocess.get_rate(count, seconds),unit+"/sec,",\
+            "RSS grew",rss_growth / 1e6,"MB")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,208 @@
+import bisect
+import collections
+import json
+import os
+
+# the buckets preprocess.py sorts games into, and the files they're written to.
+# a bucket scheme is a spec like:
+#   brackets            - the four rating brackets 0-999, 1000-1499, 1500-1999 and 2000+
+#   elo:100             - 100 elo wide buckets from 0-99 up to MAX_ELO+
+#   bounds:1200/1600    - buckets split at any elos (here 0-1199, 1200-1599 and 1600+)
+# optionally followed by ",tc" to split every rating bucket by time control too (blitz-1500-1599, ...).
+# games are routed with a bisect on the elo bounds, so the number of buckets doesn't slow routing down.
+# prepreprocess records the scheme in BUCKETS_FILE next to the GAMES files, and process.py and
+# analyze.py read the buckets from there instead of picking them out of file names.
+
+# the scheme prepreprocess uses by default
+DEFAULT_SCHEME = "brackets"
+# where the elos of the "brackets" scheme are split
+BRACKET_BOUNDS = [1000, 1500, 2000]
+# the last bound of "elo:WIDTH" schemes, everything above it goes in one bucket
+MAX_ELO = 3000
+# time control classes, split by estimated game length (base seconds + 40 * increment) like lichess does.
+# "-" is correspondence and a missing or unreadable time control is unknown
+TIME_CONTROLS = ["ultrabullet", "bullet", "blitz", "rapid", "classical", "correspondence", "unknown"]
+TIME_CONTROL_SECONDS = [30, 180, 480, 1500]
+
+# the file the bucket scheme of a directory is recorded in
+BUCKETS_FILE = "buckets.json"
+# how many characters of games a BucketFile holds before writing them
+BUFFER_CHARS = 64 * 1024
+# how many bucket files a FilePool keeps open at once
+MAX_OPEN_FILES = 64
+
+class BucketScheme:
+    def __init__(self, spec:str=DEFAULT_SCHEME):
+        self.spec = spec
+        rating, *rest = spec.split(",")
+        if rating == "brackets":
+            self.bounds = list(BRACKET_BOUNDS)
+        elif rating.startswith("elo:") and rating[4:].isdigit() and int(rating[4:]) > 0:
+            self.bounds = list(range(int(rating[4:]), MAX_ELO + 1, int(rating[4:])))
+        elif rating.startswith("bounds:"):
+            self.bounds = sorted({int(bound) for bound in rating[7:].split("/")})
+        else:
+            raise ValueError("unknown bucket scheme "+spec)
+        if rest not in ([], ["tc"]):
+            raise ValueError("unknown bucket scheme "+spec)
+        self.time_controls = rest == ["tc"]
+        lows = [0] + self.bounds
+        highs = [bound - 1 for bound in self.bounds] + [None]
+        # [(name, min elo, max elo or None, time control or None)] in bucket order
+        self.buckets = [(get_rating_name(low, high), low, high, None) for low, high in zip(lows, highs)]
+        if self.time_controls:
+            self.buckets = [(time_control+"-"+name, low, high, time_control)\
+                for time_control in TIME_CONTROLS for name, low, high, _ in self.buckets]
+        self.names = [bucket[0] for bucket in self.buckets]
+        # time control string -> its index in TIME_CONTROLS, there are only a few different ones
+        self.time_control_indexes = {}
+
+    # returns the number of the bucket a game goes in
+    def get_bucket(self, avg_elo, time_control:str="?"):
+        bucket = bisect.bisect_right(self.bounds, avg_elo)
+        if self.time_controls:
+            index = self.time_control_indexes.get(time_control)
+            if index is None:
+                index = self.time_control_indexes[time_control] = get_time_control_index(time_control)
+            bucket += index * (len(self.bounds) + 1)
+        return bucket
+
+# returns the name of the bucket of elos low to high (None for no upper bound)
+def get_rating_name(low:int, high:int):
+    if high is None:
+        return str(low)+"+"
+    return str(low)+"-"+str(high)
+
+# returns the index in TIME_CONTROLS of a pgn TimeControl ("180+2", "-", ...)
+def get_time_control_index(time_control:str):
+    if time_control == "-":
+        return TIME_CONTROLS.index("correspondence")
+    base, _, increment = time_control.partition("+")
+    try:
+        seconds = int(base) + 40 * int(increment or 0)
+    except ValueError:
+        return TIME_CONTROLS.index("unknown")
+    return bisect.bisect_right(TIME_CONTROL_SECONDS, seconds)
+
+# returns the number of the bucket of scheme that every bucket of other (a finer scheme, like elo:100 for
+# brackets) falls in. raises ValueError if a bucket of other is split between buckets of scheme
+def get_groups(scheme:BucketScheme, other:BucketScheme):
+    if scheme.time_controls and not other.time_controls:
+        raise ValueError("the buckets of "+other.spec+" aren't split by time control like "+scheme.spec)
+    groups = []
+    for name, low, high, time_control in other.buckets:
+        bucket = bisect.bisect_right(scheme.bounds, low)
+        last = len(scheme.bounds) if high is None else bisect.bisect_right(scheme.bounds, high)
+        if last != bucket:
+            raise ValueError("the bucket "+name+" of "+other.spec+" is split between buckets of "+scheme.spec)
+        if scheme.time_controls:
+            bucket += TIME_CONTROLS.index(time_control) * (len(scheme.bounds) + 1)
+        groups.append(bucket)
+    return groups
+
+# records the bucket scheme of the GAMES files in path (replaced in one step, like checkpoint.Manifest)
+# and the generation of the checkpoint.Manifest they're written with. the generation changes whenever
+# they're written again from the start, so what was made from them before can be started over too
+def save(path:str, scheme:BucketScheme, generation:str=None):
+    buckets = [{"name": name, "min_elo": low, "max_elo": high, "time_control": time_control}\
+        for name, low, high, time_control in scheme.buckets]
+    manifest_path = os.path.join(path, BUCKETS_FILE)
+    with open(manifest_path+".tmp", "w") as f:
+        json.dump({"scheme": scheme.spec, "generation": generation, "buckets": buckets}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(manifest_path+".tmp", manifest_path)
+
+# returns the bucket scheme recorded in path. directories preprocessed before schemes were
+# recorded have the default one
+def load(path:str):
+    manifest_path = os.path.join(path, BUCKETS_FILE)
+    if not os.path.exists(manifest_path):
+        return BucketScheme()
+    with open(manifest_path, "r") as f:
+        return BucketScheme(json.load(f)["scheme"])
+
+# returns the generation of the GAMES files in path (see save), None if it wasn't recorded
+def load_generation(path:str):
+    manifest_path = os.path.join(path, BUCKETS_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f).get("generation")
+
+# returns the path of the kind ("GAMES" or "FEATURES") file of a bucket
+def get_path(path:str, name:str, kind:str, file_format:str="csv"):
+    return os.path.join(path, name+kind+"."+file_format)
+
+# returns (bucket name, path) pairs for the kind files in path, in bucket order.
+# buckets that never got a file are left out
+def get_files(path:str, kind:str, file_format:str="csv"):
+    files = []
+    for name in load(path).names:
+        file_path = get_path(path, name, kind, file_format)
+        if os.path.exists(file_path):
+            files.append((name, file_path))
+    return files
+
+# keeps at most max_open files open, closing the least recently used one to open another.
+# opener(path) opens a file (anything with write and close)
+class FilePool:
+    def __init__(self, opener, max_open:int=MAX_OPEN_FILES):
+        self.opener = opener
+        self.max_open = max_open
+        self.files = collections.OrderedDict()
+
+    # returns the open file at path, opening it if it isn't
+    def get(self, path:str):
+        f = self.files.get(path)
+        if f is None:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            f = self.files[path] = self.opener(path)
+        else:
+            self.files.move_to_end(path)
+        return f
+
+    def close(self, path:str):
+        f = self.files.pop(path, None)
+        if f is not None:
+            f.close()
+
+# the output of one bucket. stands in for its file object: games are buffered and written
+# BUFFER_CHARS at a time through a FilePool, so any number of buckets can be written to
+# with few writes and a bounded number of open files. the file is only created once it's written to
+class BucketFile:
+    def __init__(self, path:str, files:FilePool):
+        self.path = path
+        self.files = files
+        self.buffer = []
+        self.size = 0
+        # whether anything was written to the bucket yet, buffered or not (see checkpoint.Manifest.commit)
+        self.written = False
+
+    def write(self, text:str):
+        self.written = True
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= BUFFER_CHARS:
+            self.flush(whole_lines=True)
+
+    # writes the buffer. whole_lines keeps an unfinished last line for later, so the file
+    # (which may be closed before the next write) only ever gets whole games
+    def flush(self, whole_lines:bool=False):
+        if not self.buffer:
+            return
+        text = "".join(self.buffer)
+        cut = text.rfind("\n") + 1 if whole_lines else len(text)
+        self.buffer = [text[cut:]] if cut < len(text) else []
+        self.size = len(text) - cut
+        if cut > 0:
+            self.files.get(self.path).write(text[:cut])
+
+    # returns the open file of the bucket (see checkpoint.get_output_size)
+    def get_file(self):
+        return self.files.get(self.path)
+
+    def close(self):
+        self.flush()
+        self.files.close(self.path)
@@ -0,0 +1,145 @@
+import json
+import os
+import time
+import uuid
+import columnar
+import buckets
+import writer
+
+# manifests that let preprocess.py and process.py pick up where they left off.
+# a manifest is a json file in the data directory:
+#   {"settings": {...}, "generation": id, "inputs": {name: {"size", "mtime", "offset", "done"}}, "outputs": {name: committed size}}
+# names are relative to the directory. offset is how far into an input its games have been written out
+# (decompressed bytes of a pgn file, rows of a GAMES file) and the committed size of an output is how
+# much of it belongs to those games (bytes of a csv, rows of a .npy). anything an output holds past its
+# committed size was written after the last checkpoint and is cut off before the outputs are reopened.
+# the generation is a new id every time a manifest starts over, so the outputs of one generation can be
+# told from the ones written after they were started over (see buckets.save)
+
+# how often (at most) a checkpoint is written while an input is being read
+CHECKPOINT_SECONDS = 30
+
+class Manifest:
+    def __init__(self, path:str, settings:dict, restart:bool=False):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.settings = settings
+        self.inputs = {}
+        self.outputs = {}
+        self.generation = uuid.uuid4().hex
+        self.last_save = time.time()
+        if not os.path.exists(path):
+            return
+        if not restart:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+            # outputs made with other settings can't be added to
+            if manifest.get("settings") == settings:
+                self.inputs = manifest["inputs"]
+                self.outputs = manifest["outputs"]
+                # None for manifests written before it was kept
+                self.generation = manifest.get("generation")
+                return
+            print("settings changed since",path,"was written, starting over")
+        # saved right away, so a run stopped before its first checkpoint doesn't leave the old
+        # manifest behind with the outputs it kept track of cut off
+        self.save()
+
+    # returns the name a file is kept under
+    def get_name(self, path:str):
+        return os.path.relpath(os.path.abspath(path), self.directory)
+
+    # returns what has to be done with an input:
+    #   "done"    - read completely and not changed since
+    #   "resume"  - partly read, or only added to since (dumps and GAMES files only ever grow),
+    #               so reading can start at get_offset
+    #   "changed" - smaller since it was read, the games already written from it are stale
+    #   "new"     - never read
+    # an input of the same size is taken to be the one that was read, whatever its mtime: inputs are only
+    # ever added to, so its offset still points past the same games, and a GAMES file can have its mtime
+    # touched by a preprocess.py run that reopened it without adding a game
+    def get_status(self, path:str):
+        entry = self.inputs.get(self.get_name(path))
+        if entry is None:
+            return "new"
+        stat = os.stat(path)
+        if stat.st_size < entry["size"]:
+            return "changed"
+        if entry["done"] and stat.st_size == entry["size"]:
+            return "done"
+        return "resume"
+
+    # returns where reading an input should start
+    def get_offset(self, path:str):
+        entry = self.inputs.get(self.get_name(path))
+        if entry is None:
+            return 0
+        return entry["offset"]
+
+    # forgets an input and the outputs written from it, so they're written from the start again
+    def forget(self, path:str, out_paths:list=[]):
+        self.inputs.pop(self.get_name(path), None)
+        for out_path in out_paths:
+            self.outputs.pop(self.get_name(out_path), None)
+
+    # cuts every output back to its committed size (nothing, if it isn't in the manifest yet).
+    # has to be done before the outputs are opened
+    def restore_outputs(self, paths:list):
+        for path in paths:
+            name = self.get_name(path)
+            if name not in self.outputs and os.path.exists(path) and os.path.getsize(path) > 0:
+                print(path,"isn't kept track of in",self.path+", writing it again from the start")
+            truncate_output(path, self.outputs.get(name, 0))
+
+    # records that the games of an input up to offset are in the outputs, and saves the manifest.
+    # outs are the open outputs (file objects or columnar writers) at paths. buckets.BucketFiles that
+    # weren't written to keep the size they were committed with, their files aren't even opened
+    def commit(self, path:str, offset:int, outs:list, paths:list, done:bool=False):
+        for out, out_path in zip(outs, paths):
+            if isinstance(out, buckets.BucketFile) and not out.written:
+                continue
+            self.outputs[self.get_name(out_path)] = get_output_size(out)
+        stat = os.stat(path)
+        self.inputs[self.get_name(path)] = {"size": stat.st_size, "mtime": stat.st_mtime, "offset": offset, "done": done}
+        self.save()
+
+    # returns whether CHECKPOINT_SECONDS have passed since the manifest was last saved
+    def is_due(self):
+        return time.time() - self.last_save >= CHECKPOINT_SECONDS
+
+    # writes the manifest. it's replaced in one step, so a crash leaves the old or the new one
+    def save(self):
+        temp = self.path+".tmp"
+        with open(temp, "w") as f:
+            json.dump({"settings": self.settings, "generation": self.generation, "inputs": self.inputs, "outputs": self.outputs}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.path)
+        self.last_save = time.time()
+
+# writes out everything buffered for an output and returns its size (bytes of a csv, rows of a .npy)
+def get_output_size(out):
+    if isinstance(out, buckets.BucketFile):
+        out.flush()
+        out = out.get_file()
+    if isinstance(out, writer.BackgroundWriter):
+        out.flush() # waits for its buffers to be written
+        out = out.out
+    if isinstance(out, (columnar.NpyWriter, columnar.GamesWriter)):
+        return out.checkpoint()
+    out.flush()
+    os.fsync(out.fileno())
+    return out.tell()
+
+# cuts an output back to size (bytes of a csv, rows of a .npy). missing files are left missing
+# (and empty ones empty, a .npy that was created but never written to doesn't even have a header)
+def truncate_output(path:str, size:int):
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    if path.endswith(".npy"):
+        if os.path.exists(columnar.get_moves_path(path)):
+            columnar.truncate_games(path, size)
+        else:
+            columnar.truncate_npy(path, size)
+    elif os.path.getsize(path) > size:
+        os.truncate(path, size)
@@ -0,0 +1,217 @@
+import numpy as np
+import os
+
+# binary, columnar versions of the GAMES and FEATURES files (--format npy).
+# every table is a .npy file of a structured array, so it loads with np.load (or memory maps)
+# without any parsing. rows are appended as they come and the shape in the header is filled
+# in when the file is closed (or checkpointed), so the files can be written as a stream like the csvs.
+# rows past the shape in the header weren't checkpointed yet and are dropped when the file is reopened.
+
+# returns the dtype of a FEATURES file with the given columns (see process.get_feature_columns)
+def get_features_dtype(columns:list):
+    return np.dtype([(column, np.int16 if column == "when_castled" else np.int8) for column in columns])
+
+# returns the column names of a FEATURES (or GAMES) csv or .npy file
+def get_columns(path:str):
+    if path.endswith(".npy"):
+        with open(path, "rb") as f:
+            length, dtype, header_bytes = read_header(f)
+        return list(dtype.names)
+    with open(path, "r") as f:
+        return f.readline().strip().split(",")
+# one row of a GAMES file: where the game's moves are in the .moves file next to it, and the result
+GAMES_DTYPE = np.dtype([("offset", np.int64), ("length", np.int32), ("result", np.int8)])
+
+# how many rows an NpyWriter buffers before writing them
+BUFFER_ROWS = 65536
+
+# appends rows to a .npy file of a structured dtype. an existing file is added to, like open(path, "a").
+# rows can be appended one at a time (as tuples) or written as arrays of dtype.
+class NpyWriter:
+    def __init__(self, path:str, dtype):
+        self.dtype = np.dtype(dtype)
+        self.rows = []
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.file = open(path, "r+b")
+            length, file_dtype, self.header_bytes = read_header(self.file)
+            if file_dtype != self.dtype:
+                raise ValueError(path+" holds "+str(file_dtype)+", not "+str(self.dtype))
+            self.length = length
+            # rows past the header are cut off, a file that has none is left as it is (mtime and all)
+            if os.path.getsize(path) > self.header_bytes + length * self.dtype.itemsize:
+                self.file.truncate(self.header_bytes + length * self.dtype.itemsize)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(path, "wb")
+            self.length = 0
+            # room for the header of any length, so it can be rewritten in place on close
+            self.header_bytes = get_header_bytes(self.dtype, 2**62)
+            write_header(self.file, self.dtype, 0, self.header_bytes)
+        # the number of rows in the header, it's only rewritten once there are more
+        self.header_length = self.length
+
+    # adds one row (a tuple in the order of dtype's fields)
+    def append(self, row:tuple):
+        self.rows.append(row)
+        if len(self.rows) >= BUFFER_ROWS:
+            self.flush()
+
+    # writes an array of rows
+    def write(self, rows):
+        self.flush()
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        self.file.write(rows.tobytes())
+        self.length += len(rows)
+
+    # writes the rows appended so far
+    def flush(self):
+        if self.rows:
+            rows = np.array(self.rows, dtype=self.dtype)
+            self.rows = []
+            self.write(rows)
+
+    # writes everything and puts the number of rows in the header, so the file is complete
+    # up to here even if it's never closed. returns the number of rows
+    def checkpoint(self):
+        self.flush()
+        self.update_header()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.length
+
+    # writes everything and puts the final number of rows in the header
+    def close(self):
+        self.flush()
+        self.update_header()
+        self.file.close()
+
+    # puts the number of rows in the header if it changed
+    def update_header(self):
+        if self.length == self.header_length:
+            return
+        self.file.seek(0)
+        write_header(self.file, self.dtype, self.length, self.header_bytes)
+        self.file.seek(0, os.SEEK_END)
+        self.header_length = self.length
+
+# writes GAMES files: an index of GAMES_DTYPE rows in path and the moves of every game in the
+# .moves file next to it. takes the same "moves,result" csv text store_game writes to a csv
+# (in pieces of any size), so it can stand in for the csv file object.
+class GamesWriter:
+    def __init__(self, path:str):
+        # moves past the last game in the index weren't checkpointed
+        self.offset = get_moves_end(path) if os.path.exists(path) and os.path.getsize(path) > 0 else 0
+        self.index = NpyWriter(path, GAMES_DTYPE)
+        self.moves = open(get_moves_path(path), "ab")
+        if self.moves.tell() > self.offset:
+            self.moves.truncate(self.offset)
+        self.leftover = ""
+
+    # takes csv text. lines that aren't finished yet are kept for the next write
+    def write(self, text:str):
+        lines = (self.leftover + text).split("\n")
+        self.leftover = lines.pop()
+        for line in lines:
+            moves, _, result = line.rpartition(",")
+            if moves == "moves" and result == "result": # the csv header
+                continue
+            data = moves.encode() + b"\n"
+            self.moves.write(data)
+            self.index.append((self.offset, len(data) - 1, int(result)))
+            self.offset += len(data)
+
+    # writes everything, moves first so the index never points past them. returns the number of games
+    def checkpoint(self):
+        self.moves.flush()
+        os.fsync(self.moves.fileno())
+        return self.index.checkpoint()
+
+    def close(self):
+        self.moves.close()
+        self.index.close()
+
+# returns where the moves of the last game in a GAMES .npy file end in its .moves file
+def get_moves_end(path:str):
+    index = load_npy(path)
+    if len(index) == 0:
+        return 0
+    return int(index[-1]["offset"]) + int(index[-1]["length"]) + 1
+
+# cuts a .npy file back to its first length rows (if it has more)
+def truncate_npy(path:str, length:int):
+    with open(path, "r+b") as f:
+        file_length, dtype, header_bytes = read_header(f)
+        if file_length <= length:
+            return
+        f.seek(0)
+        write_header(f, dtype, length, header_bytes)
+        f.truncate(header_bytes + length * dtype.itemsize)
+
+# cuts a GAMES .npy file and its .moves file back to their first length games
+def truncate_games(path:str, length:int):
+    truncate_npy(path, length)
+    moves_path = get_moves_path(path)
+    end = get_moves_end(path)
+    if os.path.getsize(moves_path) > end:
+        os.truncate(moves_path, end)
+
+# returns the path of the .moves file of a GAMES .npy file
+def get_moves_path(path:str):
+    return os.path.splitext(path)[0]+".moves"
+
+# returns how many bytes the header of a .npy file of length rows of dtype takes
+# (padded to 64 bytes like numpy does)
+def get_header_bytes(dtype, length:int):
+    return (10 + len(get_header_text(dtype, length)) + 1 + 63) // 64 * 64
+
+# returns the dict part of a .npy header
+def get_header_text(dtype, length:int):
+    return repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (length,)})
+
+# writes a version 1.0 .npy header of exactly header_bytes bytes at the current position of f
+def write_header(f, dtype, length:int, header_bytes:int):
+    text = get_header_text(dtype, length)
+    text = text + " " * (header_bytes - 10 - len(text) - 1) + "\n"
+    f.write(np.lib.format.MAGIC_PREFIX + bytes([1, 0]) + (header_bytes - 10).to_bytes(2, "little") + text.encode("latin1"))
+
+# reads the header of a .npy file of rows
+# returns the number of rows, their dtype and the size of the header in bytes
+def read_header(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape[0], dtype, f.tell()
+
+# yields the rows of a .npy file from row start on, chunk_size at a time.
+# the file is memory mapped, not loaded
+def read_npy(path:str, chunk_size:int, start:int=0):
+    with open(path, "rb") as f:
+        length, dtype, header_bytes = read_header(f)
+    if length <= start:
+        return
+    rows = np.memmap(path, dtype=dtype, mode="r", offset=header_bytes, shape=(length,))
+    for start in range(start, length, chunk_size):
+        yield rows[start:start+chunk_size]
+
+# returns every row of a .npy file (memory mapped)
+def load_npy(path:str):
+    with open(path, "rb") as f:
+        length, dtype, header_bytes = read_header(f)
+    if length == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", offset=header_bytes, shape=(length,))
+
+# yields the games of a GAMES .npy file (and its .moves file) from game start on, chunk_size at a time
+# as lists of (moves, result) pairs, like process.read_games does for csvs
+def read_games(path:str, chunk_size:int, start:int=0):
+    with open(get_moves_path(path), "rb") as moves:
+        for index in read_npy(path, chunk_size, start):
+            offsets = index["offset"].tolist()
+            lengths = index["length"].tolist()
+            start = offsets[0]
+            moves.seek(start)
+            data = moves.read(offsets[-1] + lengths[-1] - start)
+            yield [(data[offset - start:offset - start + length].decode(), result)\
+                for offset, length, result in zip(offsets, lengths, index["result"].tolist())]
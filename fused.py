@@ -0,0 +1,237 @@
+import time
+import os
+import sys
+import argparse
+import collections
+import functools
+import columnar
+import checkpoint
+import buckets
+import writer
+import preprocess
+import process
+
+# preprocess.py and process.py in one pass: the pgn files in a directory are read once and every
+# game goes straight from its pgn lines to the FEATURES file of its bucket, without the round trip
+# through the GAMES files (writing every movetext out and reading it back with pandas, only for its
+# first few moves). the games are read with preprocess.iter_games, routed with the bucket scheme and
+# held in memory a chunk per bucket at a time until process.process_chunk extracts their features,
+# here or in a pool of worker processes. skipped games go to the QUARANTINE csvs like process.py's.
+# the GAMES files are only written too if they're asked for (--games), store.py needs them.
+
+# where fuse keeps track of how far it got, see checkpoint.py
+MANIFEST = ".fused-manifest.json"
+
+def main(args:list):
+    start = time.time()
+    args = get_args(args)
+    writer.set_buffering(args.write_buffer, args.fsync)
+    horizons = {"unique": args.unique_moves, "material": args.material_moves, "center": args.center_moves}
+    fuse(str(args.path), args.workers, args.chunk_size, args.format, args.restart, args.buckets, args.games,\
+        args.legacy, args.cache_size, horizons)
+    print("Done. Took",time.time()-start,"seconds.")
+
+# reads the commandline args
+def get_args(args:list):
+    parser = argparse.ArgumentParser(description="extracts features from the pgn files in a directory straight into FEATURES files")
+    parser.add_argument("path", help="path to the databases directory")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to extract features with")
+    parser.add_argument("--chunk-size", type=int, default=process.CHUNK_SIZE, help="number of games of a bucket to extract features from at a time")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv", help="format of the FEATURES (and GAMES) files to write")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoints of earlier runs and start over")
+    parser.add_argument("--buckets", type=buckets.BucketScheme, default=buckets.DEFAULT_SCHEME,\
+        help="how to split the games into buckets: brackets, elo:WIDTH or bounds:ELO/ELO/.., with ,tc to split by time control too")
+    parser.add_argument("--games", action="store_true", help="write the GAMES files too, like preprocess.py")
+    parser.add_argument("--legacy", action="store_true", help="extract the features like process.py --legacy")
+    parser.add_argument("--cache-size", type=int, default=process.OPENING_CACHE_SIZE, help="number of opening positions each process caches (0 turns the cache off)")
+    parser.add_argument("--unique-moves", type=process.parse_horizons, default=process.HORIZONS["unique"], help="comma separated moves to count unique pieces moved at")
+    parser.add_argument("--material-moves", type=process.parse_horizons, default=process.HORIZONS["material"], help="comma separated moves to take the material difference at")
+    parser.add_argument("--center-moves", type=process.parse_horizons, default=process.HORIZONS["center"], help="comma separated moves to count center control at")
+    parser.add_argument("--write-buffer", type=int, default=writer.WRITE_BUFFER, help="bytes every FEATURES (and GAMES) file buffers before a background thread writes them (0 writes them right away)")
+    parser.add_argument("--fsync", action="store_true", help="sync every buffer to disk once it's written, not only at checkpoints")
+    return parser.parse_args(args)
+
+# extracts the features of every game in the pgn files in path into a FEATURES file per bucket of scheme,
+# the same files preprocess.prepreprocess and process.iterate_csvs would make with these settings.
+# workers > 1 extracts the features in that many processes. games writes the GAMES files as well.
+# progress is checkpointed in a manifest in path like prepreprocess does, restart ignores it.
+def fuse(path:str, workers:int=1, chunk_size:int=process.CHUNK_SIZE, file_format:str="csv", restart:bool=False,\
+        scheme:buckets.BucketScheme=None, games:bool=False, legacy:bool=False, cache_size:int=process.OPENING_CACHE_SIZE,\
+        horizons:dict=None):
+    start = time.time()
+    if scheme is None:
+        scheme = buckets.BucketScheme()
+    if horizons is None:
+        horizons = process.HORIZONS
+    pgns = preprocess.get_files(path)
+    print("extracting the features of",len(pgns),"files:")
+    for pgn in pgns:
+        print("\t",pgn)
+    settings = {"format": file_format, "buckets": scheme.spec, "games": games, "legacy": legacy, "horizons": horizons}
+    manifest = checkpoint.Manifest(os.path.join(path, MANIFEST), settings, restart)
+    # the games of a pgn file that was rewritten can't be picked back out of the outputs
+    if any(manifest.get_status(pgn) == "changed" for pgn in pgns):
+        print("a pgn file changed since its features were extracted, starting over")
+        manifest = checkpoint.Manifest(os.path.join(path, MANIFEST), settings, True)
+    # the GAMES files it writes can't be added to once something else wrote them again (see buckets.save)
+    if games and manifest.inputs and buckets.load_generation(path) != manifest.generation:
+        print("the GAMES files were written again since",manifest.path,"was, starting over")
+        manifest = checkpoint.Manifest(os.path.join(path, MANIFEST), settings, True)
+    buckets.save(path, scheme, manifest.generation if games else buckets.load_generation(path))
+    games_paths = []
+    if games:
+        games_paths = [buckets.get_path(path, name, "GAMES", file_format) for name in scheme.names]
+    out = FeatureWriter(path, scheme, file_format, chunk_size, legacy, horizons)
+    # drop whatever was written after the last checkpoint
+    manifest.restore_outputs(out.get_paths() + games_paths)
+    out.count_games()
+    games_out = preprocess.open_all(games_paths, file_format, header=True)
+    pool = None
+    if workers > 1:
+        # every worker gets its own opening cache
+        pool = writer.get_pool(workers, process.init_worker, (cache_size, False, None))
+        out.pool = pool
+        out.workers = workers
+    else:
+        process.set_opening_cache(cache_size)
+    try:
+        for pgn in pgns:
+            status = manifest.get_status(pgn)
+            if status == "done":
+                print("skipping",pgn,"(already done)")
+                continue
+            offset = manifest.get_offset(pgn)
+            if offset > 0:
+                print("resuming",pgn,"at byte",offset)
+            file_start = time.time()
+            reader = preprocess.PgnReader(pgn, offset)
+            num_games = 0
+            for moves, result, avg_elo, time_control in preprocess.iter_games(reader):
+                out.add(scheme.get_bucket(avg_elo, time_control), moves, result)
+                if games:
+                    preprocess.store_game(moves, result, avg_elo, games_out, scheme, time_control)
+                num_games += 1
+                if manifest.is_due():
+                    out.commit(manifest, pgn, reader.get_position(), games_out, games_paths)
+            out.commit(manifest, pgn, reader.get_position(), games_out, games_paths, done=True)
+            took = time.time() - file_start
+            print("completed",pgn,"took",took,"seconds.",preprocess.get_rate(num_games, took),"games/sec")
+    finally:
+        if pool is not None:
+            pool.terminate()
+        out.close()
+        preprocess.clean_up(games_out)
+    if pool is None and process.opening_cache is not None:
+        print("\topening cache:",process.get_cache_stats())
+    print("\tskipped",out.skipped,"games")
+    process.save_quarantine_summary(scheme.names, path)
+    print("took",time.time()-start,"seconds")
+
+# the FEATURES and QUARANTINE files of every bucket of a fuse run. games are added one at a time and
+# extracted chunk_size games of a bucket at a time (see process.process_chunk), in the pool of worker
+# processes if it has one. the files are opened through a buckets.FilePool, so a scheme with many
+# buckets doesn't keep a file open for each, and are only created once something is written to them.
+class FeatureWriter:
+    def __init__(self, path:str, scheme:buckets.BucketScheme, file_format:str="csv", chunk_size:int=process.CHUNK_SIZE,\
+            legacy:bool=False, horizons:dict=None):
+        self.file_format = file_format
+        self.chunk_size = chunk_size
+        self.legacy = legacy
+        self.horizons = horizons
+        self.columns = process.get_feature_columns(horizons or process.HORIZONS)
+        self.features_paths = [buckets.get_path(path, name, "FEATURES", file_format) for name in scheme.names]
+        self.quarantine_paths = [buckets.get_path(path, name, "QUARANTINE", "csv") for name in scheme.names]
+        self.files = buckets.FilePool(functools.partial(open_output, columns=self.columns))
+        # the games of every bucket waiting to be extracted
+        self.chunks = [[] for name in scheme.names]
+        # how many games of every bucket are in its FEATURES file, see count_games
+        self.games = [0] * len(scheme.names)
+        # chunks handed to the pool but not written yet, as (bucket, result) pairs
+        self.pending = collections.deque()
+        # the outputs written to since they were opened, the only ones commit has to measure
+        self.written = set()
+        self.pool = None
+        self.workers = 1
+        self.skipped = 0
+
+    # returns the paths of every output
+    def get_paths(self):
+        return self.features_paths + self.quarantine_paths
+
+    # counts the games already in the FEATURES files (two rows each), so the games
+    # of the QUARANTINE csvs keep their numbers when a run is picked back up
+    def count_games(self):
+        for bucket, features_path in enumerate(self.features_paths):
+            if os.path.exists(features_path) and os.path.getsize(features_path) > 0:
+                self.games[bucket] = process.count_games(features_path) // 2
+
+    # adds a game to its bucket, extracting the bucket's features if it has a chunk of games
+    def add(self, bucket:int, moves:str, result:int):
+        chunk = self.chunks[bucket]
+        chunk.append((moves, result))
+        if len(chunk) >= self.chunk_size:
+            self.extract(bucket)
+
+    # extracts the features of the games of a bucket, or hands them to the pool.
+    # the pool is kept at most 2 chunks per worker ahead of the writes
+    def extract(self, bucket:int):
+        games = self.chunks[bucket]
+        self.chunks[bucket] = []
+        task = (games, self.legacy, self.file_format, self.horizons)
+        if self.pool is None:
+            self.write(bucket, process.process_chunk(*task))
+            return
+        self.pending.append((bucket, self.pool.apply_async(process.process_chunk, task)))
+        if len(self.pending) >= 2 * self.workers:
+            bucket, result = self.pending.popleft()
+            self.write(bucket, result.get())
+
+    # writes a chunk process.process_chunk finished to its bucket's files
+    def write(self, bucket:int, chunk:tuple):
+        rows, num_games, quarantined, took, pid, cache_stats, profile_stats, tree = chunk
+        self.files.get(self.features_paths[bucket]).write(rows)
+        self.written.add(self.features_paths[bucket])
+        if quarantined:
+            self.files.get(self.quarantine_paths[bucket]).write(process.get_quarantine_text(self.games[bucket], quarantined))
+            self.written.add(self.quarantine_paths[bucket])
+            self.skipped += len(quarantined)
+        self.games[bucket] += num_games
+
+    # extracts and writes every game added so far
+    def flush(self):
+        for bucket, chunk in enumerate(self.chunks):
+            if chunk:
+                self.extract(bucket)
+        while self.pending:
+            bucket, result = self.pending.popleft()
+            self.write(bucket, result.get())
+
+    # writes every game added so far and records in manifest that the games of pgn up to offset are in
+    # the outputs (and in games_out, the GAMES files at games_paths, if they're written too)
+    def commit(self, manifest, pgn:str, offset:int, games_out:list, games_paths:list, done:bool=False):
+        self.flush()
+        paths = [path for path in self.get_paths() if path in self.written]
+        outs = [self.files.get(path) for path in paths]
+        manifest.commit(pgn, offset, outs + games_out, paths + games_paths, done)
+
+    def close(self):
+        for path in self.get_paths():
+            self.files.close(path)
+
+# opens a FEATURES file (or QUARANTINE csv) to add rows to, see FeatureWriter.
+# FEATURES files are written from the background, see writer.wrap
+def open_output(path:str, columns:list):
+    if path.endswith(".npy"):
+        return writer.wrap(columnar.NpyWriter(path, columnar.get_features_dtype(columns)))
+    if os.path.basename(path).endswith("QUARANTINE.csv"):
+        return process.open_quarantine(path)
+    out = open(path, "a")
+    if out.tell() == 0:
+        out.write(",".join(columns)+"\n")
+    return writer.wrap(out)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("USEAGE: python fused.py <path-to-databases-directory> [--workers N] [--chunk-size N] [--format csv|npy] [--restart] [--buckets SCHEME] [--games] [--legacy] [--cache-size N] [--unique-moves N,N..] [--material-moves N,N..] [--center-moves N,N..] [--write-buffer BYTES] [--fsync]")
+    else:
+        main(sys.argv[1:])
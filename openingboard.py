@@ -0,0 +1,457 @@
+import chess
+import itertools
+import random
+import sys
+import time
+import argparse
+
+# a lighter board than chess.Board for replaying the openings of games (see process.replay_to).
+# chess.Board.push_san generates legal moves, keeps a move stack and snapshots the position for every
+# ply. an OpeningBoard only keeps the bitboards the features are taken from (under the same names, so
+# process.py's evaluators and batch.get_bitboards read it like a chess.Board), the turn, castling rights
+# and en passant square, and resolves a SAN move by looking up which piece can get to its square:
+# one lookup in python-chess's attack tables per piece type, then a check that the mover's king isn't
+# left attacked. moves come out legal, illegal or ambiguous exactly like python-chess's, and only the
+# SAN forms that don't name their piece but do name their square ("g1f3", python-chess plays those as
+# long algebraic) are handed to a chess.Board.
+# python openingboard.py checks it against python-chess move by move over a corpus of games.
+
+# the bitboards of every piece type, in PIECE_TYPES order
+PIECE_ATTRIBUTES = ["pawns", "knights", "bishops", "rooks", "queens", "kings"]
+# SAN castling -> (side to move -> (king from, king to, rook from, rook to, squares that have to be empty,
+# squares the king can't be attacked on))
+CASTLING = {}
+for san, squares in [("O-O", {chess.WHITE: (chess.E1, chess.G1, chess.H1, chess.F1), chess.BLACK: (chess.E8, chess.G8, chess.H8, chess.F8)}),\
+        ("O-O-O", {chess.WHITE: (chess.E1, chess.C1, chess.A1, chess.D1), chess.BLACK: (chess.E8, chess.C8, chess.A8, chess.D8)})]:
+    sides = {}
+    for color, (king, king_to, rook, rook_to) in squares.items():
+        empty = chess.SquareSet(chess.between(king, rook)).mask
+        attacked = chess.SquareSet(chess.between(king, king_to)).mask | chess.BB_SQUARES[king] | chess.BB_SQUARES[king_to]
+        sides[color] = (king, king_to, rook, rook_to, empty, attacked)
+    for suffix in ["", "+", "#"]:
+        CASTLING[san + suffix] = sides
+        CASTLING[san.replace("O", "0") + suffix] = sides
+# the piece letters of SAN
+PIECE_LETTERS = {"N": chess.KNIGHT, "B": chess.BISHOP, "R": chess.ROOK, "Q": chess.QUEEN, "K": chess.KING}
+# the pieces a pawn can promote to
+PROMOTIONS = {"n": chess.KNIGHT, "b": chess.BISHOP, "r": chess.ROOK, "q": chess.QUEEN}
+# what parse_san reads a SAN move as
+MOVE = 0          # a piece (or pawn) to a square
+CASTLING_MOVE = 1 # castling
+ILLEGAL_MOVE = 2  # something no position has a legal move for, like a knight that promotes
+FALLBACK_MOVE = 3 # a move only a chess.Board plays, see push_san_fallback
+# SAN -> parse_san's reading of it. games only use a few thousand different moves
+SAN_MOVES = {}
+# from_square + 64 * to_square + 4096 * promotion -> chess.Move, see get_move
+MOVES = {}
+
+# python-chess's tables, looked up on every ply
+BB_SQUARES = chess.BB_SQUARES
+BB_KNIGHT_ATTACKS = chess.BB_KNIGHT_ATTACKS
+BB_KING_ATTACKS = chess.BB_KING_ATTACKS
+BB_PAWN_ATTACKS = chess.BB_PAWN_ATTACKS
+BB_DIAG_ATTACKS = chess.BB_DIAG_ATTACKS
+BB_DIAG_MASKS = chess.BB_DIAG_MASKS
+BB_RANK_ATTACKS = chess.BB_RANK_ATTACKS
+BB_RANK_MASKS = chess.BB_RANK_MASKS
+BB_FILE_ATTACKS = chess.BB_FILE_ATTACKS
+BB_FILE_MASKS = chess.BB_FILE_MASKS
+
+class OpeningBoard:
+    __slots__ = ("pawns", "knights", "bishops", "rooks", "queens", "kings", "occupied_co", "occupied",\
+        "turn", "castling_rights", "ep_square")
+
+    def __init__(self):
+        self.pawns = chess.BB_RANK_2 | chess.BB_RANK_7
+        self.knights = chess.BB_B1 | chess.BB_G1 | chess.BB_B8 | chess.BB_G8
+        self.bishops = chess.BB_C1 | chess.BB_F1 | chess.BB_C8 | chess.BB_F8
+        self.rooks = chess.BB_CORNERS
+        self.queens = chess.BB_D1 | chess.BB_D8
+        self.kings = chess.BB_E1 | chess.BB_E8
+        # indexed by color, like chess.Board's
+        self.occupied_co = [chess.BB_RANK_7 | chess.BB_RANK_8, chess.BB_RANK_1 | chess.BB_RANK_2]
+        self.occupied = chess.BB_RANK_1 | chess.BB_RANK_2 | chess.BB_RANK_7 | chess.BB_RANK_8
+        self.turn = chess.WHITE
+        self.castling_rights = chess.BB_CORNERS
+        self.ep_square = None
+
+    # returns a copy of the board (stack is there to match chess.Board.copy, there's no stack)
+    def copy(self, stack:bool=True):
+        board = OpeningBoard.__new__(OpeningBoard)
+        board.pawns = self.pawns
+        board.knights = self.knights
+        board.bishops = self.bishops
+        board.rooks = self.rooks
+        board.queens = self.queens
+        board.kings = self.kings
+        board.occupied_co = self.occupied_co[:]
+        board.occupied = self.occupied
+        board.turn = self.turn
+        board.castling_rights = self.castling_rights
+        board.ep_square = self.ep_square
+        return board
+
+    # returns the squares of the pieces of a type and color, like chess.Board.pieces_mask
+    def pieces_mask(self, piece_type:int, color:bool):
+        return getattr(self, PIECE_ATTRIBUTES[piece_type - 1]) & self.occupied_co[color]
+
+    # returns the type of the piece on a square, or None
+    def piece_type_at(self, square:int):
+        mask = chess.BB_SQUARES[square]
+        if not self.occupied & mask:
+            return None
+        if self.pawns & mask:
+            return chess.PAWN
+        if self.knights & mask:
+            return chess.KNIGHT
+        if self.bishops & mask:
+            return chess.BISHOP
+        if self.rooks & mask:
+            return chess.ROOK
+        if self.queens & mask:
+            return chess.QUEEN
+        return chess.KING
+
+    # the board as text, the same as str(chess.Board) (the --legacy evaluators parse it)
+    def __str__(self):
+        builder = []
+        for square in chess.SQUARES_180:
+            piece_type = self.piece_type_at(square)
+            if piece_type is None:
+                builder.append(".")
+            else:
+                symbol = chess.PIECE_SYMBOLS[piece_type]
+                builder.append(symbol.upper() if self.occupied_co[chess.WHITE] & chess.BB_SQUARES[square] else symbol)
+            if chess.BB_SQUARES[square] & chess.BB_FILE_H:
+                if square != chess.H1:
+                    builder.append("\n")
+            else:
+                builder.append(" ")
+        return "".join(builder)
+
+    # returns the pieces of color (a mask of them, out of pieces) that attack square when the board's
+    # pieces are on occupied
+    def attackers_mask(self, color:bool, square:int, occupied:int, pieces:int):
+        queens = self.queens
+        return pieces & ((BB_KNIGHT_ATTACKS[square] & self.knights)\
+            | (BB_KING_ATTACKS[square] & self.kings)\
+            | ((BB_RANK_ATTACKS[square][BB_RANK_MASKS[square] & occupied]\
+                | BB_FILE_ATTACKS[square][BB_FILE_MASKS[square] & occupied]) & (self.rooks | queens))\
+            | (BB_DIAG_ATTACKS[square][BB_DIAG_MASKS[square] & occupied] & (self.bishops | queens))\
+            | (BB_PAWN_ATTACKS[not color][square] & self.pawns))
+
+    # returns the squares of the pieces of the side to move of a type that can move to square (leaving
+    # out whether the move would leave the king attacked), like chess.Board's pseudo-legal moves
+    def get_sources(self, piece_type:int, square:int):
+        own = self.occupied_co[self.turn]
+        occupied = self.occupied
+        if piece_type == chess.KNIGHT:
+            return BB_KNIGHT_ATTACKS[square] & self.knights & own
+        if piece_type == chess.BISHOP:
+            return BB_DIAG_ATTACKS[square][BB_DIAG_MASKS[square] & occupied] & self.bishops & own
+        if piece_type == chess.ROOK:
+            return (BB_RANK_ATTACKS[square][BB_RANK_MASKS[square] & occupied]\
+                | BB_FILE_ATTACKS[square][BB_FILE_MASKS[square] & occupied]) & self.rooks & own
+        if piece_type == chess.QUEEN:
+            return (BB_DIAG_ATTACKS[square][BB_DIAG_MASKS[square] & occupied]\
+                | BB_RANK_ATTACKS[square][BB_RANK_MASKS[square] & occupied]\
+                | BB_FILE_ATTACKS[square][BB_FILE_MASKS[square] & occupied]) & self.queens & own
+        if piece_type == chess.KING:
+            return BB_KING_ATTACKS[square] & self.kings & own
+        # pawns capture onto the other side's pieces (or the en passant square) and push onto empty squares
+        pawns = self.pawns & own
+        mask = BB_SQUARES[square]
+        if occupied & mask or square == self.ep_square:
+            return BB_PAWN_ATTACKS[not self.turn][square] & pawns
+        if self.turn == chess.WHITE:
+            if mask & chess.BB_RANK_4 and not occupied & (mask >> 8):
+                return pawns & ((mask >> 8) | (mask >> 16))
+            return pawns & (mask >> 8)
+        if mask & chess.BB_RANK_5 and not occupied & (mask << 8):
+            return pawns & ((mask << 8) | (mask << 16))
+        return pawns & (mask << 8)
+
+    # returns whether moving a piece of the side to move from from_square to to_square (capturing on
+    # capture_square) leaves its king unattacked
+    def is_safe(self, from_square:int, to_square:int, capture_square:int):
+        from_mask = BB_SQUARES[from_square]
+        capture_mask = BB_SQUARES[capture_square]
+        occupied = (self.occupied & ~from_mask & ~capture_mask) | BB_SQUARES[to_square]
+        # the captured piece can't attack anymore
+        theirs = self.occupied_co[not self.turn] & ~capture_mask
+        if self.kings & from_mask:
+            king = to_square
+        else:
+            king = (self.kings & self.occupied_co[self.turn]).bit_length() - 1
+        return not self.attackers_mask(not self.turn, king, occupied, theirs)
+
+    # plays a move in SAN and returns it (a chess.Move), like chess.Board.push_san.
+    # raises ValueError (chess.IllegalMoveError or chess.AmbiguousMoveError, or chess.InvalidMoveError
+    # if it doesn't read as SAN) where python-chess would
+    def push_san(self, san:str):
+        parsed = SAN_MOVES.get(san)
+        if parsed is None:
+            parsed = SAN_MOVES[san] = parse_san(san)
+        kind, piece_type, to_square, from_mask, promotion = parsed
+        if kind != MOVE:
+            if kind == CASTLING_MOVE:
+                return self.castle(san, piece_type[self.turn])
+            if kind == FALLBACK_MOVE:
+                return self.push_san_fallback(san)
+            raise chess.IllegalMoveError("illegal san: "+repr(san))
+        to_mask = BB_SQUARES[to_square]
+        if self.occupied_co[self.turn] & to_mask:
+            raise chess.IllegalMoveError("illegal san: "+repr(san))
+        sources = self.get_sources(piece_type, to_square) & from_mask
+        capture_square = to_square
+        if piece_type == chess.PAWN and to_square == self.ep_square and not self.occupied & to_mask:
+            # en passant, get_sources only gives captures onto the square
+            capture_square = to_square - 8 if self.turn == chess.WHITE else to_square + 8
+        if sources & (sources - 1) == 0:
+            # one piece (or none) can get there, the usual case
+            from_square = sources.bit_length() - 1
+            if from_square < 0 or not self.is_safe(from_square, to_square, capture_square):
+                raise chess.IllegalMoveError("illegal san: "+repr(san))
+        else:
+            from_square = None
+            for square in chess.scan_forward(sources):
+                if self.is_safe(square, to_square, capture_square):
+                    if from_square is not None:
+                        raise chess.AmbiguousMoveError("ambiguous san: "+repr(san))
+                    from_square = square
+            if from_square is None:
+                raise chess.IllegalMoveError("illegal san: "+repr(san))
+        self.move_piece(piece_type, from_square, to_square, capture_square, promotion)
+        return get_move(from_square, to_square, promotion)
+
+    # plays a castling move (squares are the CASTLING squares of the side to move)
+    def castle(self, san:str, squares:tuple):
+        king, king_to, rook, rook_to, empty, attacked = squares
+        own = self.occupied_co[self.turn]
+        if not self.castling_rights & own & self.rooks & BB_SQUARES[rook] or not self.kings & own & BB_SQUARES[king]\
+                or self.occupied & empty:
+            raise chess.IllegalMoveError("illegal san: "+repr(san))
+        # the king can't castle out of, through or into check
+        occupied = self.occupied & ~BB_SQUARES[king] & ~BB_SQUARES[rook]
+        theirs = self.occupied_co[not self.turn]
+        for square in chess.scan_forward(attacked):
+            if self.attackers_mask(not self.turn, square, occupied, theirs):
+                raise chess.IllegalMoveError("illegal san: "+repr(san))
+        mask = BB_SQUARES[king] | BB_SQUARES[king_to]
+        self.kings ^= mask
+        own ^= mask
+        mask = BB_SQUARES[rook] | BB_SQUARES[rook_to]
+        self.rooks ^= mask
+        own ^= mask
+        self.occupied_co[self.turn] = own
+        self.occupied = own | self.occupied_co[not self.turn]
+        self.castling_rights &= ~(chess.BB_RANK_1 if self.turn == chess.WHITE else chess.BB_RANK_8)
+        self.ep_square = None
+        self.turn = not self.turn
+        return get_move(king, king_to)
+
+    # moves a piece of the side to move, like chess.Board.push does with a legal move
+    def move_piece(self, piece_type:int, from_square:int, to_square:int, capture_square:int, promotion:int=None):
+        from_mask = BB_SQUARES[from_square]
+        to_mask = BB_SQUARES[to_square]
+        if self.occupied & BB_SQUARES[capture_square]:
+            self.remove_piece(capture_square)
+        move_mask = from_mask | to_mask
+        if piece_type == chess.PAWN:
+            if promotion is None:
+                self.pawns ^= move_mask
+                if to_square - from_square == 16 or from_square - to_square == 16:
+                    self.ep_square = (from_square + to_square) // 2
+                else:
+                    self.ep_square = None
+            else:
+                self.pawns &= ~from_mask
+                self.ep_square = None
+                if promotion == chess.KNIGHT:
+                    self.knights |= to_mask
+                elif promotion == chess.BISHOP:
+                    self.bishops |= to_mask
+                elif promotion == chess.ROOK:
+                    self.rooks |= to_mask
+                else:
+                    self.queens |= to_mask
+        else:
+            self.ep_square = None
+            if piece_type == chess.KNIGHT:
+                self.knights ^= move_mask
+            elif piece_type == chess.BISHOP:
+                self.bishops ^= move_mask
+            elif piece_type == chess.ROOK:
+                self.rooks ^= move_mask
+            elif piece_type == chess.QUEEN:
+                self.queens ^= move_mask
+            else:
+                self.kings ^= move_mask
+                self.castling_rights &= ~(chess.BB_RANK_1 if self.turn == chess.WHITE else chess.BB_RANK_8)
+        self.castling_rights &= ~move_mask
+        self.occupied_co[self.turn] ^= move_mask
+        self.occupied = self.occupied_co[chess.WHITE] | self.occupied_co[chess.BLACK]
+        self.turn = not self.turn
+
+    # takes the piece on a square off the board
+    def remove_piece(self, square:int):
+        mask = ~BB_SQUARES[square]
+        self.pawns &= mask
+        self.knights &= mask
+        self.bishops &= mask
+        self.rooks &= mask
+        self.queens &= mask
+        self.kings &= mask
+        self.occupied_co[chess.WHITE] &= mask
+        self.occupied_co[chess.BLACK] &= mask
+
+    # plays a move python-chess has to read (see push_san) on a chess.Board of the same position
+    def push_san_fallback(self, san:str):
+        board = self.to_board()
+        move = board.push_san(san)
+        for attribute in PIECE_ATTRIBUTES:
+            setattr(self, attribute, getattr(board, attribute))
+        self.occupied_co = [board.occupied_co[chess.BLACK], board.occupied_co[chess.WHITE]]
+        self.occupied = board.occupied
+        self.turn = board.turn
+        self.castling_rights = board.castling_rights
+        self.ep_square = board.ep_square
+        return move
+
+    # returns a chess.Board of the same position
+    def to_board(self):
+        board = chess.Board(None)
+        for attribute in PIECE_ATTRIBUTES:
+            setattr(board, attribute, getattr(self, attribute))
+        board.occupied_co[chess.WHITE] = self.occupied_co[chess.WHITE]
+        board.occupied_co[chess.BLACK] = self.occupied_co[chess.BLACK]
+        board.occupied = self.occupied
+        board.turn = self.turn
+        board.castling_rights = self.castling_rights
+        board.ep_square = self.ep_square
+        return board
+
+# reads a SAN move the way chess.Board.parse_san does, without a position.
+# returns (kind, piece type, to square, mask of the squares it can come from, promotion) where kind is
+# MOVE, CASTLING_MOVE (and the piece type is the CASTLING squares), ILLEGAL_MOVE or FALLBACK_MOVE.
+# raises chess.InvalidMoveError if it isn't SAN
+def parse_san(san:str):
+    sides = CASTLING.get(san)
+    if sides is not None:
+        return CASTLING_MOVE, sides, None, None, None
+    match = chess.SAN_REGEX.match(san)
+    if match is None:
+        # null moves too, an OpeningBoard only plays moves
+        raise chess.InvalidMoveError("invalid san: "+repr(san))
+    piece, from_file, from_rank, to_name, promotion = match.groups()
+    if piece is None and from_file and from_rank:
+        return FALLBACK_MOVE, None, None, None, None
+    to_square = chess.SQUARE_NAMES.index(to_name)
+    from_mask = chess.BB_ALL
+    if from_file:
+        from_mask &= chess.BB_FILES[chess.FILE_NAMES.index(from_file)]
+    if from_rank:
+        from_mask &= chess.BB_RANKS[int(from_rank) - 1]
+    if piece is None:
+        if not from_file:
+            # no pawn captures without a file
+            from_mask &= chess.BB_FILES[chess.square_file(to_square)]
+        # a pawn that gets to the last rank has to promote, and only then
+        if (promotion is not None) != bool(BB_SQUARES[to_square] & chess.BB_BACKRANKS):
+            return ILLEGAL_MOVE, None, None, None, None
+        if promotion is not None:
+            promotion = PROMOTIONS.get(promotion[-1].lower())
+            if promotion is None:
+                return ILLEGAL_MOVE, None, None, None, None
+        return MOVE, chess.PAWN, to_square, from_mask, promotion
+    if promotion is not None:
+        return ILLEGAL_MOVE, None, None, None, None
+    return MOVE, PIECE_LETTERS[piece], to_square, from_mask, None
+
+# returns the chess.Move of a from square, to square and promotion (shared, they're never changed)
+def get_move(from_square:int, to_square:int, promotion:int=None):
+    key = from_square + 64 * to_square + 4096 * (promotion or 0)
+    move = MOVES.get(key)
+    if move is None:
+        move = MOVES[key] = chess.Move(from_square, to_square, promotion)
+    return move
+
+def main(args:list):
+    args = get_args(args)
+    if args.pgn:
+        import preprocess # only needed to read pgn files
+        with open(args.pgn, "r") as f:
+            movetexts = [moves for moves, result, avg_elo, time_control in preprocess.iter_games(f)]
+    else:
+        import benchmark # the synthetic games
+        movetexts = [moves for moves, result in benchmark.read_pgn_games(benchmark.generate_pgn(args.games, args.seed))]
+    check(movetexts, args.plies, args.seed)
+
+# reads the commandline args
+def get_args(args:list):
+    parser = argparse.ArgumentParser(description="checks OpeningBoard against python-chess move by move over a corpus of games")
+    parser.add_argument("pgn", nargs="?", help="pgn file to take the games from instead of benchmark.py's synthetic games")
+    parser.add_argument("--games", type=int, default=2000, help="number of synthetic games")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic games and the wrong moves tried")
+    parser.add_argument("--plies", type=int, default=0, help="plies of every game to check (0 for all of them)")
+    return parser.parse_args(args)
+
+# replays movetexts on an OpeningBoard and a chess.Board side by side and prints every ply where they
+# don't agree: on the move, on the position after it, or on whether it could be played. at every ply
+# a wrong move (a move of another game) is tried on copies of both too, so illegal and ambiguous
+# moves are checked as well. returns the number of plies that didn't agree
+def check(movetexts:list, plies:int=0, seed:int=0):
+    import process # see process.iter_plies
+    rng = random.Random(seed)
+    games = [list(process.iter_plies(moves)) for moves in movetexts]
+    if plies > 0:
+        games = [sans[:plies] for sans in games]
+    all_sans = list(itertools.chain.from_iterable(games))
+    checked = mismatches = 0
+    chess_seconds = light_seconds = 0.0
+    for number, sans in enumerate(games):
+        board = chess.Board()
+        light = OpeningBoard()
+        for ply, san in enumerate(sans):
+            wrong = rng.choice(all_sans)
+            if get_outcome(board.copy(stack=False), wrong) != get_outcome(light.copy(), wrong):
+                print("game",number,"ply",ply,"the wrong move",wrong,"went differently:",\
+                    get_outcome(board.copy(stack=False), wrong),"vs",get_outcome(light.copy(), wrong))
+                mismatches += 1
+            start = time.perf_counter()
+            expected = get_outcome(board, san)
+            chess_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            outcome = get_outcome(light, san)
+            light_seconds += time.perf_counter() - start
+            checked += 1
+            if outcome != expected or (expected[0] == "move" and get_position(light) != get_position(board)):
+                print("game",number,"ply",ply,san,"went differently:",outcome,"vs",expected)
+                mismatches += 1
+                break
+            if expected[0] != "move":
+                break
+    print("checked",checked,"plies of",len(games),"games (and as many wrong moves),",mismatches,"didn't agree")
+    print("push_san took",round(1e6 * chess_seconds / max(checked, 1), 2),"us/ply with python-chess,",\
+        round(1e6 * light_seconds / max(checked, 1), 2),"us/ply with OpeningBoard")
+    return mismatches
+
+# plays san on a board. returns ("move", the move) or (the ValueError's type name, None)
+def get_outcome(board, san:str):
+    try:
+        return "move", board.push_san(san)
+    except ValueError as e:
+        return type(e).__name__, None
+
+# returns what the features see of a board, and what the next moves depend on
+def get_position(board):
+    if isinstance(board, chess.Board):
+        castling_rights = board.clean_castling_rights()
+    else:
+        castling_rights = board.castling_rights
+    return tuple(getattr(board, attribute) for attribute in PIECE_ATTRIBUTES)\
+        + (board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK], board.occupied, board.turn,\
+        castling_rights, board.ep_square, str(board))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
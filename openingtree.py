@@ -0,0 +1,247 @@
+import json
+import os
+import numpy as np
+import columnar
+
+# a tree of the openings of the games of a directory, built while process.py --tree extracts their features
+# (see process.iterate_csvs). a game's board features only depend on its first plies (2 * the furthest
+# horizon), and the games of millions of players share far fewer of those openings than there are games.
+# so every node of the tree (the position the plies from the root to it lead to) holds the board features
+# of the games that end there (their features were taken from it), and for every bucket and result the
+# number of those games and the sums of their when_castled. that's all analyze.py needs to get the same
+# scores as from the FEATURES files (see analyze.iterate_tree), for any bucket, group of buckets and
+# opening, from a few numbers per node instead of two rows per game.
+# games that were skipped have no opening, they're counted at the root with -1 for every feature
+# like their FEATURES rows. the tree is saved next to the FEATURES files in three files:
+#   TREE_NODES  - a row per node in depth first order (children in the order of their plies), so the
+#                 nodes below a node are the slice after it: parent, size (of its subtree, itself included)
+#                 and the board features of its games (<feature>_w/b, -1 for nodes no game ends at)
+#   TREE_COUNTS - a row per node, bucket and result of the games that end at a node, in node order
+#                 (see COUNTS_DTYPE)
+#   TREE_INDEX  - the bucket scheme, columns and horizons, the ply that leads to every node and how many
+#                 games of every GAMES file (of which generation, see buckets.save) the tree has, so the
+#                 next run only adds the games after them
+
+TREE_NODES = "opening-tree.npy"
+TREE_COUNTS = "opening-tree-counts.npy"
+TREE_INDEX = "opening-tree.json"
+# a row of TREE_COUNTS. result is 1 if white won, 2 if black won and 0 otherwise (like store.py),
+# when_castled_w/b are the sums of the games' when_castled and when_castled_min/max cover both colors
+COUNTS_DTYPE = np.dtype([("node", np.uint32), ("bucket", np.uint16), ("result", np.int8), ("games", np.int64),\
+    ("when_castled_w", np.int64), ("when_castled_w_squares", np.int64),\
+    ("when_castled_b", np.int64), ("when_castled_b_squares", np.int64),\
+    ("when_castled_min", np.int16), ("when_castled_max", np.int16)])
+# how many numbers OpeningTree keeps per result of a node and bucket (the TREE_COUNTS columns from games on)
+NUM_COUNTS = 7
+
+# returns the dtype of the TREE_NODES rows of FEATURES columns (without win)
+def get_nodes_dtype(columns:list):
+    features = columnar.get_features_dtype(columns)
+    fields = [("parent", np.int32), ("size", np.uint32)]
+    for column in columns[1:]: # when_castled isn't a board feature
+        fields += [(column+"_w", features[column]), (column+"_b", features[column])]
+    return np.dtype(fields)
+
+# returns whether path has a saved tree
+def exists(path:str):
+    return all(os.path.exists(os.path.join(path, name)) for name in [TREE_NODES, TREE_COUNTS, TREE_INDEX])
+
+# the tree while it's built. nodes are numbered as they're added, the root is 0.
+# columns are the FEATURES columns (without win), when_castled first like get_feature_columns has it
+class OpeningTree:
+    def __init__(self, columns:list):
+        self.columns = columns
+        self.plies = [""]
+        self.parents = [-1]
+        # the board features of the games of every node, white's and then black's (None until one ends there)
+        self.features = [(-1,) * (2 * len(columns) - 2)]
+        # (parent, ply) -> node
+        self.children = {}
+        # (node, bucket) -> NUM_COUNTS numbers for every result
+        self.counts = {}
+
+    # returns the node plies leads to from node, adding it if it's new
+    def get_child(self, node:int, ply:str):
+        child = self.children.get((node, ply))
+        if child is None:
+            child = self.children[(node, ply)] = len(self.plies)
+            self.plies.append(ply)
+            self.parents.append(node)
+            self.features.append(None)
+        return child
+
+    # returns the node the plies of opening lead to, adding the ones that are new
+    def get_node(self, opening):
+        node = 0
+        get = self.children.get
+        for ply in opening:
+            child = get((node, ply))
+            if child is None:
+                child = self.get_child(node, ply)
+            node = child
+        return node
+
+    # adds a game that was skipped (opening None) or whose board features were taken after the plies of
+    # opening, with its result and process.GameFeatures
+    def add_game(self, opening, result:int, features, bucket:int=0):
+        if opening is None:
+            node = 0
+            values = None
+        else:
+            node = self.get_node(opening)
+            values = features.num_center_squares_controlled_w + features.material_difference + features.num_unique_pieces_moved_w +\
+                features.num_center_squares_controlled_b + features.material_difference + features.num_unique_pieces_moved_b
+        self.add(node, bucket, result, values, features.when_castled_w, features.when_castled_b)
+
+    # adds a game that ends at node: its bucket, result, board features (see features) and when it castled
+    def add(self, node:int, bucket:int, result:int, values:tuple, when_castled_w:int, when_castled_b:int):
+        if self.features[node] is None:
+            self.features[node] = values
+        counts = self.counts.get((node, bucket))
+        if counts is None:
+            counts = self.counts[(node, bucket)] = [0, 0, 0, 0, 0, 32767, -32768] * 3
+        i = NUM_COUNTS * (result if result == 1 or result == 2 else 0)
+        counts[i] += 1
+        counts[i + 1] += when_castled_w
+        counts[i + 2] += when_castled_w * when_castled_w
+        counts[i + 3] += when_castled_b
+        counts[i + 4] += when_castled_b * when_castled_b
+        counts[i + 5] = min(counts[i + 5], when_castled_w, when_castled_b)
+        counts[i + 6] = max(counts[i + 6], when_castled_w, when_castled_b)
+
+    # adds every game of other (a tree of the same columns) to bucket
+    def merge(self, other, bucket:int=0):
+        nodes = [0] * len(other.plies)
+        for node in range(1, len(other.plies)):
+            nodes[node] = self.get_child(nodes[other.parents[node]], other.plies[node])
+            if self.features[nodes[node]] is None:
+                self.features[nodes[node]] = other.features[node]
+        for (node, other_bucket), other_counts in other.counts.items():
+            counts = self.counts.get((nodes[node], bucket))
+            if counts is None:
+                self.counts[(nodes[node], bucket)] = list(other_counts)
+                continue
+            for i in range(0, len(counts), NUM_COUNTS):
+                for j in range(i, i + 5):
+                    counts[j] += other_counts[j]
+                counts[i + 5] = min(counts[i + 5], other_counts[i + 5])
+                counts[i + 6] = max(counts[i + 6], other_counts[i + 6])
+
+    # writes the tree to path (see TREE_NODES, TREE_COUNTS and TREE_INDEX). names are the bucket names
+    # of scheme (a buckets.BucketScheme spec) the bucket numbers stand for, opening_plies how many plies
+    # of every game were followed and games how many games of every GAMES file (by name) of generation
+    # the tree has. every file is replaced in one step, the index last
+    def save(self, path:str, scheme:str, names:list, horizons:dict, legacy:bool, opening_plies:int, games:dict,\
+            generation:str=None):
+        # depth first, children in the order of their plies
+        kids = [[] for ply in self.plies]
+        for (parent, ply), child in self.children.items():
+            kids[parent].append((ply, child))
+        order = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack += [child for ply, child in sorted(kids[node], reverse=True)]
+        numbers = np.empty(len(order), dtype=np.int64)
+        numbers[order] = np.arange(len(order))
+        sizes = [1] * len(order)
+        for node in reversed(order[1:]):
+            sizes[self.parents[node]] += sizes[node]
+        nodes = np.zeros(len(order), dtype=get_nodes_dtype(self.columns))
+        nodes["parent"] = [numbers[self.parents[node]] if node > 0 else -1 for node in order]
+        nodes["size"] = [sizes[node] for node in order]
+        features = np.array([self.features[node] or self.features[0] for node in order], dtype=np.int64).reshape(len(order), -1)
+        board_columns = self.columns[1:]
+        for i, column in enumerate(board_columns):
+            nodes[column+"_w"] = features[:, i]
+            nodes[column+"_b"] = features[:, len(board_columns) + i]
+        rows = []
+        for (node, bucket), counts in self.counts.items():
+            for result in range(3):
+                values = counts[NUM_COUNTS * result:NUM_COUNTS * (result + 1)]
+                if values[0] > 0:
+                    rows.append((numbers[node], bucket, result, *values))
+        counts = np.array(rows, dtype=COUNTS_DTYPE)
+        counts = counts[np.lexsort((counts["result"], counts["bucket"], counts["node"]))]
+        save_npy(os.path.join(path, TREE_NODES), nodes)
+        save_npy(os.path.join(path, TREE_COUNTS), counts)
+        index = {"scheme": scheme, "buckets": names, "columns": self.columns, "horizons": horizons, "legacy": legacy,\
+            "opening_plies": opening_plies, "games": games, "generation": generation, "plies": [self.plies[node] for node in order]}
+        with open(os.path.join(path, TREE_INDEX)+".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(os.path.join(path, TREE_INDEX)+".tmp", os.path.join(path, TREE_INDEX))
+        print("saved the opening tree of",int(counts["games"].sum()),"games:",len(order),"nodes,",len(counts),"counts")
+
+# writes an array to a .npy file, replacing it in one step
+def save_npy(path:str, array):
+    with open(path+".tmp", "wb") as f:
+        np.save(f, array)
+    os.replace(path+".tmp", path)
+
+# a tree saved by OpeningTree.save, memory mapped
+class OpeningIndex:
+    def __init__(self, path:str):
+        with open(os.path.join(path, TREE_INDEX), "r") as f:
+            index = json.load(f)
+        self.scheme = index["scheme"]
+        self.buckets = index["buckets"]
+        self.columns = index["columns"]
+        self.horizons = index["horizons"]
+        self.legacy = index["legacy"]
+        self.opening_plies = index["opening_plies"]
+        # None for trees saved before it was kept
+        self.games = index.get("games")
+        self.generation = index.get("generation")
+        self.plies = index["plies"]
+        self.nodes = columnar.load_npy(os.path.join(path, TREE_NODES))
+        self.counts = columnar.load_npy(os.path.join(path, TREE_COUNTS))
+
+    # returns the node a list of plies leads to, or None if no game went that way
+    def find(self, opening:list):
+        if len(opening) > self.opening_plies:
+            raise ValueError("the tree only follows the first "+str(self.opening_plies)+" plies of every game")
+        sizes = self.nodes["size"]
+        node = 0
+        for ply in opening:
+            child = node + 1
+            end = node + int(sizes[node])
+            while child < end and self.plies[child] != ply:
+                child += int(sizes[child])
+            if child >= end:
+                return None
+            node = child
+        return node
+
+    # returns the TREE_COUNTS rows of the games that start with the plies of opening (all of them without one)
+    def get_counts(self, opening:list=None):
+        if not opening:
+            return self.counts
+        node = self.find(opening)
+        if node is None:
+            return self.counts[:0]
+        nodes = self.counts["node"]
+        end = node + int(self.nodes["size"][node])
+        return self.counts[np.searchsorted(nodes, node):np.searchsorted(nodes, end)]
+
+    # returns the tree as an OpeningTree, to add more games to
+    def get_tree(self):
+        tree = OpeningTree(self.columns)
+        tree.plies = list(self.plies)
+        tree.parents = self.nodes["parent"].tolist()
+        tree.children = {(parent, ply): node for node, (parent, ply) in enumerate(zip(tree.parents, tree.plies)) if node > 0}
+        board_columns = self.columns[1:]
+        features = np.stack([self.nodes[column+"_w"] for column in board_columns] +\
+            [self.nodes[column+"_b"] for column in board_columns], axis=1).tolist()
+        # only the nodes games end at have features, the others get them from the first game that does
+        tree.features = [None] * len(tree.plies)
+        tree.features[0] = (-1,) * (2 * len(board_columns))
+        for node in np.unique(self.counts["node"]).tolist():
+            if node > 0:
+                tree.features[node] = tuple(features[node])
+        for node, bucket, result, *values in self.counts.tolist():
+            counts = tree.counts.get((node, bucket))
+            if counts is None:
+                counts = tree.counts[(node, bucket)] = [0, 0, 0, 0, 0, 32767, -32768] * 3
+            counts[NUM_COUNTS * result:NUM_COUNTS * (result + 1)] = values
+        return tree
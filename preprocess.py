@@ -1,60 +1,403 @@
 import pandas as pd
-import numpy as np
 import matplotlib.pyplot as plt
 import random
 import time
-import re
 import os
 import sys
+import io
+import shutil
+import tempfile
+import argparse
+import collections
+import threading
+import queue
+import bz2
+import gzip
+import functools
+import columnar
+import checkpoint
+import buckets
+import writer
+try:
+    import zstandard # only needed for .pgn.zst files
+except ImportError:
+    zstandard = None
 
 # turns pgn format into a more useful format for our calculations (.csv)
 # resulting csv = |moves|outcome|
 
+# the bucket scheme games are sorted into when none is given, and its rating brackets
+# in the order store_game uses them
+DEFAULT_SCHEME = buckets.BucketScheme()
+BRACKETS = DEFAULT_SCHEME.names
+
+# how many bytes of a pgn file each worker process parses at a time
+CHUNK_BYTES = 64 * 1024 * 1024
+
+# how many bytes are read (and decompressed) from a pgn file at a time
+READ_BUFFER = 4 * 1024 * 1024
+# how many decompressed blocks can wait for the parser
+READ_AHEAD = 8
+# the compressed pgn files read_pgn can stream
+COMPRESSED_EXTENSIONS = [".bz2", ".gz", ".zst"]
+
+# where prepreprocess keeps track of how far it got, see checkpoint.py
+MANIFEST = ".preprocess-manifest.json"
+
 def main(args:list):
-    prepreprocess(str(args[0]))
+    args = get_args(args)
+    writer.set_buffering(args.write_buffer, args.fsync)
+    prepreprocess(str(args.path), args.workers, args.chunk_mb * 1024 * 1024, args.format, args.restart, args.buckets)
+
+# reads the commandline args
+def get_args(args:list):
+    parser = argparse.ArgumentParser(description="turns the pgn files in a directory into GAMES csvs")
+    parser.add_argument("path", help="path to the databases directory")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to parse pgn files with")
+    parser.add_argument("--chunk-mb", type=int, default=CHUNK_BYTES // (1024 * 1024), help="megabytes of pgn each worker parses at a time")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv", help="format of the GAMES files to write")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoints of earlier runs and preprocess everything again")
+    parser.add_argument("--buckets", type=buckets.BucketScheme, default=buckets.DEFAULT_SCHEME,\
+        help="how to split the games into GAMES files: brackets, elo:WIDTH or bounds:ELO/ELO/.., with ,tc to split by time control too")
+    parser.add_argument("--write-buffer", type=int, default=writer.WRITE_BUFFER, help="bytes every GAMES file buffers before a background thread writes them (0 writes them right away)")
+    parser.add_argument("--fsync", action="store_true", help="sync every buffer to disk once it's written, not only at checkpoints")
+    return parser.parse_args(args)
 
 # preprocess all pgn files in path
-def prepreprocess(path:str):
+# workers > 1 splits each pgn file at game boundaries and parses the pieces in that many processes
+# file_format "npy" writes GAMES .npy files (see columnar.py) instead of csvs
+# progress is checkpointed in a manifest in path, so a run that was stopped picks up where it was,
+# pgn files that were already preprocessed are skipped and pgn files that grew are read from where
+# they ended. restart ignores the manifest and preprocesses everything again.
+# the games go in a GAMES file per bucket of scheme (the rating brackets by default, see buckets.py),
+# which is recorded in path for process.py and analyze.py.
+def prepreprocess(path:str, workers:int=1, chunk_bytes:int=CHUNK_BYTES, file_format:str="csv", restart:bool=False,\
+        scheme:buckets.BucketScheme=None):
     start = time.time()
+    if scheme is None:
+        scheme = buckets.BucketScheme()
     pgns = get_files(path)
     print("preprocessing",len(pgns),"files:")
     for pgn in pgns:
         print("\t",pgn)
-    # process every pgn file
-    out_names = [path+"/0-999GAMES.csv",path+"/1000-1499GAMES.csv", path+"/1500-1999GAMES.csv", path+"/2000+GAMES.csv"]
-    out_names = open_all(out_names)
-    for out_name in out_names:
-        add_header(out_name)
-    for pgn in pgns:
-        p = open(pgn, "r")
-        preprocess(p, out_names) # process the file
-        print("completed",pgn,"took",time.time()-start,"seconds.")
+    out_paths = [buckets.get_path(path, name, "GAMES", file_format) for name in scheme.names]
+    settings = {"format": file_format, "buckets": scheme.spec}
+    manifest = checkpoint.Manifest(os.path.join(path, MANIFEST), settings, restart)
+    # the games of a pgn file that was rewritten can't be picked back out of the GAMES files
+    if any(manifest.get_status(pgn) == "changed" for pgn in pgns):
+        print("a pgn file changed since it was preprocessed, starting over")
+        manifest = checkpoint.Manifest(os.path.join(path, MANIFEST), settings, True)
+    # fused.py --games writes the GAMES files too (see buckets.save)
+    if manifest.inputs and buckets.load_generation(path) != manifest.generation:
+        print("the GAMES files were written again since",manifest.path,"was, starting over")
+        manifest = checkpoint.Manifest(os.path.join(path, MANIFEST), settings, True)
+    buckets.save(path, scheme, manifest.generation)
+    # drop whatever was written after the last checkpoint
+    manifest.restore_outputs(out_paths)
+    out_names = open_all(out_paths, file_format, header=True)
+    try:
+        # process every pgn file
+        for pgn in pgns:
+            status = manifest.get_status(pgn)
+            if status == "done":
+                print("skipping",pgn,"(already preprocessed)")
+                continue
+            offset = manifest.get_offset(pgn)
+            if offset > 0:
+                print("resuming",pgn,"at byte",offset)
+            file_start = time.time()
+            if workers > 1:
+                end = preprocess_parallel(pgn, out_names, workers, chunk_bytes, offset,\
+                    functools.partial(save_checkpoint, manifest, pgn, out_names, out_paths), scheme)
+            else:
+                reader = PgnReader(pgn, offset)
+                preprocess(reader, out_names,\
+                    functools.partial(save_checkpoint, manifest, pgn, out_names, out_paths, reader.get_position), scheme) # process the file
+                end = reader.get_position()
+            manifest.commit(pgn, end, out_names, out_paths, done=True)
+            took = time.time() - file_start
+            print("completed",pgn,"took",time.time()-start,"seconds.",get_rate(os.path.getsize(pgn), took)/1e6,"MB/sec")
+    finally:
+        # whatever was written after the last checkpoint is cut off on the next run anyway
+        clean_up(out_names)
     end = time.time() - start
     print("Done. Took",end,"seconds.")
 
+# checkpoints how far into pgn the games in out_names go, if a checkpoint is due.
+# get_offset returns the (decompressed) byte offset just past the last game written
+def save_checkpoint(manifest, pgn:str, out_names:list, out_paths:list, get_offset):
+    if manifest.is_due():
+        manifest.commit(pgn, get_offset(), out_names, out_paths)
+
 # writes the headers for the csvs
 def add_header(out_name):
     out_name.write("moves,result\n")
 # opens all the files and returns a list of file objects instead of strings
-def open_all(out_names:list):
-    files = []
-    for name in out_names:
-        files.append(open(name, "a"))
-    return files
+# (buckets.BucketFiles, which buffer the games and share at most max_open open files: csvs,
+# or columnar.GamesWriters for file_format "npy"). header adds the csv header to new csvs
+def open_all(out_names:list, file_format:str="csv", header:bool=False, max_open:int=buckets.MAX_OPEN_FILES):
+    files = buckets.FilePool(functools.partial(open_output, file_format=file_format, header=header), max_open)
+    return [buckets.BucketFile(name, files) for name in out_names]
+
+# opens a GAMES file to add games to (written from the background, see writer.wrap), see open_all
+def open_output(name:str, file_format:str="csv", header:bool=False):
+    if file_format == "npy":
+        return writer.wrap(columnar.GamesWriter(name))
+    out_name = open(name, "a")
+    if header and out_name.tell() == 0:
+        add_header(out_name)
+    return writer.wrap(out_name)
 
 # returns a list of database names from root/directory
+# compressed databases (.pgn.bz2, .pgn.gz, .pgn.zst) are included unless they were already
+# decompressed next to themselves, so the same games aren't read twice.
 def get_files(path:str):
     databases = []
     for root, directories, files in os.walk(path, topdown=False):
 	    for name in files:
-		    if ( ".pgn" in name) and ("bz2" not in name): databases.append(os.path.join(root, name))
+		    if ( ".pgn" in name): databases.append(os.path.join(root, name))
 	    for name in directories:
-		    if ( ".pgn" in name) and ("bz2" not in name): databases.append(os.path.join(root, name))
-    return databases
+		    if ( ".pgn" in name): databases.append(os.path.join(root, name))
+    return [database for database in databases if not (is_compressed(database) and os.path.splitext(database)[0] in databases)]
+
+# returns whether a pgn file is compressed
+def is_compressed(pgn:str):
+    return os.path.splitext(pgn)[1] in COMPRESSED_EXTENSIONS
+
+# opens a pgn file for reading bytes, decompressing it on the fly if it's compressed
+def open_pgn(pgn:str):
+    extension = os.path.splitext(pgn)[1]
+    if extension == ".bz2":
+        return bz2.open(pgn, "rb")
+    elif extension == ".gz":
+        return gzip.open(pgn, "rb")
+    elif extension == ".zst":
+        if zstandard is None:
+            raise ImportError("reading "+pgn+" needs the zstandard package (pip install zstandard)")
+        return zstandard.ZstdDecompressor().stream_reader(open(pgn, "rb"), read_size=READ_BUFFER, closefd=True)
+    return open(pgn, "rb", buffering=READ_BUFFER)
+
+# yields the lines of a pgn file as strs (with "\n" line endings, like open(pgn, "r")).
+# the file is read (and decompressed) READ_BUFFER bytes at a time on a background thread,
+# so decompressing and parsing overlap and a compressed file never has to be unpacked to disk.
+def read_pgn(pgn:str):
+    return iter(PgnReader(pgn))
+
+# the lines of a pgn file, starting start bytes into its (decompressed) text, see read_pgn.
+# keeps track of where in the file the lines are, so reading can be picked back up there later
+class PgnReader:
+    def __init__(self, pgn:str, start:int=0):
+        self.pgn = pgn
+        self.start = start
+        # the lines are yielded a block at a time. where the current block begins,
+        # its bytes and how many of its lines have been yielded
+        self.block_start = start
+        self.block = b""
+        self.lines = 0
+
+    def __iter__(self):
+        blocks = queue.Queue(READ_AHEAD)
+        reader = threading.Thread(target=read_blocks, args=(self.pgn, blocks, self.start), daemon=True)
+        reader.start()
+        leftover = b""
+        while True:
+            block = blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if block is None:
+                break
+            # only decode up to the last full line, a character can be split between blocks
+            data = leftover + block
+            cut = data.rfind(b"\n") + 1
+            leftover = data[cut:]
+            yield from self.read_block(data[:cut])
+        if leftover:
+            yield from self.read_block(leftover)
+
+    def read_block(self, block:bytes):
+        self.block_start += len(self.block)
+        self.block = block
+        self.lines = 0
+        for line in io.StringIO(block.decode(), newline=None):
+            self.lines += 1
+            yield line
+
+    # returns the byte offset just past the last line yielded (or back lines before that)
+    def get_position(self, back:int=0):
+        end = 0
+        for i in range(self.lines - back):
+            end = self.block.find(b"\n", end) + 1
+            if end == 0: # the last line of the file, without a "\n"
+                return self.block_start + len(self.block)
+        return self.block_start + end
+
+# background side of read_pgn: puts the blocks of a pgn file from byte start on blocks,
+# then None when it's done (or the exception that stopped it)
+def read_blocks(pgn:str, blocks, start:int=0):
+    try:
+        with open_pgn(pgn) as f:
+            if start > 0:
+                f.seek(start) # compressed files are decompressed up to start
+            while True:
+                block = f.read(READ_BUFFER)
+                if not block:
+                    break
+                blocks.put(block)
+        blocks.put(None)
+    except Exception as e:
+        blocks.put(e)
+
+# parses one pgn file with a pool of worker processes.
+# the file is split into chunks at game boundaries, every worker writes the games of its chunk
+# to its own shard per bracket, and the shards are appended to out_names in file order,
+# so the csvs come out the same as when the file is parsed in one go.
+# plain files are split by byte range and read by the workers themselves. compressed files can't
+# be seeked in, so they are decompressed here and the workers are handed the text of each chunk.
+# starts start bytes into the (decompressed) file. every time a chunk is merged, save_progress is called
+# with a function that returns the offset just past it. returns the offset the file ended at
+def preprocess_parallel(pgn:str, out_names:list, workers:int, chunk_bytes:int=CHUNK_BYTES, start:int=0,\
+        save_progress=None, scheme:buckets.BucketScheme=None):
+    shard_dir = tempfile.mkdtemp(prefix=".shards-", dir=os.path.dirname(os.path.abspath(pgn)))
+    if is_compressed(pgn):
+        chunks = (((None, None, None, text), chunk_end) for text, chunk_end in get_text_chunks(PgnReader(pgn, start), chunk_bytes))
+    else:
+        chunks = (((pgn, chunk_start, chunk_end, None), chunk_end) for chunk_start, chunk_end in get_chunks(pgn, chunk_bytes, start))
+    end = start
+    # pid -> [bytes, seconds]
+    worker_stats = {}
+    # chunks handed to the pool but not merged yet. kept short so a decompressed
+    # file can't pile up in memory faster than the workers parse it.
+    pending = collections.deque()
+    try:
+        with writer.get_pool(workers) as pool:
+            for i, (chunk, chunk_end) in enumerate(chunks):
+                task = chunk + (os.path.join(shard_dir, str(i)), scheme)
+                pending.append((pool.apply_async(preprocess_chunk, (task,)), chunk_end))
+                if len(pending) >= 2 * workers:
+                    end = merge_chunk(pending.popleft(), out_names, worker_stats, save_progress)
+            while pending:
+                end = merge_chunk(pending.popleft(), out_names, worker_stats, save_progress)
+    finally:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    for pid, (num_bytes, took) in sorted(worker_stats.items()):
+        print("\tworker",pid,"parsed",num_bytes,"bytes at",get_rate(num_bytes, took)/1e6,"MB/sec")
+    return end
+
+# merges the shards of a finished chunk into out_names, adds it to its worker's stats
+# and saves the offset the chunk ends at as progress. returns that offset
+def merge_chunk(chunk:tuple, out_names:list, worker_stats:dict, save_progress=None):
+    result, end = chunk
+    shards, num_bytes, took, pid = result.get()
+    merge_shards(shards, out_names)
+    stats = worker_stats.setdefault(pid, [0, 0.0])
+    stats[0] += num_bytes
+    stats[1] += took
+    if save_progress is not None:
+        save_progress(lambda: end)
+    return end
+
+# groups the lines of a PgnReader into strs of about chunk_bytes characters that begin at an "[Event " line.
+# yields (text, the byte offset the text ends at) pairs
+def get_text_chunks(reader, chunk_bytes:int):
+    chunk = []
+    size = 0
+    for line in reader:
+        if size >= chunk_bytes and line.startswith("[Event "):
+            yield "".join(chunk), reader.get_position(1)
+            chunk = []
+            size = 0
+        chunk.append(line)
+        size += len(line)
+    if chunk:
+        yield "".join(chunk), reader.get_position()
+
+# splits a pgn file from byte start on into (start, end) byte ranges of about chunk_bytes
+# that begin at an "[Event " line
+def get_chunks(pgn:str, chunk_bytes:int, start:int=0):
+    size = os.path.getsize(pgn)
+    starts = [start]
+    with open(pgn, "rb") as f:
+        while starts[-1] + chunk_bytes < size:
+            f.seek(starts[-1] + chunk_bytes)
+            f.readline() # most likely the middle of a line
+            start = None
+            while True:
+                pos = f.tell()
+                line = f.readline()
+                if not line:
+                    break
+                if line.startswith(b"[Event "):
+                    start = pos
+                    break
+            if start is None:
+                break
+            starts.append(start)
+    ends = starts[1:] + [size]
+    return list(zip(starts, ends))
+
+# worker side of preprocess_parallel: parses the games in bytes start to end of a pgn file
+# (or in text, for compressed files) into one shard per bucket named shard_prefix-<bucket number>.
+# buckets without games in the chunk get no shard.
+# returns the shard names, the number of bytes, how long it took and the worker's pid
+def preprocess_chunk(task:tuple):
+    pgn, start, end, text, shard_prefix, scheme = task
+    began = time.time()
+    if scheme is None:
+        scheme = buckets.BucketScheme()
+    shards = [shard_prefix+"-"+str(i) for i in range(len(scheme.names))]
+    out_names = open_all(shards)
+    if text is None:
+        preprocess(read_lines(pgn, start, end), out_names, scheme=scheme)
+        num_bytes = end - start
+    else:
+        preprocess(io.StringIO(text), out_names, scheme=scheme)
+        num_bytes = len(text)
+    clean_up(out_names)
+    return shards, num_bytes, time.time() - began, os.getpid()
+
+# yields the lines in bytes start to end of a file as strs (with "\n" line endings, like open(pgn, "r"))
+def read_lines(pgn:str, start:int, end:int):
+    with open(pgn, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line.decode().replace("\r\n", "\n")
+
+# appends each shard to its out_name and deletes it
+def merge_shards(shards:list, out_names:list):
+    for shard, out_name in zip(shards, out_names):
+        if not os.path.exists(shard): # no games in the bucket
+            continue
+        with open(shard, "r") as f:
+            shutil.copyfileobj(f, out_name, 1024 * 1024)
+        os.remove(shard)
+
+# returns things per second, or 0 if no time has passed
+def get_rate(count:int, seconds:float):
+    if seconds <= 0:
+        return 0
+    return count / seconds
 
 # do the processing line-by-line.
-def preprocess(pgns, out_names:list):
+# save_progress (if given) is called after every game that's written.
+# out_names has a file per bucket of scheme (the rating brackets by default)
+def preprocess(pgns, out_names:list, save_progress=None, scheme:buckets.BucketScheme=None):
+    if scheme is None:
+        scheme = DEFAULT_SCHEME
+    for moves, result, avg_elo, time_control in iter_games(pgns):
+        store_game(moves, result, avg_elo, out_names, scheme, time_control)
+        if save_progress is not None:
+            save_progress()
+
+# reads the games out of the lines of pgn files.
+# yields (moves, result, avg_elo, time_control) for every game, right after its moves line is read
+def iter_games(pgns):
     result = avg_elo = white_elo = 0 # 1 if white win, 0 if draw, 2 if black win
+    time_control = "?"
     for line in pgns:
         if line.startswith("[R"): #Result
             quote_val = match_quotes(line)
@@ -67,21 +410,19 @@ def preprocess(pgns, out_names:list):
             black_elo = elo_to_int(quote_val)
             # we can assume white's elo is already known because of the PGN format
             avg_elo = get_avg_elo(white_elo, black_elo)
+        elif line.startswith("[TimeC"): #TimeControl
+            time_control = match_quotes(line)
         elif line.startswith("1."): # Moves
             moves = line[:-5].strip()
             #print(moves)
-            store_game(moves, result, avg_elo, out_names)
-
-# store games in different files depending on array brackets
-def store_game(moves:str, result:int, avg_elo:int, out_names:list):
-    if avg_elo < 1000:
-        out_names[0].write(str(moves)+","+str(result)+"\n")
-    elif avg_elo < 1500:
-        out_names[1].write(str(moves)+","+str(result)+"\n")
-    elif avg_elo < 2000:
-        out_names[2].write(str(moves)+","+str(result)+"\n")
-    else:
-        out_names[3].write(str(moves)+","+str(result)+"\n")
+            yield moves, result, avg_elo, time_control
+            time_control = "?"
+
+# store games in different files depending on their bucket (see buckets.BucketScheme)
+def store_game(moves:str, result:int, avg_elo:int, out_names:list, scheme:buckets.BucketScheme=None, time_control:str="?"):
+    if scheme is None:
+        scheme = DEFAULT_SCHEME
+    out_names[scheme.get_bucket(avg_elo, time_control)].write(str(moves)+","+str(result)+"\n")
 
 # clean up files.
 def clean_up(open_files:list):
@@ -96,7 +437,7 @@ def get_avg_elo(elo1:int, elo2:int):
         return elo2
     if (elo2 == 0):
         return elo1
-    return np.divide(np.add(elo1, elo2), 2)
+    return (elo1 + elo2) / 2
 
 # cleans up the elo value. returns an int.
 # Who decided it was a good idea to include the "?" for unsure elos in the pgn?
@@ -122,14 +463,14 @@ def get_result(quote_val:str):
     else: #black win
         return 2
 
-# helpful regex for line processing
+# returns what's between the first and last quote of a line
 def match_quotes(line:str):
-    return re.search("\"(.)*\"", line).group(0)[1:-1]
+    return line[line.index('"') + 1:line.rindex('"')]
 
 # can call this from the commandline with preprocess.py <path-to-databases-directory>
 # but processing will probably call this too.
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("USEAGE: python preprocess.py <path-to-databases-directory>")
+    if len(sys.argv) < 2:
+        print("USEAGE: python preprocess.py <path-to-databases-directory> [--workers N] [--chunk-mb N] [--format csv|npy] [--restart] [--buckets SCHEME] [--write-buffer BYTES] [--fsync]")
     else:
         main(sys.argv[1:])
@@ -7,19 +7,111 @@ import time
 import re
 import sys
 import os
+import collections
+import itertools
+import argparse
+import functools
+import cProfile
+import array
+import json
+import columnar
+import checkpoint
+import buckets
+import openingboard
+import openingtree
+import writer
+import preprocess
 
 # extracts features and build csvs from them.
 # output format: when_castled,num_center_squares_controlled,material_difference,num_unique_pieces_moved,win
+# (with more than one horizon for a feature, it gets a column per horizon, see get_feature_columns)
+
+# number of games read from a csv (and handed to a worker process) at a time
+CHUNK_SIZE = 5000
+# bytes open_csv reads at a time to skip the rows a csv was already read up to
+SKIP_BYTES = 1024 * 1024
+
+# d4, e4, d5 and e5
+BB_CENTER = chess.BB_D4 | chess.BB_E4 | chess.BB_D5 | chess.BB_E5
+# how many moves into the game each feature is taken
+UNIQUE_PIECES_MOVES = 7
+MATERIAL_MOVES = 4
+CENTER_MOVES = 5
+# the horizons extract_features takes the features at by default.
+# every feature can be taken at any number of horizons (in moves), all from the same replay
+HORIZONS = {"unique": [UNIQUE_PIECES_MOVES], "material": [MATERIAL_MOVES], "center": [CENTER_MOVES]}
+# the FEATURES column of each feature
+FEATURE_COLUMNS = {"center": "num_center_squares_controlled", "material": "material_difference",\
+    "unique": "num_unique_pieces_moved"}
+
+# one token of movetext. group 1 is either a ply, "(" or ")". comments, move numbers, NAGs and
+# results are matched without it so they get skipped, and annotation marks never match at all.
+# anything else is a ply, even if it isn't a move (like a null move), check_game decides that
+MOVETEXT_TOKEN = re.compile(r"\{[^}]*\}|;[^\n]*|\$\d+|\d+\.+|(?:1-0|0-1|1/2(?:-1/2)?|\*)(?![^\s(){};])|([()]|[^\s(){};$!?.][^\s(){};$!?]*)")
+
+# a ply check_game lets through to python-chess: castling or anything chess.SAN_REGEX reads (which
+# takes long algebraic and a few other deviations too, like python-chess does). null moves ("--", "Z0", ...)
+# python-chess would play as well, but a game with one isn't a game features can be taken from, so
+# iter_plies hands them over like any other ply and they don't match
+SAN_MOVE = re.compile(r"(?:O-O(?:-O)?|0-0(?:-0)?)[\+#]?\Z|" + chess.SAN_REGEX.pattern.lstrip("^"))
+
+# default number of positions the opening cache of each process holds
+OPENING_CACHE_SIZE = 50000
+# the opening cache of this process, see set_opening_cache
+opening_cache = None
+
+# the characters a move in SAN can start with, iter_plies only looks closer at tokens that start with something else
+SAN_FIRST_CHARS = "abcdefghKQRBNO"
+# the results movetext can end with
+RESULTS = ("1-0", "0-1", "1/2-1/2", "1/2", "*")
+
+# the pieces that count towards center control
+CENTER_PIECE_TYPES = [chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.QUEEN]
+
+# where iterate_csvs keeps track of how far it got, see checkpoint.py
+MANIFEST = ".process-manifest.json"
+
+# the reasons games are quarantined for (see extract_game). a quarantined game still gets its two
+# rows of -1s in FEATURES, so the rows keep lining up with the games of the GAMES file
+BAD_RESULT = "bad_result"           # the result isn't 0, 1 or 2
+NO_MOVES = "no_moves"               # no moves could be read from the movetext
+UNREADABLE_MOVE = "unreadable_move" # one of the plies the features are taken from isn't a move (see SAN_MOVE)
+ILLEGAL_MOVE = "illegal_move"       # one of them can't be played where it is
+LEGACY_COMMENTS = "legacy_comments" # --legacy only: the movetext has a '%' in it
+LEGACY_SPLIT = "legacy_split"       # --legacy only: get_moves_ar couldn't split the movetext
+# the columns of a bucket's QUARANTINE csv: the game's number in the GAMES file, the reason, and the game
+QUARANTINE_COLUMNS = ["game", "reason", "result", "moves"]
+# how many games of every bucket were quarantined and why, written next to the FEATURES files
+QUARANTINE_SUMMARY = "quarantine.json"
+
+# default number of seconds between progress reports
+PROGRESS_SECONDS = 60
+# the functions extract_features spends its time in, timed by --profile
+PROFILED_FUNCTIONS = ["extract_game", "check_game", "get_moves_ar", "replay_horizons", "push_ply",\
+    "evaluate_material_difference", "evaluate_material_difference_legacy",\
+    "evaluate_num_center_squares_controlled", "evaluate_num_center_squares_controlled_legacy",\
+    "extract_when_castled", "extract_when_castled_w", "extract_when_castled_b"]
+# the FeatureProfiler of this process, see set_profiler
+feature_profiler = None
+# the cProfile.Profile of process_games in this process and where it's saved, see set_hot_loop_profile
+hot_loop_profile = None
+hot_loop_profile_path = None
 
 # main program entry
 def main(args:list):
     start = time.time()
-    path = str(args[0])
-    csvs = get_csvs(path)
+    args = get_args(args)
+    path = str(args.path)
+    csvs = buckets.get_files(path, "GAMES", args.format)
     print("processing",len(csvs),"csvs:")
-    for csv in csvs:
+    for bucket, csv in csvs:
         print("\t",csv)
-    iterate_csvs(csvs, path)
+    set_profiler(args.profile)
+    set_hot_loop_profile(args.cprofile)
+    writer.set_buffering(args.write_buffer, args.fsync)
+    horizons = {"unique": args.unique_moves, "material": args.material_moves, "center": args.center_moves}
+    iterate_csvs(csvs, path, args.workers, args.chunk_size, args.legacy, args.cache_size, args.format, args.restart,\
+        args.progress, horizons, args.tree)
     end = time.time() - start
     print("Done. Took",end,"seconds.")
 
@@ -34,63 +126,735 @@ def open_all(out_names:list):
 
     return files
 
-def process(csv, data, out):
-    # data: the data in CSV:
-    # |moves|result|
-    for i, game in data.iterrows():
-        result = int(game[1])
-        moves = str(game[0])
-        when_castled_w, when_castled_b,\
-        num_center_squares_controlled_w, num_center_squares_controlled_b,\
-        material_difference,\
-        extract_num_unique_pieces_moved_w, extract_num_unique_pieces_moved_b\
-        = extract_features(moves, result)
-        save_game(out, result,  when_castled_w, when_castled_b,\
-            num_center_squares_controlled_w, num_center_squares_controlled_b,\
-            material_difference,\
-            extract_num_unique_pieces_moved_w, extract_num_unique_pieces_moved_b)
+# reads the commandline args
+def get_args(args:list):
+    parser = argparse.ArgumentParser(description="extracts features from the GAMES csvs in a directory")
+    parser.add_argument("path", help="path to the csvs directory")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes to extract features with")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="number of games to read at a time")
+    parser.add_argument("--legacy", action="store_true", help="use the original movetext splitter and str(board) evaluators to reproduce old FEATURES files")
+    parser.add_argument("--cache-size", type=int, default=OPENING_CACHE_SIZE, help="number of opening positions each process caches (0 turns the cache off)")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv", help="format of the GAMES files to read and the FEATURES files to write")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoints of earlier runs and process everything again")
+    parser.add_argument("--progress", type=float, default=PROGRESS_SECONDS, help="seconds between progress reports (0 turns them off)")
+    parser.add_argument("--profile", action="store_true", help="time the functions extract_features calls and report them with the progress")
+    parser.add_argument("--cprofile", help="save a cProfile of the feature extraction loop here (with .<pid> added for each worker)")
+    parser.add_argument("--unique-moves", type=parse_horizons, default=HORIZONS["unique"], help="comma separated moves to count unique pieces moved at")
+    parser.add_argument("--material-moves", type=parse_horizons, default=HORIZONS["material"], help="comma separated moves to take the material difference at")
+    parser.add_argument("--center-moves", type=parse_horizons, default=HORIZONS["center"], help="comma separated moves to count center control at")
+    parser.add_argument("--write-buffer", type=int, default=writer.WRITE_BUFFER, help="bytes every FEATURES file buffers before a background thread writes them (0 writes them right away)")
+    parser.add_argument("--fsync", action="store_true", help="sync every buffer to disk once it's written, not only at checkpoints")
+    parser.add_argument("--tree", action="store_true", help="build the opening tree analyze.py --tree reads (see openingtree.py)")
+    return parser.parse_args(args)
+
+# turns "4,8,12" into a sorted list of distinct horizons
+def parse_horizons(text:str):
+    horizons = sorted({int(k) for k in text.split(",")})
+    if not horizons or horizons[0] < 1:
+        raise argparse.ArgumentTypeError("horizons must be positive numbers of moves")
+    return horizons
+
+# returns the FEATURES columns for horizons: a feature with one horizon keeps its plain column name,
+# one with more gets a column per horizon named <column>_<moves>
+def get_feature_columns(horizons:dict):
+    columns = ["when_castled"]
+    for feature in ["center", "material", "unique"]:
+        if len(horizons[feature]) == 1:
+            columns.append(FEATURE_COLUMNS[feature])
+        else:
+            columns += [FEATURE_COLUMNS[feature]+"_"+str(k) for k in horizons[feature]]
+    return columns + ["win"]
+
+# save_progress (if given) is called with the number of games done after every chunk,
+# and progress (a Progress, if given) is updated. skipped games go to quarantine (a Quarantine, if given)
+# and every game to tree (an openingtree.OpeningTree, if given).
+# returns the number of games
+def process(csv, data, out, legacy:bool=False, file_format:str="csv", save_progress=None, progress=None, horizons:dict=None,\
+        quarantine=None, tree=None):
+    # data: chunks of (moves, result) pairs from the CSV, see read_games
+    num_games = 0
+    skipped = 0
+    for games in data:
+        skipped += process_games(games, out, legacy, file_format, horizons, quarantine, tree)
+        num_games += len(games)
+        if save_progress is not None:
+            save_progress(num_games)
+        if progress is not None:
+            progress.update(num_games, skipped, get_profile_stats())
+    return num_games
+
+# extract the features of every chunk of games in data with a pool of worker processes.
+# the rows are written back in the original order as soon as each chunk is done,
+# along with the games of it that were quarantined (to quarantine, a Quarantine, if given),
+# then save_progress (if given) is called with the number of games written so far
+# and progress (a Progress, if given) is updated. the workers also add the games of their
+# chunks to trees that are merged into tree (an openingtree.OpeningTree, if given).
+# the workers profile the same way this process does (see set_profiler and set_hot_loop_profile).
+# returns the number of games
+def process_parallel(csv, data, out, workers:int, legacy:bool=False, cache_size:int=OPENING_CACHE_SIZE,\
+        file_format:str="csv", save_progress=None, progress=None, horizons:dict=None, quarantine=None, tree=None):
+    start = time.time()
+    total_games = 0
+    skipped = 0
+    # pid -> [games, seconds, opening cache stats, profile stats]
+    worker_stats = {}
+    # every worker gets its own opening cache
+    with writer.get_pool(workers, init_worker, (cache_size, feature_profiler is not None, hot_loop_profile_path)) as pool:
+        for chunk in run_chunks(pool, data, workers, legacy, file_format, horizons, tree is not None):
+            num_games, num_skipped = write_chunk(chunk, out, worker_stats, quarantine, tree)
+            total_games += num_games
+            skipped += num_skipped
+            if save_progress is not None:
+                save_progress(total_games)
+            if progress is not None:
+                progress.update(total_games, skipped, merge_profile_stats(stats[3] for stats in worker_stats.values()))
+    end = time.time() - start
+    for pid, (num_games, took, cache_stats, profile_stats) in sorted(worker_stats.items()):
+        print("\tworker",pid,"extracted",num_games,"games at",preprocess.get_rate(num_games, took),"games/sec")
+        if cache_stats is not None:
+            print("\t\topening cache:",cache_stats)
+    print("\textracted",total_games,"games in",end,"seconds at",preprocess.get_rate(total_games, end),"games/sec")
+    if feature_profiler is not None:
+        print_profile(merge_profile_stats(stats[3] for stats in worker_stats.values()))
+    return total_games
+
+# writes the rows of a finished chunk to out (its quarantined games to quarantine and its
+# opening tree to tree, if given) and adds it to its worker's stats.
+# returns the number of games in the chunk and how many of them were skipped
+def write_chunk(chunk:tuple, out, worker_stats:dict, quarantine=None, tree=None):
+    rows, num_games, quarantined, took, pid, cache_stats, profile_stats, chunk_tree = chunk
+    out.write(rows)
+    if quarantine is not None:
+        quarantine.write(num_games, quarantined)
+    if tree is not None:
+        tree.merge(chunk_tree)
+    stats = worker_stats.setdefault(pid, [0, 0.0, None, None])
+    stats[0] += num_games
+    stats[1] += took
+    stats[2] = cache_stats # the counters are totals already
+    stats[3] = profile_stats # so are these
+    return num_games, len(quarantined)
+
+# hands the chunks of games in data to the workers of pool and yields the finished chunks in order
+def run_chunks(pool, data, workers:int, legacy:bool=False, file_format:str="csv", horizons:dict=None, tree:bool=False):
+    # chunks handed to the pool but not written yet. kept short so that
+    # the reader can't run ahead of the workers and fill up memory.
+    pending = collections.deque()
+    for games in data:
+        pending.append(pool.apply_async(process_chunk, (games, legacy, file_format, horizons, tree)))
+        if len(pending) >= 2 * workers:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+# sets up a process_parallel worker: its opening cache and whether it profiles
+def init_worker(cache_size:int, profile:bool, cprofile_path:str):
+    set_opening_cache(cache_size)
+    set_profiler(profile)
+    if cprofile_path is not None:
+        cprofile_path = cprofile_path+"."+str(os.getpid())
+    set_hot_loop_profile(cprofile_path)
+
+# worker side of process_parallel: extracts the features of a chunk of games.
+# returns the rows (csv text or a FEATURES .npy array, see columnar.get_features_dtype), the number of games, the
+# games that were quarantined (see extract_block), how long it took, the worker's pid, the worker's opening cache stats,
+# its profile stats (see get_profile_stats) and, if tree, an openingtree.OpeningTree of the games (None otherwise)
+def process_chunk(games:list, legacy:bool=False, file_format:str="csv", horizons:dict=None, tree:bool=False):
+    start = time.time()
+    columns = get_feature_columns(horizons or HORIZONS)
+    block = FeatureBlock(columns)
+    chunk_tree = openingtree.OpeningTree(columns[:-1]) if tree else None
+    quarantined = extract_block(games, block, legacy, horizons, chunk_tree)
+    if file_format == "npy":
+        rows = block.get_array()
+    else:
+        rows = block.get_text()
+    return rows, len(games), quarantined, time.time() - start, os.getpid(), get_cache_stats(), get_profile_stats(), chunk_tree
+
+# reads a GAMES csv (or .npy) from game start on, chunk_size rows at a time so the whole file
+# is never in memory. yields lists of (moves, result) pairs
+def read_games(csv:str, chunk_size:int=CHUNK_SIZE, start:int=0):
+    yield from GamesReader(csv, chunk_size, start)
+
+# the games of a GAMES csv (or .npy), see read_games. keeps track of how much of the file has
+# been read, so progress can be told without counting the games of the file first
+class GamesReader:
+    def __init__(self, csv:str, chunk_size:int=CHUNK_SIZE, start:int=0):
+        self.csv = csv
+        self.chunk_size = chunk_size
+        self.start = start
+        self.position = 0.0
+
+    def __iter__(self):
+        if self.csv.endswith(".npy"):
+            total = count_games(self.csv) # only reads the header
+            games = self.start
+            for chunk in columnar.read_games(self.csv, self.chunk_size, self.start):
+                games += len(chunk)
+                self.position = games / total
+                yield chunk
+            return
+        size = max(os.path.getsize(self.csv), 1)
+        f, columns = open_csv(self.csv, self.start)
+        with f:
+            for data in pd.read_csv(f, chunksize=self.chunk_size, header=None, names=columns):
+                # how far the parser has read, which is at most its buffer ahead of the games
+                self.position = min(f.tell() / size, 1.0)
+                yield get_games(data)
+
+    # returns how much of the file has been read, from 0 to 1
+    def get_progress(self):
+        return self.position
+
+# yields the columns of a FEATURES csv or .npy file chunk_size rows at a time
+def read_features(features:str, chunk_size:int, start:int=0):
+    if features.endswith(".npy"):
+        yield from columnar.read_npy(features, chunk_size, start)
+        return
+    f, columns = open_csv(features, start)
+    with f:
+        for data in pd.read_csv(f, chunksize=chunk_size, header=None, names=columns):
+            yield {column: data[column].to_numpy() for column in data.columns}
+
+# opens a csv (in binary) past its header and its first rows rows, and returns it with its column names.
+# the rows are skipped by counting line ends SKIP_BYTES at a time, so it takes no memory however many there are
+def open_csv(path:str, rows:int=0):
+    f = open(path, "rb")
+    columns = f.readline().decode().strip().split(",")
+    while rows > 0:
+        start = f.tell()
+        block = f.read(SKIP_BYTES)
+        if not block:
+            break
+        count = block.count(b"\n")
+        if count < rows:
+            rows -= count
+            continue
+        end = -1
+        for i in range(rows):
+            end = block.index(b"\n", end + 1)
+        f.seek(start + end + 1)
+        rows = 0
+    return f, columns
+
+# turns the data in a GAMES csv into a list of (moves, result) pairs
+def get_games(data):
+    return list(zip(data.iloc[:,0].astype(str), data.iloc[:,1].astype(int)))
+
+# extract the features of (moves, result) pairs and write them to out
+# (a text file for csv, or anything with write() for arrays, like a columnar.NpyWriter, for npy)
+# and the games that were skipped to quarantine (a Quarantine, if given). every game is added to tree
+# (an openingtree.OpeningTree, if given).
+# returns how many games were skipped (written as -1s)
+def process_games(games:list, out, legacy:bool=False, file_format:str="csv", horizons:dict=None, quarantine=None, tree=None):
+    block = FeatureBlock(get_feature_columns(horizons or HORIZONS))
+    quarantined = extract_block(games, block, legacy, horizons, tree)
+    block.write(out, file_format)
+    if quarantine is not None:
+        quarantine.write(len(games), quarantined)
+    return len(quarantined)
+
+# extract the features of (moves, result) pairs into a FeatureBlock (and add them to tree, an
+# openingtree.OpeningTree, if given).
+# returns the games that were skipped (given -1s) as (index in games, reason, result, moves) tuples
+def extract_block(games:list, block, legacy:bool=False, horizons:dict=None, tree=None):
+    quarantined = []
+    profile = hot_loop_profile
+    if profile is not None:
+        profile.enable()
+    for index, (moves, result) in enumerate(games):
+        reason, features, opening = extract_game(moves, result, legacy, horizons)
+        if reason is not None:
+            quarantined.append((index, reason, result, moves))
+        block.append(features, result)
+        if tree is not None:
+            tree.add_game(opening, result, features)
+    if profile is not None:
+        profile.disable()
+        profile.dump_stats(hot_loop_profile_path)
+    return quarantined
 
 # extract the features we want.
-def extract_features(moves:str, result:int):
-    if '%' in moves:
-        return -1, -1, -1, -1, -1, -1, -1
-    moves_ar = get_moves_ar(moves)
-    if moves_ar[0] == "bad game":
-        return -1, -1, -1, -1, -1, -1, -1
+# legacy reads the moves with get_moves_ar and skips every game with a '%' in it, like the original
+# horizons are the moves each board feature is taken at (HORIZONS by default).
+# returns GameFeatures, skipped games get -1 for every value.
+def extract_features(moves:str, result:int, legacy:bool=False, horizons:dict=None):
+    return extract_game(moves, result, legacy, horizons)[1]
+
+# extract_features, also saying why a game was skipped and where its board features were taken.
+# returns (reason, GameFeatures, opening): reason is None, or one of the reasons above for a skipped game,
+# and opening is the tuple of plies the board features were taken after (see get_opening), None for a skipped game
+def extract_game(moves:str, result:int, legacy:bool=False, horizons:dict=None):
+    if horizons is None:
+        horizons = HORIZONS
+    reason, moves_ar, plies = check_game(moves, result, legacy, 2 * get_max_horizon(horizons))
+    if reason is not None:
+        return reason, get_skipped_features(horizons), None
     # extract the features
-    # (this takes the vast majority of runtime)
-    num_unique_pieces_moved_w = extract_num_unique_pieces_moved_w(moves_ar,7)
-    num_unique_pieces_moved_b = extract_num_unique_pieces_moved_b(moves_ar,7)
-    when_castled_w = extract_when_castled_w(moves_ar)
-    when_castled_b = extract_when_castled_b(moves_ar)
-    material_difference = extract_material_difference(moves_ar, 4) # material difference k moves in.
-    num_center_squares_controlled_w, num_center_squares_controlled_b = extract_num_center_squares_controlled(moves_ar, 5)
+    # (this takes the vast majority of runtime, so the game is only replayed once)
+    opening = tuple(itertools.chain.from_iterable(moves_ar))[:2 * get_max_horizon(horizons)]
+    features = replay_horizons(moves_ar, horizons, legacy)
+    if features is None:
+        return ILLEGAL_MOVE, get_skipped_features(horizons), None
+    material_difference,\
+    num_center_squares_controlled_w, num_center_squares_controlled_b,\
+    num_unique_pieces_moved_w, num_unique_pieces_moved_b = features
+    if legacy:
+        when_castled_w = extract_when_castled_w(moves_ar)
+        when_castled_b = extract_when_castled_b(moves_ar)
+    else:
+        when_castled_w, when_castled_b = extract_when_castled(plies)
     # return the features
-    return when_castled_w, when_castled_b,\
+    return None, GameFeatures(when_castled_w, when_castled_b,\
         num_center_squares_controlled_w, num_center_squares_controlled_b,\
         material_difference,\
-        num_unique_pieces_moved_w, num_unique_pieces_moved_b
+        num_unique_pieces_moved_w, num_unique_pieces_moved_b), opening
 
-# save the game to out in a csv format
-# when_castled,num_center_squares_controlled,material_difference,num_unique_pieces_moved,win
-# outputs 2 lines, one for white's features and one for black's features
-def save_game(out, result,  when_castled_w, when_castled_b,\
-        num_center_squares_controlled_w, num_center_squares_controlled_b,\
-        material_difference,\
-        num_unique_pieces_moved_w, num_unique_pieces_moved_b):
-    # win corresponds to if a COLOR wins, so we have to change this depending on which color is saved
-    win = 0
-    if int(result) == 1:
-        win = 1
-    white_print = str(when_castled_w)+","+str(num_center_squares_controlled_w)+","+str(material_difference)+","+str(num_unique_pieces_moved_w)+","+str(win)+"\n"
-    out.write(white_print)
-    win = 0
-    if int(result) == 2:
-        win = 1
-    black_print = str(when_castled_b)+","+str(num_center_squares_controlled_b)+","+str(material_difference)+","+str(num_unique_pieces_moved_b)+","+str(win)+"\n"
-    out.write(black_print)
+# checks a game before it's replayed, without a board: its result and the first num_plies plies,
+# the ones features are taken from. so the only thing left that can go wrong in the replay is a move
+# that reads fine but can't be played there, and that stops it at once (see replay_horizons).
+# returns (reason, moves_ar, plies): reason is None, or why the game has to be skipped.
+# moves_ar holds the first num_plies plies as turns (see get_turns), or all of them with legacy,
+# and plies yields every ply of the game (None with legacy)
+def check_game(moves:str, result:int, legacy:bool, num_plies:int):
+    if result != 0 and result != 1 and result != 2:
+        return BAD_RESULT, None, None
+    if legacy:
+        if '%' in moves:
+            return LEGACY_COMMENTS, None, None
+        moves_ar = get_moves_ar(moves)
+        if moves_ar[0] == "bad game":
+            return LEGACY_SPLIT, None, None
+        opening = tuple(itertools.chain.from_iterable(moves_ar))[:num_plies]
+        plies = None
+    else:
+        # only the opening is turned into a list, the rest of the game is left to the tokenizer
+        rest = iter_plies(moves)
+        opening = list(itertools.islice(rest, num_plies))
+        if len(opening) == 0:
+            return NO_MOVES, None, None
+        moves_ar = get_turns(opening)
+        plies = itertools.chain(opening, rest)
+    is_move = SAN_MOVE.match
+    for san in opening:
+        if is_move(san) is None:
+            return UNREADABLE_MOVE, None, None
+    return None, moves_ar, plies
+
+# returns what extract_features gives for a game it skips
+def get_skipped_features(horizons:dict):
+    center = (-1,) * len(horizons["center"])
+    unique = (-1,) * len(horizons["unique"])
+    return GameFeatures(-1, -1, center, center, (-1,) * len(horizons["material"]), unique, unique)
+
+# returns the furthest horizon of any feature, in moves
+def get_max_horizon(horizons:dict):
+    return max(max(ks) for ks in horizons.values())
+
+# the features extract_features takes from a game.
+# the board features are tuples with a value per horizon
+class GameFeatures:
+    __slots__ = ("when_castled_w", "when_castled_b",\
+        "num_center_squares_controlled_w", "num_center_squares_controlled_b",\
+        "material_difference",\
+        "num_unique_pieces_moved_w", "num_unique_pieces_moved_b")
+
+    def __init__(self, when_castled_w:int, when_castled_b:int,\
+            num_center_squares_controlled_w:tuple, num_center_squares_controlled_b:tuple,\
+            material_difference:tuple,\
+            num_unique_pieces_moved_w:tuple, num_unique_pieces_moved_b:tuple):
+        self.when_castled_w = when_castled_w
+        self.when_castled_b = when_castled_b
+        self.num_center_squares_controlled_w = num_center_squares_controlled_w
+        self.num_center_squares_controlled_b = num_center_squares_controlled_b
+        self.material_difference = material_difference
+        self.num_unique_pieces_moved_w = num_unique_pieces_moved_w
+        self.num_unique_pieces_moved_b = num_unique_pieces_moved_b
+
+# the FEATURES rows of many games, two per game (one for white's features and one for black's, see
+# get_feature_columns), kept as one flat array of small ints and written out in one go
+class FeatureBlock:
+    __slots__ = ("columns", "values")
+
+    def __init__(self, columns:list):
+        self.columns = columns
+        self.values = array.array("h")
+
+    # adds the rows of a game's GameFeatures
+    def append(self, features, result:int):
+        values = self.values
+        # win corresponds to if a COLOR wins, so it's different in white's and black's rows
+        values.append(features.when_castled_w)
+        values.extend(features.num_center_squares_controlled_w)
+        values.extend(features.material_difference)
+        values.extend(features.num_unique_pieces_moved_w)
+        values.append(1 if result == 1 else 0)
+        values.append(features.when_castled_b)
+        values.extend(features.num_center_squares_controlled_b)
+        values.extend(features.material_difference)
+        values.extend(features.num_unique_pieces_moved_b)
+        values.append(1 if result == 2 else 0)
+
+    def __len__(self):
+        return len(self.values) // len(self.columns)
+
+    # returns the rows as csv lines
+    def get_text(self):
+        return ((",".join(["%d"] * len(self.columns)) + "\n") * len(self)) % tuple(self.values)
+
+    # returns the rows as a FEATURES .npy array (see columnar.get_features_dtype)
+    def get_array(self):
+        values = np.frombuffer(self.values, dtype=np.int16).reshape(-1, len(self.columns))
+        rows = np.empty(len(values), dtype=columnar.get_features_dtype(self.columns))
+        for i, column in enumerate(self.columns):
+            rows[column] = values[:, i]
+        return rows
+
+    # writes the rows to out (a text file for csv, or anything with write() for arrays for npy) and empties the block
+    def write(self, out, file_format:str="csv"):
+        if len(self.values) > 0:
+            if file_format == "npy":
+                out.write(self.get_array())
+            else:
+                out.write(self.get_text())
+        self.values = array.array("h")
+
+# replays the game a single time and takes every board feature from it, so SAN parsing
+# and move generation happen once per game instead of once per feature.
+# k_unique, k_material and k_center are the same horizons the extract_* functions take.
+# returns material_difference, num_center_squares_controlled_w, num_center_squares_controlled_b,
+# num_unique_pieces_moved_w, num_unique_pieces_moved_b or None if a move could not be played
+def replay_features(moves_ar:list, k_unique:int, k_material:int, k_center:int, legacy:bool=False):
+    features = replay_horizons(moves_ar, {"unique": [k_unique], "material": [k_material], "center": [k_center]}, legacy)
+    if features is None:
+        return None
+    return tuple(values[0] for values in features)
+
+# replay_features for any number of horizons per feature (see HORIZONS), still in one replay.
+# positions already in the opening cache are not replayed again (see OpeningCache).
+# returns the same features as replay_features as tuples with a value per horizon, or None.
+# the replay stops at the first move python-chess refuses, which for games check_game let
+# through can only be a move that reads fine but is illegal where it's played
+def replay_horizons(moves_ar:list, horizons:dict, legacy:bool=False):
+    plies = tuple(itertools.chain.from_iterable(moves_ar))[:2 * get_max_horizon(horizons)]
+    # the same positions sim_board(moves_ar, k) would give
+    unique_plies = [min(len(plies), 2 * k) for k in horizons["unique"]]
+    material_plies = [min(len(plies), 2 * k) for k in horizons["material"]]
+    center_plies = [min(len(plies), 2 * k) for k in horizons["center"]]
+    # ply -> feature value there
+    unique = {}
+    material = {}
+    center = {}
+    state = new_replay_state()
+    ply = 0
+    try:
+        for target in sorted(set(unique_plies + material_plies + center_plies)):
+            state = replay_to(plies, target, state, ply)
+            ply = target
+            # the board is played on in place, so everything is taken from it right away
+            if ply in unique_plies:
+                unique[ply] = state[2], state[3]
+            if ply in material_plies:
+                material[ply] = evaluate_state(state, "material", legacy)
+            if ply in center_plies:
+                center[ply] = evaluate_state(state, "center", legacy)
+    except (ValueError, IndexError): # illegal or unreadable move
+        return None
+    return tuple(material[ply] for ply in material_plies),\
+        tuple(center[ply][0] for ply in center_plies), tuple(center[ply][1] for ply in center_plies),\
+        tuple(unique[ply][0] for ply in unique_plies), tuple(unique[ply][1] for ply in unique_plies)
+
+# the state of a replay before any moves:
+# (board, moved, num_unique_w, num_unique_b, values) where board is an openingboard.OpeningBoard,
+# moved holds the starting squares on each side's back two ranks that have moved and values holds
+# features already evaluated on board
+def new_replay_state():
+    return openingboard.OpeningBoard(), frozenset(), 0, 0, {}
+
+# advances a replay state of plies from ply to target.
+# with the opening cache on, the position after plies[:target] is looked up first and cached
+# once it has been replayed, so only the positions features are taken from get cached.
+def replay_to(plies:tuple, target:int, state:tuple, ply:int):
+    cache = opening_cache
+    if cache is not None:
+        key = plies[:target]
+        cached = cache.get(key)
+        if cached is not None:
+            cache.hits += 1
+            return cached
+        cache.misses += 1
+        if ply > 0 and ply < target:
+            # the board we're on is cached too, so play on a copy of it
+            state = (state[0].copy(stack=False),) + state[1:]
+    while ply < target:
+        state = push_ply(state, plies, ply)
+        ply += 1
+    if cache is not None:
+        cache.put(key, state)
+    return state
+
+# plays plies[ply] on the board of a replay state and returns the new state
+def push_ply(state:tuple, plies:tuple, ply:int):
+    board, moved, num_unique_w, num_unique_b, values = state
+    san = plies[ply]
+    move = board.push_san(san)
+    if san[0] == '0': # castling written with zeros, counted like "O-O" and "O-O-O"
+        san = san.replace('0', 'O')
+    if ply % 2 == 0:
+        if san.startswith('O'):
+            num_unique_w += 2
+            moved = moved | {chess.E1, chess.H1 if san == "O-O" else chess.A1}
+        elif chess.square_rank(move.from_square) < 2 and move.from_square not in moved:
+            num_unique_w += 1
+            moved = moved | {move.from_square}
+    else:
+        if san.startswith('O'):
+            num_unique_b += 2
+            # extract_num_unique_pieces_moved_b picks the rook by looking at white's move
+            # (it only matters if black moves a piece off that square later); kept as is so
+            # the features don't change.
+            moved = moved | {chess.E8, chess.H8 if plies[ply - 1].replace('0', 'O') == "O-O" else chess.A8}
+        elif chess.square_rank(move.from_square) > 5 and move.from_square not in moved:
+            num_unique_b += 1
+            moved = moved | {move.from_square}
+    return board, moved, num_unique_w, num_unique_b, {}
+
+# evaluates the "material" or "center" feature on the board of a replay state.
+# the value is kept with the state, so cached positions are only evaluated once.
+def evaluate_state(state:tuple, feature:str, legacy:bool):
+    values = state[4]
+    key = (feature, legacy)
+    if key not in values:
+        board = state[0]
+        if feature == "material":
+            if legacy:
+                values[key] = evaluate_material_difference_legacy(board)
+            else:
+                values[key] = evaluate_material_difference(board)
+        elif legacy:
+            values[key] = evaluate_num_center_squares_controlled_legacy(board)
+        else:
+            values[key] = evaluate_num_center_squares_controlled(board)
+    return values[key]
+
+# a bounded (least recently used) cache of replay states keyed by the tuple of plies that led
+# to them, so the openings shared by most games are only replayed (and evaluated) once per process.
+class OpeningCache:
+    def __init__(self, size:int):
+        self.size = size
+        self.states = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # returns the state cached for plies, or None
+    def get(self, plies:tuple):
+        state = self.states.get(plies)
+        if state is not None:
+            self.states.move_to_end(plies)
+        return state
+
+    # caches a state, dropping the least recently used one if the cache is full
+    def put(self, plies:tuple, state:tuple):
+        self.states[plies] = state
+        if len(self.states) > self.size:
+            self.states.popitem(last=False)
+
+    # returns the counters as a printable str
+    def get_stats(self):
+        return str(self.hits)+" hits, "+str(self.misses)+" misses, "+str(len(self.states))+"/"+str(self.size)+" positions cached"
+
+# turns the opening cache of this process on with room for size positions, or off if size is 0.
+# also used as the initializer of process_parallel's workers.
+def set_opening_cache(size:int):
+    global opening_cache
+    if size > 0:
+        opening_cache = OpeningCache(size)
+    else:
+        opening_cache = None
+
+# returns the opening cache's counters as a printable str, or None if it's off
+def get_cache_stats():
+    if opening_cache is None:
+        return None
+    return opening_cache.get_stats()
+
+# times the functions in PROFILED_FUNCTIONS: how often each was called and how long it took in total
+# (including the time spent in the other profiled functions it calls).
+# turning it on swaps timing wrappers in for the functions (see set_profiler), so when it's off
+# they're called directly and it costs nothing.
+class FeatureProfiler:
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.seconds = collections.Counter()
+        # name -> the function that was swapped out
+        self.originals = {}
+
+    # returns function wrapped so its calls are timed under name
+    def wrap(self, name:str, function):
+        calls = self.calls
+        seconds = self.seconds
+        clock = time.perf_counter
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                seconds[name] += clock() - start
+                calls[name] += 1
+        return timed
+
+    # returns {name: (calls, seconds)}
+    def get_stats(self):
+        return {name: (self.calls[name], self.seconds[name]) for name in self.calls}
+
+# turns the feature profiler of this process on or off.
+# also used (through init_worker) for process_parallel's workers.
+def set_profiler(on:bool):
+    global feature_profiler
+    functions = globals()
+    if feature_profiler is not None:
+        functions.update(feature_profiler.originals)
+        feature_profiler = None
+    if on:
+        feature_profiler = FeatureProfiler()
+        for name in PROFILED_FUNCTIONS:
+            feature_profiler.originals[name] = functions[name]
+            functions[name] = feature_profiler.wrap(name, functions[name])
+
+# returns the feature profiler's stats (see FeatureProfiler.get_stats), or None if it's off
+def get_profile_stats():
+    if feature_profiler is None:
+        return None
+    return feature_profiler.get_stats()
+
+# adds up the profile stats of several processes. returns None if there aren't any
+def merge_profile_stats(all_stats):
+    merged = None
+    for stats in all_stats:
+        if stats is None:
+            continue
+        if merged is None:
+            merged = {}
+        for name, (calls, seconds) in stats.items():
+            total_calls, total_seconds = merged.get(name, (0, 0.0))
+            merged[name] = (total_calls + calls, total_seconds + seconds)
+    return merged
+
+# prints profile stats, slowest function first
+def print_profile(stats:dict):
+    if not stats:
+        return
+    for name, (calls, seconds) in sorted(stats.items(), key=lambda item: -item[1][1]):
+        print("\t\t",name+":",calls,"calls,",round(seconds, 3),"seconds,",round(1e6 * seconds / calls, 2),"us/call")
+
+# turns the cProfile of process_games on (saved to path after every chunk of games) or off (path None)
+def set_hot_loop_profile(path:str):
+    global hot_loop_profile, hot_loop_profile_path
+    hot_loop_profile_path = path
+    if path is None:
+        hot_loop_profile = None
+    else:
+        hot_loop_profile = cProfile.Profile()
+
+# prints how far along a csv is every interval seconds: games/sec, the time left at that rate,
+# how many games were skipped and (with --profile) where the time went
+# get_progress returns how much of the csv has been read, from 0 to 1 (see GamesReader.get_progress).
+# the time left is estimated from how fast that went since the first update, which is after the games
+# a resumed run skips
+class Progress:
+    def __init__(self, get_progress, interval:float):
+        self.get_progress = get_progress
+        self.interval = interval
+        self.start = self.last = time.time()
+        # (time, progress) of the first update
+        self.first = None
+
+    # num_games and skipped are totals so far, profile_stats are profile stats or None
+    def update(self, num_games:int, skipped:int, profile_stats:dict=None):
+        now = time.time()
+        if self.first is None:
+            self.first = now, self.get_progress()
+        if self.interval <= 0 or now - self.last < self.interval:
+            return
+        self.last = now
+        rate = preprocess.get_rate(num_games, now - self.start)
+        first_time, first_progress = self.first
+        progress = self.get_progress()
+        if progress > first_progress:
+            eta = str(round((1 - progress) * (now - first_time) / (progress - first_progress)))+" seconds"
+        else:
+            eta = "unknown"
+        print("\t",num_games,"games,",str(round(100 * progress, 1))+"% of the file,",round(rate, 1),"games/sec, ETA",eta+",",\
+            round(100 * preprocess.get_rate(skipped, num_games), 2),"% skipped")
+        print_profile(profile_stats)
+
+# the QUARANTINE csv of a bucket: every game that was skipped, with its number in the GAMES file and why
+# (see QUARANTINE_COLUMNS). game numbers go on from first, the game of the GAMES file reading started at
+class Quarantine:
+    def __init__(self, path:str, first:int=0):
+        self.file = open_quarantine(path)
+        self.first = first
+
+    # writes the games of the next num_games games that were quarantined
+    # ((index in those games, reason, result, moves) tuples, see extract_block)
+    def write(self, num_games:int, quarantined:list):
+        if quarantined:
+            self.file.write(get_quarantine_text(self.first, quarantined))
+        self.first += num_games
+
+    def close(self):
+        self.file.close()
+
+# opens a QUARANTINE csv to add games to
+def open_quarantine(path:str):
+    f = open(path, "a")
+    if f.tell() == 0:
+        f.write(",".join(QUARANTINE_COLUMNS)+"\n")
+    return f
+
+# returns the QUARANTINE csv lines of quarantined games (see Quarantine.write) of a chunk that starts at game first
+def get_quarantine_text(first:int, quarantined:list):
+    return "".join([str(first + index)+","+reason+","+str(result)+","+moves+"\n"\
+        for index, reason, result, moves in quarantined])
+
+# returns how many games of a QUARANTINE csv were quarantined for each reason
+def count_quarantined(quarantine_path:str):
+    counts = collections.Counter()
+    with open(quarantine_path, "r") as f:
+        f.readline() # the header
+        for line in f:
+            counts[line.split(",", 2)[1]] += 1
+    return counts
+
+# prints how many games of every bucket (of names) were quarantined and why, and writes it to QUARANTINE_SUMMARY in path:
+#   {bucket: {"games": quarantined games, "reasons": {reason: games}}}
+def save_quarantine_summary(names:list, path:str):
+    summary = {}
+    for bucket in names:
+        quarantine_path = buckets.get_path(path, bucket, "QUARANTINE", "csv")
+        if not os.path.exists(quarantine_path):
+            continue
+        counts = count_quarantined(quarantine_path)
+        summary[bucket] = {"games": sum(counts.values()), "reasons": dict(sorted(counts.items()))}
+        print("\tquarantined",summary[bucket]["games"],"games of",bucket+\
+            "".join([", "+reason+": "+str(games) for reason, games in sorted(counts.items())]))
+    with open(os.path.join(path, QUARANTINE_SUMMARY), "w") as f:
+        json.dump(summary, f, indent=1)
+
+# returns the number of games in a GAMES csv (or .npy)
+def count_games(csv:str):
+    if csv.endswith(".npy"):
+        with open(csv, "rb") as f:
+            return columnar.read_header(f)[0]
+    lines = 0
+    with open(csv, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            lines += block.count(b"\n")
+    return max(lines - 1, 0) # the header
 
 #returns the number of unique pieces moved by white in k turns
+# (the moves have to be playable, see check_game)
 def extract_num_unique_pieces_moved_w(moves_ar,k):
     # number of unique pieces
     num_unique = 0
@@ -99,7 +863,7 @@ def extract_num_unique_pieces_moved_w(moves_ar,k):
     # list of starting points of pieces that have moved in row 2
     row_2 = []
     # simulate the board
-    board = chess.Board()
+    board = openingboard.OpeningBoard()
     # if there are less than k moves, use moves # instead of k
     length = 0
     if len(moves_ar) < k:
@@ -118,10 +882,7 @@ def extract_num_unique_pieces_moved_w(moves_ar,k):
             else:
                 row_1.append("a1")
         else:
-            try:
-                start_pos = board.push_san(moves_ar[i][0]).uci()[:2]
-            except:
-                pass
+            start_pos = board.push_san(moves_ar[i][0]).uci()[:2]
             if start_pos[1] == '1':
                 if start_pos not in row_1:
                     num_unique += 1
@@ -135,6 +896,7 @@ def extract_num_unique_pieces_moved_w(moves_ar,k):
     return num_unique
 
 # returns the number of unique pieces moved by black in k turns
+# (the moves have to be playable, see check_game)
 def extract_num_unique_pieces_moved_b(moves_ar,k):
     # number of unique pieces
     num_unique = 0
@@ -143,7 +905,7 @@ def extract_num_unique_pieces_moved_b(moves_ar,k):
     # list of starting points of pieces that have moved in row 7
     row_7 = []
     # simulate the board
-    board = chess.Board()
+    board = openingboard.OpeningBoard()
     # if there are less than k moves, use moves # instead of k
     length = 0
     if len(moves_ar) < k:
@@ -202,9 +964,27 @@ def extract_num_unique_pieces_moved_b(moves_ar,k):
 
 # extracts and returns the material count k-moves into the game
 # 0 means even material, negative num means black is up, positive num means white is up
-def extract_material_difference(moves_ar, k):
+def extract_material_difference(moves_ar, k, legacy:bool=False):
     # simulate the board
     board = sim_board(moves_ar, k)
+    if legacy:
+        return evaluate_material_difference_legacy(board)
+    return evaluate_material_difference(board)
+
+# returns the material count of a board straight from its bitboards
+# 0 means even material, negative num means black is up, positive num means white is up
+def evaluate_material_difference(board):
+    white = board.occupied_co[chess.WHITE]
+    black = board.occupied_co[chess.BLACK]
+    minors = board.knights | board.bishops
+    return chess.popcount(board.pawns & white) - chess.popcount(board.pawns & black)\
+        + 3 * (chess.popcount(minors & white) - chess.popcount(minors & black))\
+        + 5 * (chess.popcount(board.rooks & white) - chess.popcount(board.rooks & black))\
+        + 9 * (chess.popcount(board.queens & white) - chess.popcount(board.queens & black))
+
+# the original material count, which parses str(board).
+# gives the same numbers as evaluate_material_difference, just slower.
+def evaluate_material_difference_legacy(board):
     # Change the board into just a string of pieces.
     # We don't care about piece positions. just the peice count.
     # capital letters = white, lower-case = black.
@@ -234,9 +1014,54 @@ def extract_material_difference(moves_ar, k):
 
 
 # (counts x-rays, ex: unmoved queens count towards center count)
-def extract_num_center_squares_controlled(moves_ar, k):
+def extract_num_center_squares_controlled(moves_ar, k, legacy:bool=False):
     # simulate the board
     board = sim_board(moves_ar, k)
+    if legacy:
+        return evaluate_num_center_squares_controlled_legacy(board)
+    return evaluate_num_center_squares_controlled(board)
+
+# builds the masks evaluate_num_center_squares_controlled counts with.
+# returns a dict (color, piece type) -> list of masks, where the i-th mask holds every square
+# a piece attacks more than i of d4/e4/d5/e5 from on an empty board (so x-rays count).
+def get_center_masks():
+    center_masks = {}
+    for color in chess.COLORS:
+        for piece_type in CENTER_PIECE_TYPES:
+            masks = [0, 0, 0, 0]
+            for square in chess.SQUARES:
+                if piece_type == chess.PAWN:
+                    attacks = chess.BB_PAWN_ATTACKS[color][square]
+                elif piece_type == chess.KNIGHT:
+                    attacks = chess.BB_KNIGHT_ATTACKS[square]
+                else:
+                    attacks = chess.BB_DIAG_ATTACKS[square][0]
+                    if piece_type == chess.QUEEN:
+                        attacks |= chess.BB_RANK_ATTACKS[square][0] | chess.BB_FILE_ATTACKS[square][0]
+                for i in range(chess.popcount(attacks & BB_CENTER)):
+                    masks[i] |= chess.BB_SQUARES[square]
+            center_masks[color, piece_type] = [mask for mask in masks if mask]
+    return center_masks
+
+# returns how many center squares each color controls on a board, counting every
+# pawn, knight, bishop and queen once for each of d4/e4/d5/e5 it attacks.
+# only uses popcounts of the board's bitboards against CENTER_MASKS.
+def evaluate_num_center_squares_controlled(board):
+    w = 0
+    b = 0
+    for piece_type in CENTER_PIECE_TYPES:
+        pieces = board.pieces_mask(piece_type, chess.WHITE)
+        for mask in CENTER_MASKS[chess.WHITE, piece_type]:
+            w += chess.popcount(pieces & mask)
+        pieces = board.pieces_mask(piece_type, chess.BLACK)
+        for mask in CENTER_MASKS[chess.BLACK, piece_type]:
+            b += chess.popcount(pieces & mask)
+    return w, b
+
+# the original center count, which parses str(board) with hand-written index tables.
+# kept so old FEATURES files can be reproduced (see --legacy). the tables have known bugs:
+# board_str[10-12] is board_str[-2] and knights are counted as 'K' instead of 'N'.
+def evaluate_num_center_squares_controlled_legacy(board):
     board_str = str(board).replace(' ', '').replace('\n', '')
     w = 0
     b = 0
@@ -264,6 +1089,8 @@ def extract_num_center_squares_controlled(moves_ar, k):
     b = pawns.count('p') + horsies.count('k') + bishops.count('b') + queens.count('q')
     return w, b
 
+CENTER_MASKS = get_center_masks()
+
 # extracts on what move white castled
 def extract_when_castled_w(moves_ar:list):
     i = 1
@@ -280,26 +1107,89 @@ def extract_when_castled_b(moves_ar:list):
     for move in moves_ar:
         if len(move) > 0:
             # for black, we need to check a move was even played!
-            try:
-                if "O-O" in move[1]:
-                    return i
-            except:
-                pass
+            if len(move) > 1 and "O-O" in move[1]:
+                return i
         i+=1
     return i
 
-# simulate k-moves and return a python-chess board representing this position
+# simulate k-moves and return an openingboard.OpeningBoard representing this position
+# (short games or games with early checkmate or resignation end where they end).
+# the moves have to be playable, see check_game: an illegal one raises ValueError
 def sim_board(moves_ar, k):
-    board = chess.Board()
-    for i in range(k):
-        try: # no error on short games or games with early checkmate or resignation
-            board.push_san(moves_ar[i][0])
-            board.push_san(moves_ar[i][1])
-        except:
-            pass
+    board = openingboard.OpeningBoard()
+    for turn in moves_ar[:k]:
+        for san in turn[:2]:
+            board.push_san(san)
     return board
 
+# yields the moves (in SAN) of a movetext str one ply at a time, so callers that only
+# want the first few moves never tokenize the rest of the game.
+# move numbers, comments (including %clk and %eval), NAGs, !/? marks, variations and
+# the result are all skipped. every other token is yielded, moves or not (see check_game).
+def iter_plies(moves:str):
+    if "{" in moves or "(" in moves or ";" in moves:
+        # comments and variations can hold spaces and moves of their own, so they need the regex
+        depth = 0 # how many variations deep we are
+        for token in MOVETEXT_TOKEN.finditer(moves):
+            san = token.group(1)
+            if san is None:
+                continue
+            if san == "(":
+                depth += 1
+            elif san == ")":
+                depth -= 1
+            elif depth == 0:
+                yield san
+        return
+    # everything else is split on whitespace, which is a lot faster than the regex
+    marks = "!" in moves or "?" in moves
+    for token in moves.split():
+        if token[0] not in SAN_FIRST_CHARS:
+            # results, NAGs, marks and move numbers ("1.", "1...") are skipped, "1.e4" keeps its move
+            if token in RESULTS or token[0] in "$!?":
+                continue
+            number = token.lstrip("0123456789")
+            if number[:1] == ".":
+                token = number.lstrip(".")
+                if not token:
+                    continue
+        if marks:
+            token = token.rstrip("!?")
+        yield token
+
+# returns the first num_plies plies of a movetext as a tuple: the ones extract_game takes the board features
+# of a game from, read the way it reads them (with get_moves_ar for legacy)
+def get_opening(moves:str, legacy:bool, num_plies:int):
+    if legacy:
+        return tuple(itertools.chain.from_iterable(get_moves_ar(moves)))[:num_plies]
+    return tuple(itertools.islice(iter_plies(moves), num_plies))
+
+# groups plies into an array where each index = one full turn (2 moves), like get_moves_ar
+def get_turns(plies:list):
+    return [plies[i:i+2] for i in range(0, len(plies), 2)]
+
+# extracts on what move each color castled from the plies of a game in one pass.
+# a color that never castled gets the number of moves in the game + 1,
+# the same as extract_when_castled_w and extract_when_castled_b.
+def extract_when_castled(plies):
+    when_castled_w = when_castled_b = 0
+    ply = 0
+    for san in plies:
+        if san.startswith(("O-O", "0-0")):
+            if ply % 2 == 0:
+                if when_castled_w == 0:
+                    when_castled_w = ply // 2 + 1
+            elif when_castled_b == 0:
+                when_castled_b = ply // 2 + 1
+            if when_castled_w and when_castled_b:
+                return when_castled_w, when_castled_b
+        ply += 1
+    num_moves = (ply + 1) // 2
+    return when_castled_w or num_moves + 1, when_castled_b or num_moves + 1
+
 # takes a moves str and returns an array where each index = one full turn (2 moves)
+# (the original splitter. breaks on comments and "..." and drops the last turn of a draw,
+# see iter_plies)
 def get_moves_ar(moves:str):
     m = []
     moves_ = moves.split(".")
@@ -319,42 +1209,168 @@ def get_moves_ar(moves:str):
 def strip_csv(csv:str):
     return csv.split("GAMES")[0]
 
-# get all the relevant csvs from the databases directory
-def get_csvs(path:str):
-    csvs = []
-    for root, directories, files in os.walk(path, topdown=False):
-	    for name in files:
-		    if (".csv" in name) and ("FEATURES" not in name): csvs.append(os.path.join(root, name))
-	    for name in directories:
-		    if (".csv" in name) and ("FEATURES" not in name): csvs.append(os.path.join(root, name))
-    return csvs
-
 # iterate through all the csvs. calls the processing function.
-def iterate_csvs(csvs:list, path:str):
-    for csv in csvs:
-        data = pd.read_csv(csv)
+# csvs are (bucket name, GAMES file) pairs (see buckets.get_files), each bucket's features go
+# in its FEATURES file in path and the games that were skipped in its QUARANTINE csv (see Quarantine),
+# which are counted in QUARANTINE_SUMMARY once every csv is done.
+# workers > 1 splits each csv across that many processes.
+# cache_size is how many positions each process's opening cache holds (0 turns it off).
+# file_format "npy" writes FEATURES .npy files (see columnar.py) instead of csvs.
+# progress is checkpointed in a manifest in path, so a run that was stopped picks up where it was,
+# csvs that were already processed are skipped and csvs that grew (preprocess.py appends to them)
+# are read from where they ended. restart ignores the manifest and processes everything again.
+# progress is reported every progress_seconds (0 turns it off), with the profile stats if the
+# feature profiler is on (see set_profiler).
+# tree adds the games of every csv to the opening tree in path (see openingtree.py, and load_tree)
+# and saves it once they're done. the games processed now are added as they're extracted, the ones
+# processed before that the tree doesn't have yet (a run without tree, or one that was stopped)
+# from their GAMES and FEATURES files.
+def iterate_csvs(csvs:list, path:str, workers:int=1, chunk_size:int=CHUNK_SIZE, legacy:bool=False,\
+        cache_size:int=OPENING_CACHE_SIZE, file_format:str="csv", restart:bool=False, progress_seconds:float=0,\
+        horizons:dict=None, tree:bool=False):
+    if horizons is None:
+        horizons = HORIZONS
+    columns = get_feature_columns(horizons)
+    # the FEATURES files are started over when the GAMES files are (see buckets.save)
+    settings = {"legacy": legacy, "horizons": horizons, "games": buckets.load_generation(path)}
+    manifest = checkpoint.Manifest(os.path.join(path, MANIFEST), settings, restart)
+    scheme = buckets.load(path)
+    opening_plies = 2 * get_max_horizon(horizons)
+    if tree:
+        opening_tree, tree_games = load_tree(path, manifest, csvs, scheme, columns, horizons, legacy, opening_plies)
+        # whether the tree has to be saved
+        tree_changed = not openingtree.exists(path)
+    processed = False
+    for bucket, csv in csvs:
+        out_path = buckets.get_path(path, bucket, "FEATURES", file_format)
+        quarantine_path = buckets.get_path(path, bucket, "QUARANTINE", "csv")
+        number = scheme.names.index(bucket)
+        name = manifest.get_name(csv)
+        status = manifest.get_status(csv)
+        if status == "done":
+            print("skipping",csv,"(already processed)")
+            if tree and fill_tree(opening_tree, tree_games, name, number, csv, out_path, manifest.get_offset(csv), legacy,\
+                    opening_plies, chunk_size):
+                tree_changed = True
+            continue
+        processed = True
+        if status == "changed":
+            print(csv,"changed since it was processed, starting it over")
+            manifest.forget(csv, [out_path, quarantine_path])
+        # drop whatever was written after the last checkpoint
+        manifest.restore_outputs([out_path, quarantine_path])
+        offset = manifest.get_offset(csv)
+        reader = GamesReader(csv, chunk_size, offset)
+        data = iter(reader)
         print("analyzing",csv)
-        rating_range = get_range(csv)
-        out_path = path+rating_range+"FEATURES.csv"
-        out = open(out_path, "a")
+        if offset > 0:
+            print("resuming at game",offset)
+            if tree:
+                fill_tree(opening_tree, tree_games, name, number, csv, out_path, offset, legacy, opening_plies, chunk_size)
+        if file_format == "npy":
+            out = columnar.NpyWriter(out_path, columnar.get_features_dtype(columns))
+        else:
+            out = open(out_path, "a")
         print("writing to "+out_path)
-        out.write("when_castled,num_center_squares_controlled,material_difference,num_unique_pieces_moved,win\n")
-        process(csv, data, out)
-
-# extract the rating range from a csv string
-def get_range(csv:str):
-    if "1000" in csv:
-        return "1000-1499"
-    elif "1500" in csv:
-        return "1500-1999"
-    elif "2000" in csv:
-        return "2000+"
-    elif "999" in csv:
-        return "0-999"
+        if file_format == "csv" and out.tell() == 0:
+            out.write(",".join(columns)+"\n")
+        out = writer.wrap(out)
+        quarantine = Quarantine(quarantine_path, offset)
+        try:
+            save_progress = functools.partial(save_checkpoint, manifest, csv, [out, quarantine.file],\
+                [out_path, quarantine_path], offset)
+            progress = None
+            if progress_seconds > 0:
+                progress = Progress(reader.get_progress, progress_seconds)
+            csv_tree = openingtree.OpeningTree(columns[:-1]) if tree else None
+            if workers > 1:
+                num_games = process_parallel(csv, data, out, workers, legacy, cache_size, file_format, save_progress, progress, horizons,\
+                    quarantine, csv_tree)
+            else:
+                set_opening_cache(cache_size)
+                set_profiler(feature_profiler is not None) # start the counts over
+                num_games = process(csv, data, out, legacy, file_format, save_progress, progress, horizons, quarantine, csv_tree)
+                if opening_cache is not None:
+                    print("\topening cache:",get_cache_stats())
+                if feature_profiler is not None:
+                    print_profile(get_profile_stats())
+            manifest.commit(csv, offset + num_games, [out, quarantine.file], [out_path, quarantine_path], done=True)
+        finally:
+            # whatever was written after the last checkpoint is cut off on the next run anyway
+            out.close()
+            quarantine.close()
+        if tree:
+            opening_tree.merge(csv_tree, number)
+            tree_games[name] = offset + num_games
+            tree_changed = True
+    save_quarantine_summary([bucket for bucket, csv in csvs], path)
+    if tree and tree_changed:
+        opening_tree.save(path, scheme.spec, scheme.names, horizons, legacy, opening_plies, tree_games, settings["games"])
+    elif not tree and processed and openingtree.exists(path):
+        print("the opening tree in",path,"doesn't have the games processed now, --tree adds them")
+
+# returns the opening tree saved in path as an openingtree.OpeningTree to add the games of csvs to, and how
+# many games of every GAMES file (by their names in manifest) it has. a tree saved with other settings or of
+# other GAMES files (see buckets.save), or with games that aren't processed anymore (their GAMES file changed
+# or is processed again), is started over
+def load_tree(path:str, manifest, csvs:list, scheme, columns:list, horizons:dict, legacy:bool, opening_plies:int):
+    if openingtree.exists(path):
+        index = openingtree.OpeningIndex(path)
+        if (index.scheme, index.buckets, index.columns, index.horizons, index.legacy, index.opening_plies, index.generation) ==\
+                (scheme.spec, scheme.names, columns[:-1], horizons, legacy, opening_plies, manifest.settings["games"])\
+                and index.games is not None:
+            processed = {manifest.get_name(csv): manifest.get_offset(csv) for bucket, csv in csvs\
+                if manifest.get_status(csv) not in ("new", "changed")}
+            if all(games <= processed.get(name, 0) for name, games in index.games.items()):
+                return index.get_tree(), dict(index.games)
+        print("the opening tree in",path,"doesn't go with the games processed, building it again")
+    return openingtree.OpeningTree(columns[:-1]), {}
+
+# adds the games of a GAMES csv (or .npy) the tree doesn't have yet (tree_games has how many of every
+# GAMES file it has, by name) up to num_games to tree from its files, see add_to_tree.
+# returns whether there were any
+def fill_tree(tree, tree_games:dict, name:str, bucket:int, csv:str, features:str, num_games:int, legacy:bool,\
+        num_plies:int, chunk_size:int=CHUNK_SIZE):
+    start = tree_games.get(name, 0)
+    if start >= num_games:
+        return False
+    print("adding the openings of",num_games - start,"games of",csv,"to the opening tree")
+    add_to_tree(tree, bucket, csv, features, num_games, legacy, num_plies, chunk_size, start)
+    tree_games[name] = num_games
+    return True
+
+# adds the games of a GAMES csv (or .npy) from game start up to num_games to tree as games of bucket, with the
+# board features and when_castled of its FEATURES file (two rows per game, see FeatureBlock) instead of replaying
+# them. games the FEATURES file has -1s for were skipped
+def add_to_tree(tree, bucket:int, csv:str, features:str, num_games:int, legacy:bool, num_plies:int, chunk_size:int=CHUNK_SIZE,\
+        start:int=0):
+    game = start
+    for games, data in zip(read_games(csv, chunk_size, start), read_features(features, 2 * chunk_size, 2 * start)):
+        games = games[:num_games - game]
+        rows = np.stack([np.asarray(data[column]) for column in tree.columns], axis=1)[:2 * len(games)].tolist()
+        if len(rows) != 2 * len(games):
+            raise ValueError(features+" doesn't have two rows for every game of "+csv+", it has to be processed again")
+        for (moves, result), white, black in zip(games, rows[0::2], rows[1::2]):
+            if white[0] == -1:
+                node = 0
+            else:
+                node = tree.get_node(get_opening(moves, legacy, num_plies))
+            tree.add(node, bucket, result, tuple(white[1:] + black[1:]), white[0], black[0])
+        game += len(games)
+        if game >= num_games:
+            break
+    if game < num_games:
+        raise ValueError(csv+" has fewer games than were processed, it has to be processed again")
+
+# checkpoints how far into csv the rows in outs (open at out_paths) go, if a checkpoint is due.
+# offset is where in csv this run started and num_games how many games it has done since
+def save_checkpoint(manifest, csv:str, outs:list, out_paths:list, offset:int, num_games:int):
+    if manifest.is_due():
+        manifest.commit(csv, offset + num_games, outs, out_paths)
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("USEAGE: python process.py <path-to-csvs-directory>")
+    if len(sys.argv) < 2:
+        print("USEAGE: python process.py <path-to-csvs-directory> [--workers N] [--chunk-size N] [--legacy] [--cache-size N] [--format csv|npy] [--restart] [--progress SECONDS] [--profile] [--cprofile PATH] [--unique-moves N,N..] [--material-moves N,N..] [--center-moves N,N..] [--write-buffer BYTES] [--fsync] [--tree]")
         print("NOTE: must be run with python2 because of the python-chess library")
     else:
         main(sys.argv[1:])
@@ -0,0 +1,226 @@
+import numpy as np
+import itertools
+import bisect
+import json
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import columnar
+import buckets
+import process
+
+# a memory mapped store of the features of every game in a directory, built from its GAMES and
+# FEATURES files. every game is one fixed width row of STORE_ROWS (a .npy file):
+#   game          - the game's number in its bucket's GAMES file
+#   bucket        - the bucket's number in buckets.json
+#   opening       - the number of the game's first OPENING_PLIES plies in the sorted openings table
+#   result        - 1 if white won, 0 if draw, 2 if black won (like the GAMES files)
+#   <feature>_w/b - every FEATURES column for white and for black, as int8s (int16 for when_castled)
+# the rows are sorted by bucket, then opening, then game. openings are numbered in the order of their
+# plies, so the games of a bucket that start with any sequence of moves are one slice of the file,
+# found with two binary searches in the index (STORE_INDEX) and read without copying or parsing:
+#   FeatureStore(path).get_rows("1500-1999", "1.e4 c5")
+
+# the files of a store, next to the FEATURES files
+STORE_ROWS = "features-store.npy"
+STORE_INDEX = "features-store.json"
+# how many plies of every game are indexed
+OPENING_PLIES = 6
+# how many games are read at a time while the store is built
+CHUNK_SIZE = 100000
+
+def main(args:list):
+    start = time.time()
+    args = get_args(args)
+    build(str(args.path), args.format, args.opening_plies)
+    print("Done. Took",time.time()-start,"seconds.")
+
+# reads the commandline args
+def get_args(args:list):
+    parser = argparse.ArgumentParser(description="builds the features store of the GAMES and FEATURES files of a directory")
+    parser.add_argument("path", help="path to the csvs directory")
+    parser.add_argument("--format", choices=["csv", "npy"], default="csv", help="format of the GAMES and FEATURES files to read")
+    parser.add_argument("--opening-plies", type=int, default=OPENING_PLIES, help="how many plies of every game to index")
+    return parser.parse_args(args)
+
+# returns the dtype of the rows of a store of FEATURES columns (without win)
+def get_store_dtype(columns:list):
+    features = columnar.get_features_dtype(columns)
+    fields = [("game", np.int64), ("bucket", np.uint16), ("opening", np.uint32), ("result", np.int8)]
+    for column in columns:
+        fields += [(column+"_w", features[column]), (column+"_b", features[column])]
+    return np.dtype(fields)
+
+# builds the store of the buckets in path that have both a GAMES and a FEATURES file.
+# the files are read twice, a chunk at a time: once to number the openings and count the games of
+# every bucket and opening, and once to put every game's row where it goes in the sorted store.
+# nothing is ever sorted in memory, so the store can be much bigger than it
+def build(path:str, file_format:str="csv", opening_plies:int=OPENING_PLIES):
+    scheme = buckets.load(path)
+    inputs = []
+    for number, name in enumerate(scheme.names):
+        games = buckets.get_path(path, name, "GAMES", file_format)
+        features = buckets.get_path(path, name, "FEATURES", file_format)
+        if os.path.exists(games) and os.path.exists(features):
+            inputs.append((number, name, games, features))
+    print("building the store of",len(inputs),"buckets")
+    columns = None
+    temp_dir = tempfile.mkdtemp(prefix=".store-", dir=path)
+    try:
+        # opening plies -> the number it was first seen as
+        numbers = {}
+        # bucket -> games per opening number
+        counts = {}
+        for number, name, games, features in inputs:
+            file_columns = [column for column in columnar.get_columns(features) if column != "win"]
+            if columns is None:
+                columns = file_columns
+            elif file_columns != columns:
+                raise ValueError(features+" has the columns "+str(file_columns)+", not "+str(columns))
+            print("numbering the openings of",games)
+            counts[number] = number_openings(games, os.path.join(temp_dir, name+".npy"), numbers, opening_plies)
+        # numbered in the order of their plies instead
+        openings = sorted(numbers)
+        renumber = np.zeros(len(openings), dtype=np.uint32)
+        renumber[[numbers[opening] for opening in openings]] = np.arange(len(openings), dtype=np.uint32)
+        # where the rows of every bucket and opening start
+        starts = {}
+        ranges = []
+        total = 0
+        for number, name, games, features in inputs:
+            sorted_counts = np.zeros(len(openings), dtype=np.int64)
+            sorted_counts[renumber[:len(counts[number])]] = counts[number]
+            starts[number] = total + np.concatenate(([0], np.cumsum(sorted_counts)[:-1]))
+            ranges.append({"name": name, "number": number, "start": total, "end": total + int(sorted_counts.sum())})
+            total += int(sorted_counts.sum())
+        temp_rows = os.path.join(temp_dir, STORE_ROWS)
+        rows = np.lib.format.open_memmap(temp_rows, mode="w+", dtype=get_store_dtype(columns or []), shape=(total,))
+        for number, name, games, features in inputs:
+            print("storing",features)
+            store_rows(rows, number, features, os.path.join(temp_dir, name+".npy"), columns, renumber, starts[number])
+        rows.flush()
+        del rows
+        os.replace(temp_rows, os.path.join(path, STORE_ROWS))
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+    index = {"scheme": scheme.spec, "columns": columns or [], "opening_plies": opening_plies,\
+        "buckets": ranges, "openings": [list(opening) for opening in openings]}
+    with open(os.path.join(path, STORE_INDEX)+".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(os.path.join(path, STORE_INDEX)+".tmp", os.path.join(path, STORE_INDEX))
+    print("stored",total,"games with",len(openings),"openings")
+
+# first pass of build: writes the opening number of every game of a GAMES file to out (a .npy file),
+# numbering new openings as they come. returns the number of games per opening number
+def number_openings(games:str, out:str, numbers:dict, opening_plies:int):
+    writer = columnar.NpyWriter(out, np.uint32)
+    counts = np.zeros(0, dtype=np.int64)
+    for chunk in process.read_games(games, CHUNK_SIZE):
+        chunk_numbers = []
+        for moves, result in chunk:
+            opening = tuple(itertools.islice(process.iter_plies(moves), opening_plies))
+            number = numbers.get(opening)
+            if number is None:
+                number = numbers[opening] = len(numbers)
+            chunk_numbers.append(number)
+        chunk_numbers = np.array(chunk_numbers, dtype=np.uint32)
+        writer.write(chunk_numbers)
+        chunk_counts = np.bincount(chunk_numbers, minlength=len(numbers))
+        chunk_counts[:len(counts)] += counts
+        counts = chunk_counts
+    writer.close()
+    return counts
+
+# second pass of build: puts a row in rows for every game of a FEATURES file (two rows, white's
+# and black's, per game) of bucket. openings is the file written by number_openings, renumber turns
+# its numbers into the sorted ones and starts is where every (sorted) opening's games go next
+def store_rows(rows, bucket:int, features:str, openings:str, columns:list, renumber, starts):
+    starts = starts.copy()
+    openings = columnar.load_npy(openings)
+    game = 0
+    for data in process.read_features(features, 2 * CHUNK_SIZE):
+        num_games = len(data["win"]) // 2
+        if 2 * num_games != len(data["win"]) or game + num_games > len(openings):
+            raise ValueError(features+" doesn't have two rows for every game of its GAMES file, it has to be processed again")
+        chunk_openings = openings[game:game + num_games]
+        chunk = np.zeros(num_games, dtype=rows.dtype)
+        chunk["game"] = np.arange(game, game + num_games)
+        chunk["bucket"] = bucket
+        chunk["opening"] = renumber[chunk_openings]
+        wins = np.asarray(data["win"])
+        chunk["result"] = np.where(wins[0::2] == 1, 1, np.where(wins[1::2] == 1, 2, 0))
+        for column in columns:
+            values = np.asarray(data[column])
+            chunk[column+"_w"] = values[0::2]
+            chunk[column+"_b"] = values[1::2]
+        # the games of the chunk go after the games of their opening that came before them
+        order = np.argsort(chunk["opening"], kind="stable")
+        chunk = chunk[order]
+        chunk_opening, first, count = np.unique(chunk["opening"], return_index=True, return_counts=True)
+        positions = starts[chunk["opening"]] + (np.arange(num_games) - np.repeat(first, count))
+        starts[chunk_opening] += count
+        rows[positions] = chunk
+        game += num_games
+    if game != len(openings):
+        raise ValueError(features+" doesn't have two rows for every game of its GAMES file, it has to be processed again")
+
+# a store built by build, memory mapped
+class FeatureStore:
+    def __init__(self, path:str):
+        with open(os.path.join(path, STORE_INDEX), "r") as f:
+            index = json.load(f)
+        self.columns = index["columns"]
+        self.opening_plies = index["opening_plies"]
+        self.buckets = [bucket["name"] for bucket in index["buckets"]]
+        self.ranges = {bucket["name"]: (bucket["start"], bucket["end"]) for bucket in index["buckets"]}
+        self.openings = [tuple(opening) for opening in index["openings"]]
+        self.rows = columnar.load_npy(os.path.join(path, STORE_ROWS))
+
+    # returns the rows of the games of a bucket that start with opening (movetext like "1.e4 c5", or a
+    # list of plies), as a slice of the memory mapped store. without a bucket the games of every bucket
+    # are returned, which only needs no copy if there's no opening either
+    def get_rows(self, bucket:str=None, opening=None):
+        if bucket is None:
+            if opening is None:
+                return self.rows
+            return np.concatenate([self.get_rows(name, opening) for name in self.buckets])
+        start, end = self.ranges[bucket]
+        if opening is None:
+            return self.rows[start:end]
+        first, last = self.get_openings(opening)
+        openings = self.rows["opening"][start:end]
+        return self.rows[start + np.searchsorted(openings, first):start + np.searchsorted(openings, last)]
+
+    # returns the range of opening numbers that start with opening (see get_rows)
+    def get_openings(self, opening):
+        if isinstance(opening, str):
+            opening = tuple(process.iter_plies(opening))
+        opening = tuple(opening)
+        if len(opening) > self.opening_plies:
+            raise ValueError("the store only indexes the first "+str(self.opening_plies)+" plies of every game")
+        if len(opening) == 0:
+            return 0, len(self.openings)
+        # every opening that starts with these plies sorts before this one
+        after = opening[:-1] + (opening[-1] + "\0",)
+        return bisect.bisect_left(self.openings, opening), bisect.bisect_left(self.openings, after)
+
+    # returns the opening plies of a row as movetext
+    def get_opening(self, row):
+        return " ".join(self.openings[int(row["opening"])])
+
+# returns the features of rows of a store like the rows of a FEATURES file: a 2d array with
+# a column per feature and the win column, white's rows and then black's
+def get_features(rows, columns:list):
+    x = np.concatenate([np.stack([rows[column+"_w"] for column in columns]),\
+        np.stack([rows[column+"_b"] for column in columns])], axis=1).T
+    y = np.concatenate([(rows["result"] == 1), (rows["result"] == 2)]).astype(np.int8)
+    return x, y
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("USEAGE: python store.py <path-to-csvs-directory> [--format csv|npy] [--opening-plies N]")
+    else:
+        main(sys.argv[1:])
@@ -0,0 +1,148 @@
+import os
+import threading
+import queue
+import multiprocessing
+import numpy as np
+
+# writes the outputs of preprocess.py, process.py and fused.py from a background thread, so the thread
+# that parses or extracts never waits on the disk (or a network share) when it writes. every output is
+# double buffered: what it's given is kept in a buffer until there's WRITE_BUFFER bytes of it, then the
+# buffer is joined into one big write (text into one str, arrays into one array) and written by the
+# flusher while the next buffer fills up. an output only ever has one buffer being written, so memory
+# stays bounded and its writes stay in order. one flusher thread per process writes every output.
+# checkpoints (see checkpoint.get_output_size) wait for the buffers of an output to be written first.
+
+# how many bytes an output buffers before they're handed to the flusher
+WRITE_BUFFER = 1024 * 1024
+
+# what wrap does with the outputs of this process, see set_buffering
+write_buffer = WRITE_BUFFER
+fsync = False
+# the flusher of this process, see get_flusher
+flusher = None
+
+# sets how outputs opened from now on are written: write_buffer bytes at a time from the background
+# (0 writes them right away, on the thread that writes to them) and, with fsync, synced to disk after
+# every buffer instead of only at checkpoints and on close
+def set_buffering(buffer_bytes:int, sync:bool=False):
+    global write_buffer, fsync
+    write_buffer = buffer_bytes
+    fsync = sync
+
+# returns an output (anything with write and close: a file, a columnar.NpyWriter, ...) that's written
+# from the background, or out itself if buffering is off
+def wrap(out):
+    if write_buffer <= 0:
+        return out
+    return BackgroundWriter(out, write_buffer, fsync)
+
+# returns the flusher of this process. a forked process doesn't have its parent's thread, so it gets its own
+def get_flusher():
+    global flusher
+    if flusher is None or flusher.pid != os.getpid():
+        flusher = Flusher()
+    return flusher
+
+# returns a multiprocessing.Pool of workers processes (initializer and initargs like multiprocessing.Pool's).
+# a worker forked while the flusher writes could start with a lock the flusher holds taken, so the flusher of
+# this process is stopped first (once it wrote everything it was handed) and the next buffer starts a new one
+def get_pool(workers:int, initializer=None, initargs:tuple=()):
+    global flusher
+    if flusher is not None and flusher.pid == os.getpid():
+        flusher.stop()
+        flusher = None
+    return multiprocessing.Pool(workers, initializer, initargs)
+
+# the thread that writes the buffers of every BackgroundWriter of a process, in the order they're handed over
+class Flusher:
+    def __init__(self):
+        self.pid = os.getpid()
+        self.buffers = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            out, buffer = self.buffers.get()
+            if out is None: # see stop
+                return
+            try:
+                out.write_buffer(buffer)
+            except Exception as e:
+                out.error = e
+            out.written.release()
+
+    # waits for the buffers handed over so far to be written and ends the thread
+    def stop(self):
+        self.buffers.put((None, None))
+        self.thread.join()
+
+# stands in for an output, see above. the arrays written to it mustn't be changed afterwards
+class BackgroundWriter:
+    def __init__(self, out, buffer_bytes:int=WRITE_BUFFER, sync:bool=False):
+        self.out = out
+        self.buffer_bytes = buffer_bytes
+        self.sync = sync
+        self.buffer = []
+        self.size = 0
+        # taken while a buffer is being written
+        self.written = threading.Semaphore(1)
+        # what stopped the last write, raised on the writing thread
+        self.error = None
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.size += data.nbytes if isinstance(data, np.ndarray) else len(data)
+        if self.size >= self.buffer_bytes:
+            self.hand_over()
+
+    # hands the buffer to the flusher once the one before it is written
+    def hand_over(self):
+        self.written.acquire()
+        if self.error is not None or not self.buffer:
+            self.written.release()
+            self.check()
+            return
+        buffer = self.buffer
+        self.buffer = []
+        self.size = 0
+        get_flusher().buffers.put((self, buffer))
+
+    # background side of hand_over: writes a buffer to the output in one go
+    def write_buffer(self, buffer:list):
+        if isinstance(buffer[0], np.ndarray):
+            self.out.write(np.concatenate(buffer))
+        else:
+            self.out.write("".join(buffer))
+        if self.sync:
+            sync_output(self.out)
+
+    # raises what went wrong in the background, if anything did
+    def check(self):
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    # waits until everything written so far is written to the output
+    def flush(self):
+        self.hand_over()
+        self.written.acquire()
+        self.written.release()
+        self.check()
+
+    def close(self):
+        try:
+            self.flush()
+            if self.sync:
+                sync_output(self.out)
+        finally:
+            self.out.close()
+
+# writes everything an output buffers itself to disk
+def sync_output(out):
+    if hasattr(out, "checkpoint"): # a columnar.NpyWriter or GamesWriter
+        out.checkpoint()
+    else:
+        out.flush()
+        os.fsync(out.fileno())